@@ -0,0 +1,150 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Compare the time per training step and per NEQ inference batch of the eager
+# sub-networks against the torch.compile'd ones (see compile_subnetworks()).
+# Random inputs are used, so the dataset is not needed.
+
+import time
+from argparse import ArgumentParser
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from neuralut.nn import compile_subnetworks
+
+from models import JetSubstructureNeqModel
+
+
+def time_steps(step, num_warmup, num_steps, cuda):
+    for i in range(num_warmup):
+        step()
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for i in range(num_steps):
+        step()
+    if cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_steps
+
+
+def benchmark(model, x, target, args):
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.AdamW(model.parameters(), lr=1e-3, betas=(0.5, 0.999))
+
+    def train_step():
+        model.train()
+        optimizer.zero_grad()
+        loss = criterion(model(x), target)
+        loss.backward()
+        optimizer.step()
+
+    def inference_step():
+        model.eval()
+        with torch.no_grad():
+            model(x)
+
+    train_time = time_steps(train_step, args.warmup, args.steps, args.cuda)
+    inference_time = time_steps(inference_step, args.warmup, args.steps, args.cuda)
+    return train_time, inference_time
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Benchmark the eager vs. compiled NeuraLUT sub-networks"
+    )
+    parser.add_argument(
+        "--hidden-layers",
+        nargs="+",
+        type=int,
+        default=[128, 128, 128, 64],
+        help="A list of hidden layer neuron sizes (default: %(default)s)",
+    )
+    parser.add_argument("--input-length", type=int, default=16)
+    parser.add_argument("--output-length", type=int, default=5)
+    parser.add_argument("--input-bitwidth", type=int, default=7)
+    parser.add_argument("--hidden-bitwidth", type=int, default=4)
+    parser.add_argument("--output-bitwidth", type=int, default=4)
+    parser.add_argument("--input-fanin", type=int, default=2)
+    parser.add_argument("--hidden-fanin", type=int, default=3)
+    parser.add_argument("--output-fanin", type=int, default=3)
+    parser.add_argument("--width-n", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=5,
+        help="Untimed steps, which include compilation (default: %(default)s)",
+    )
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default=None,
+        help="The torch.compile mode, e.g., max-autotune (default: %(default)s)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cuda", action="store_true", default=False)
+    args = parser.parse_args()
+
+    model_cfg = {
+        "hidden_layers": args.hidden_layers,
+        "input_length": args.input_length,
+        "output_length": args.output_length,
+        "input_bitwidth": args.input_bitwidth,
+        "hidden_bitwidth": args.hidden_bitwidth,
+        "output_bitwidth": args.output_bitwidth,
+        "input_fanin": args.input_fanin,
+        "hidden_fanin": args.hidden_fanin,
+        "output_fanin": args.output_fanin,
+        "width_n": args.width_n,
+        "cuda": args.cuda,
+    }
+    torch.manual_seed(args.seed)
+    eager_model = JetSubstructureNeqModel(model_cfg)
+    compiled_model = JetSubstructureNeqModel(model_cfg)
+    compiled_model.load_state_dict(eager_model.state_dict())
+    x = torch.randn(args.batch_size, args.input_length)
+    target = torch.randint(args.output_length, (args.batch_size,))
+    if args.cuda:
+        eager_model.cuda()
+        compiled_model.cuda()
+        x, target = x.cuda(), target.cuda()
+    compile_subnetworks(compiled_model, mode=args.mode)
+
+    # Check that both models compute the same function before timing them
+    eager_model.eval()
+    compiled_model.eval()
+    with torch.no_grad():
+        max_diff = (eager_model(x) - compiled_model(x)).abs().max().item()
+    print(f"Max. absolute difference between eager and compiled outputs: {max_diff}")
+
+    results = {}
+    for name, model in [("eager", eager_model), ("compiled", compiled_model)]:
+        results[name] = benchmark(model, x, target, args)
+    print(f"{'':<10}{'train step (ms)':>18}{'inference (ms)':>18}")
+    for name, (train_time, inference_time) in results.items():
+        print(f"{name:<10}{1e3*train_time:>18.3f}{1e3*inference_time:>18.3f}")
+    print(
+        f"{'speedup':<10}"
+        f"{results['eager'][0]/results['compiled'][0]:>17.2f}x"
+        f"{results['eager'][1]/results['compiled'][1]:>17.2f}x"
+    )
@@ -0,0 +1,305 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Measure the cost of each stage of the conversion in neq2lut.py (truth table
+# generation, LUT inference, Verilog emission, BENCH emission and, optionally,
+# the Verilator build and simulation) on randomly initialized models, for a
+# grid of fan-ins, bitwidths, sub-network widths and layer sizes. The dataset
+# is not needed.
+# Results can be stored as JSON (--save) and compared against a previous run
+# (--compare), which fails if any stage got slower, or its peak RSS larger,
+# than --tolerance allows.
+
+import itertools
+import json
+import platform
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from neuralut.instrument import Instrumentation
+from neuralut.nn import (
+    SparseLinearNeq,
+    generate_truth_tables,
+    lut_inference,
+    module_list_to_verilog_module,
+)
+
+from models import JetSubstructureNeqModel
+
+STAGES = [
+    "truth_tables",
+    "lut_inference",
+    "verilog",
+    "bench",
+    "verilator_build",
+    "simulation",
+]
+
+
+# Run fn() repeat times in a span of instrumentation, which samples the RSS
+# while the stage runs, and record its fastest wall time, the peak RSS of the
+# process and of its child processes (e.g., the Verilator build) during the
+# stage, how much the RSS of the process grew over the stage and the number of
+# items it processed per second
+def measure(instrumentation, stage, fn, items, repeat):
+    times = []
+    with instrumentation.span(stage) as s:
+        start_rss = s.peak_rss
+        for i in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+    wall_time = min(times)
+    return {
+        "wall_time_s": wall_time,
+        "peak_rss_mb": s.peak_rss / 2**20,
+        "rss_growth_mb": (s.peak_rss - start_rss) / 2**20,
+        "child_peak_rss_mb": s.child_peak_rss / 2**20,
+        "items": items,
+        "throughput": items / wall_time if wall_time > 0 else float("inf"),
+    }
+
+
+def write_bench(model, directory):
+    for i, layer in enumerate(model.module_list):
+        for index in range(layer.out_features):
+            module_name = f"layer{i}_N{index}"
+            with open(f"{directory}/{module_name}.bench", "w") as f:
+                f.write(layer.gen_neuron_bench(index, module_name))
+
+
+def benchmark_config(params, args):
+    model_cfg = {
+        "hidden_layers": [params["out_features"]] * args.num_layers,
+        "input_length": args.input_length,
+        "output_length": args.output_length,
+        "input_bitwidth": params["bitwidth"],
+        "hidden_bitwidth": params["bitwidth"],
+        "output_bitwidth": params["bitwidth"],
+        "input_fanin": params["fanin"],
+        "hidden_fanin": params["fanin"],
+        "output_fanin": params["fanin"],
+        "width_n": params["width_n"],
+        "cuda": args.cuda,
+    }
+    torch.manual_seed(args.seed)
+    model = JetSubstructureNeqModel(model_cfg)
+    if args.cuda:
+        model.cuda()
+    model.eval()
+    x = torch.randn(args.samples, args.input_length)
+    if args.cuda:
+        x = x.cuda()
+    layers = [m for m in model.modules() if type(m) == SparseLinearNeq]
+    num_neurons = sum(layer.out_features for layer in layers)
+    num_entries = sum(sum(layer.get_truth_table_sizes()) for layer in layers)
+
+    def infer():
+        with torch.no_grad():
+            model(x)
+
+    instrumentation = Instrumentation(sample_interval=0.01)
+    stages = {}
+
+    def run(stage, fn, items, repeat=args.repeat):
+        stages[stage] = measure(instrumentation, stage, fn, items, repeat)
+
+    try:
+        run("truth_tables", lambda: generate_truth_tables(model), num_entries)
+        lut_inference(model)
+        run("lut_inference", infer, args.samples)
+        with tempfile.TemporaryDirectory(dir=args.output_dir) as directory:
+            run(
+                "verilog",
+                lambda: module_list_to_verilog_module(
+                    model.module_list, "neuralut", directory, add_registers=False
+                ),
+                num_neurons,
+            )
+            run("bench", lambda: write_bench(model, directory), num_neurons)
+            if args.simulate:
+                run(
+                    "verilator_build",
+                    lambda: model.verilog_inference(directory, "neuralut.v", logfile=None),
+                    num_neurons,
+                    repeat=1,
+                )
+                num_samples = min(args.samples, args.simulation_samples)
+                run("simulation", lambda: model(x[:num_samples].cpu()), num_samples)
+    finally:
+        instrumentation.close()
+    return {"params": params, "truth_table_entries": num_entries, "stages": stages}
+
+
+def config_name(params):
+    return "-".join(f"{k}{v}" for k, v in params.items())
+
+
+# The metrics of a stage compared against a previous run, with their units
+COMPARED_METRICS = [("wall_time_s", "s"), ("peak_rss_mb", "MiB")]
+
+
+# The peak RSS of a stage, including its child processes
+def stage_metric(stage, metric):
+    if metric == "peak_rss_mb":
+        return stage["peak_rss_mb"] + stage.get("child_peak_rss_mb", 0.0)
+    return stage[metric]
+
+
+# Compare the wall time and peak RSS of every stage against a previous run,
+# returns the (config, stage, metric, ratio) of those larger than 1 + tolerance
+def compare(results, baseline, tolerance):
+    baseline_configs = {config_name(r["params"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"{'config':<40}{'stage':<16}{'metric':<14}{'baseline':>14}{'current':>14}{'ratio':>7}")
+    for r in results:
+        name = config_name(r["params"])
+        if name not in baseline_configs:
+            continue
+        for stage, current in r["stages"].items():
+            previous = baseline_configs[name]["stages"].get(stage)
+            if previous is None:
+                continue
+            for metric, unit in COMPARED_METRICS:
+                # The peak RSS of runs before it was sampled per stage is not comparable
+                if metric == "peak_rss_mb" and "rss_growth_mb" not in previous:
+                    continue
+                before, after = stage_metric(previous, metric), stage_metric(current, metric)
+                ratio = after / max(before, 1e-9)
+                flag = " *" if ratio > 1 + tolerance else ""
+                print(
+                    f"{name:<40}{stage:<16}{metric:<14}{before:>10.4f} {unit:<3}"
+                    f"{after:>10.4f} {unit:<3}{ratio:>6.2f}x{flag}"
+                )
+                if ratio > 1 + tolerance:
+                    regressions.append((name, stage, metric, ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Benchmark the stages of the NeuraLUT conversion on synthetic models"
+    )
+    parser.add_argument("--fanins", nargs="+", type=int, default=[2, 3])
+    parser.add_argument("--bitwidths", nargs="+", type=int, default=[2, 3])
+    parser.add_argument("--width-ns", nargs="+", type=int, default=[16])
+    parser.add_argument(
+        "--out-features",
+        nargs="+",
+        type=int,
+        default=[32, 64],
+        help="Neurons per hidden layer (default: %(default)s)",
+    )
+    parser.add_argument("--num-layers", type=int, default=2)
+    parser.add_argument("--input-length", type=int, default=16)
+    parser.add_argument("--output-length", type=int, default=5)
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=1024,
+        help="Random inputs used for LUT inference (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--simulate",
+        action="store_true",
+        default=False,
+        help="Also build and time the Verilator simulation, requires pyverilator (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--simulation-samples",
+        type=int,
+        default=128,
+        help="Inputs simulated with Verilator (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Runs of each stage, the fastest is reported (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        default=None,
+        help="Where the temporary Verilog / BENCH files are written (default: the system temporary directory)",
+    )
+    parser.add_argument("--save", type=str, default=None, help="Store the results in this JSON file")
+    parser.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        help="Compare the results against a JSON file from a previous run, exits with 1 on regressions",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative increase of the wall time or peak RSS of a stage which is reported as a regression (default: %(default)s)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cuda", action="store_true", default=False)
+    args = parser.parse_args()
+
+    results = []
+    for fanin, bitwidth, width_n, out_features in itertools.product(
+        args.fanins, args.bitwidths, args.width_ns, args.out_features
+    ):
+        params = {
+            "fanin": fanin,
+            "bitwidth": bitwidth,
+            "width_n": width_n,
+            "out_features": out_features,
+        }
+        print(f"Benchmarking {config_name(params)}...")
+        r = benchmark_config(params, args)
+        for stage in STAGES:
+            if stage in r["stages"]:
+                s = r["stages"][stage]
+                print(
+                    f"  {stage:<14}{s['wall_time_s']:>10.4f} s{s['throughput']:>14.1f} items/s"
+                    f"{s['peak_rss_mb']:>10.1f} MiB peak RSS"
+                    f"{s['rss_growth_mb']:>10.1f} MiB growth"
+                )
+                if s["child_peak_rss_mb"]:
+                    print(f"  {'':<14}{s['child_peak_rss_mb']:>10.1f} MiB peak RSS of child processes")
+        results.append(r)
+
+    if args.save is not None:
+        report = {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "args": vars(args),
+            "results": results,
+        }
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results stored at: {args.save}")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stage metric(s) above the baseline by more than {100*args.tolerance:.0f}%")
+            sys.exit(1)
@@ -13,6 +13,11 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import hashlib
+import json
+import os
+import shutil
+
 import h5py
 import yaml
 import numpy as np
@@ -20,78 +25,474 @@ import pandas as pd
 from sklearn.model_selection import train_test_split
 from sklearn import preprocessing
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, Subset
 
 
-# Based off example from: https://github.com/hls-fpga-machine-learning/pytorch-training/blob/master/train/Data_loader.py
-# Creates a PyTorch Dataset from the h5 file input.
-# Returns labels as a one-hot encoded vector.
-# Input / output labels are contained in self.feature_labels / self.output_labels respectively
-class JetSubstructureDataset(Dataset):
+# Feed the contents of a file into a hashlib digest, one chunk at a time
+def _update_digest(digest, path, chunk_size=1 << 20):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
 
-    def __init__(self, input_file, config_file, split="train"):
-        super().__init__()
 
-        self.split = split
+# The sha256 of the contents of a file. Hashing the raw h5 file reads all of
+# it, so the digests are remembered in index_path by path, size and mtime, and
+# a file is only hashed again once one of those changes.
+def _file_digest(path, index_path=None):
+    stat = os.stat(path)
+    name = os.path.abspath(path)
+    index = {}
+    if index_path is not None and os.path.exists(index_path):
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+    entry = index.get(name)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["sha256"]
+    digest = hashlib.sha256()
+    _update_digest(digest, path)
+    if index_path is not None:
+        index[name] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": digest.hexdigest(),
+        }
+        tmp_path = f"{index_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, index_path)
+    return digest.hexdigest()
+
+
+# The cache key covers both the raw h5 file and the YAML config, so editing
+# either one (e.g., toggling PCA) results in a fresh set of processed splits.
+# With a cache_dir, the digest of the h5 file is only recomputed when its path,
+# size or mtime changed, see _file_digest().
+def dataset_cache_key(input_file, config_file, cache_dir=None):
+    index_path = os.path.join(cache_dir, "digests.json") if cache_dir else None
+    digest = hashlib.sha256()
+    digest.update(_file_digest(input_file, index_path).encode())
+    _update_digest(digest, config_file)
+    return digest.hexdigest()[:16]
 
-        with h5py.File(input_file, 'r') as h5py_file:
-            tree_array = h5py_file["t_allpar_new"][()]
-
-        with open(config_file, 'r') as f:
-            self.config = yaml.safe_load(f)
-
-        # TODO: Add warnings about unused dictionary entries
-        self.feature_labels = self.config["Inputs"]
-        self.output_labels = self.config["Labels"]
-
-        # Filter input file and convert inputs / outputs to numpy array
-        dataset_df = pd.DataFrame(
-            tree_array,
-            columns=list(set(self.feature_labels + self.output_labels)))
-        dataset_df = dataset_df.drop_duplicates()
-        features_df = dataset_df[self.feature_labels]
-        outputs_df = dataset_df[self.output_labels]
-        X = features_df.values
-        y = outputs_df.values
-        if "j_index" in self.feature_labels:
-            X = X[:, :-1]  # drop the j_index feature
-        if "j_index" in self.output_labels:
-            # drop the j_index label
-            y = y[:, :-1]
-            self.output_labels = self.output_labels[:-1]
-        X_train_val, X_test, y_train_val, y_test = train_test_split(
-            X, y, test_size=0.2, random_state=42
-        )  # Using the same dataset split as: https://github.com/hls-fpga-machine-learning/pytorch-training/blob/master/train/Data_loader.py
-        if self.config["NormalizeInputs"]:
-            scaler = preprocessing.StandardScaler().fit(X_train_val)
-            # scaler = preprocessing.MinMaxScaler().fit(X_train_val)
-            X_train_val = scaler.transform(X_train_val)
-            X_test = scaler.transform(X_test)
-
-        if self.config["ApplyPca"]:
+
+# The input normalization and PCA projection fitted on the training split.
+# Either step is None when disabled in the dataset config. train.py saves this
+# next to its checkpoints, so that inference jobs can apply the exact same
+# preprocessing to new data without refitting it (or having the training data).
+class JetSubstructurePreprocessing:
+
+    def __init__(self, mean=None, scale=None, components=None):
+        self.mean = mean
+        self.scale = scale
+        self.components = components
+        self._affine = None
+
+    @classmethod
+    def fit(cls, X, config):
+        mean, scale, components = None, None, None
+        if config["NormalizeInputs"]:
+            scaler = preprocessing.StandardScaler().fit(X)
+            # scaler = preprocessing.MinMaxScaler().fit(X)
+            mean, scale = scaler.mean_, scaler.scale_
+            X = scaler.transform(X)
+        if config["ApplyPca"]:
             # Apply dimenionality reduction to the inputs
             with torch.no_grad():
-                dim = self.config["PcaDimensions"]
-                X_train_val_fp64 = torch.from_numpy(X_train_val).double()
-                X_test_fp64 = torch.from_numpy(X_test).double()
-                U, S, V = torch.svd(X_train_val_fp64)
-                X_train_val_pca_fp64 = torch.mm(X_train_val_fp64, V[:, 0:dim])
-                X_test_pca_fp64 = torch.mm(X_test_fp64, V[:, 0:dim])
+                dim = config["PcaDimensions"]
+                U, S, V = torch.svd(torch.from_numpy(X).double())
+                components = V[:, 0:dim].numpy()
                 variance_retained = 100 * (S[0:dim].sum() / S.sum())
                 print(f"Dimensions used for PCA: {dim}")
                 print(f"Variance retained (%): {variance_retained}")
-                X_train_val = X_train_val_pca_fp64.float().numpy()
-                X_test = X_test_pca_fp64.float().numpy()
+        return cls(mean, scale, components)
+
+    # Matches StandardScaler.transform() followed by the fp64 PCA projection,
+    # this is what the (cached) dataset splits are built with
+    def transform(self, X):
+        if self.mean is not None:
+            dtype = X.dtype if X.dtype in (np.float64, np.float32, np.float16) else np.float64
+            X = np.array(X, dtype=dtype, copy=True)
+            X -= self.mean
+            X /= self.scale
+        if self.components is not None:
+            with torch.no_grad():
+                X = torch.mm(
+                    torch.from_numpy(X).double(), torch.from_numpy(self.components)
+                ).float().numpy()
+        return X
+
+    # Fold the normalization and the PCA projection into a single affine map:
+    # ((x - mean) / scale) @ C == x @ (C / scale[:, None]) - (mean / scale) @ C
+    def affine(self, num_features):
+        if self._affine is None:
+            weight = np.eye(num_features)
+            bias = np.zeros(num_features)
+            if self.mean is not None:
+                weight = weight / self.scale[:, None]
+                bias = -self.mean / self.scale
+            if self.components is not None:
+                weight = weight @ self.components
+                bias = bias @ self.components
+            self._affine = (torch.from_numpy(weight), torch.from_numpy(bias))
+        return self._affine
+
+    # Fast path for new batches (e.g., streamed jets): one fp64 matrix multiply
+    # per batch. Agrees with transform() up to floating point rounding.
+    def apply(self, X):
+        X = torch.as_tensor(X)
+        weight, bias = self.affine(X.shape[1])
+        with torch.no_grad():
+            return torch.addmm(bias, X.double(), weight).float()
+
+    def arrays(self):
+        arrays = {}
+        for name in ("mean", "scale", "components"):
+            if getattr(self, name) is not None:
+                arrays[name] = getattr(self, name)
+        return arrays
+
+    def digest(self):
+        digest = hashlib.sha256()
+        for name, array in self.arrays().items():
+            digest.update(name.encode())
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()[:16]
+
+    def equals(self, other):
+        arrays, other_arrays = self.arrays(), other.arrays()
+        return arrays.keys() == other_arrays.keys() and all(
+            np.array_equal(arrays[name], other_arrays[name]) for name in arrays
+        )
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, **self.arrays())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(
+                *(arrays[name] if name in arrays.files else None
+                  for name in ("mean", "scale", "components"))
+            )
+
+
+# Select the input / output columns from a structured array read from the h5 file
+def _select_columns(tree_array, feature_labels, output_labels):
+    X = np.stack([tree_array[label] for label in feature_labels], axis=1)
+    y = np.stack([tree_array[label] for label in output_labels], axis=1)
+    if "j_index" in feature_labels:
+        X = X[:, :-1]  # drop the j_index feature
+    if "j_index" in output_labels:
+        y = y[:, :-1]  # drop the j_index label
+    return X, y
+
+
+# Read the h5 file, filter it, split it and apply the normalization / PCA
+# described in the config. Returns the processed arrays for each split, along
+# with the preprocessing fitted on the training split. If input_preprocessing
+# is given it is applied as-is, rather than refitted.
+def preprocess_jet_substructure(input_file, config, input_preprocessing=None):
+    feature_labels = config["Inputs"]
+    output_labels = config["Labels"]
+
+    with h5py.File(input_file, 'r') as h5py_file:
+        tree_array = h5py_file["t_allpar_new"][()]
+
+    # Filter input file and convert inputs / outputs to numpy array
+    dataset_df = pd.DataFrame(
+        tree_array,
+        columns=list(set(feature_labels + output_labels)))
+    dataset_df = dataset_df.drop_duplicates()
+    features_df = dataset_df[feature_labels]
+    outputs_df = dataset_df[output_labels]
+    X = features_df.values
+    y = outputs_df.values
+    if "j_index" in feature_labels:
+        X = X[:, :-1]  # drop the j_index feature
+    if "j_index" in output_labels:
+        y = y[:, :-1]  # drop the j_index label
+    X_train_val, X_test, y_train_val, y_test = train_test_split(
+        X, y, test_size=0.2, random_state=42
+    )  # Using the same dataset split as: https://github.com/hls-fpga-machine-learning/pytorch-training/blob/master/train/Data_loader.py
+    if input_preprocessing is None:
+        input_preprocessing = JetSubstructurePreprocessing.fit(X_train_val, config)
+    X_train_val = input_preprocessing.transform(X_train_val)
+    X_test = input_preprocessing.transform(X_test)
+
+    splits = {
+        "train": (X_train_val, y_train_val),
+        "test": (X_test, y_test),
+    }
+    return splits, input_preprocessing
+
+
+_CACHE_FILES = [
+    "train_X.npy",
+    "train_y.npy",
+    "test_X.npy",
+    "test_y.npy",
+    "preprocessing.npz",
+]
+
+
+# Accept either a JetSubstructurePreprocessing or the path to a saved one
+def _as_preprocessing(input_preprocessing):
+    if isinstance(input_preprocessing, str):
+        return JetSubstructurePreprocessing.load(input_preprocessing)
+    return input_preprocessing
+
 
-        if self.split == "train":
-            self.X = torch.from_numpy(X_train_val)
-            self.y = torch.from_numpy(y_train_val)
-        elif self.split == "test":
-            self.X = torch.from_numpy(X_test)
-            self.y = torch.from_numpy(y_test)
+# Preprocess the h5 file into cache_path, unless it is already there. The
+# files are written to a temporary directory first, so that an interrupted run
+# (or a concurrent one) never leaves a partially written cache behind.
+def _materialize_splits(cache_path, input_file, config, input_preprocessing=None):
+    if all(os.path.exists(os.path.join(cache_path, f)) for f in _CACHE_FILES):
+        return
+    shutil.rmtree(cache_path, ignore_errors=True)  # Incomplete or outdated
+    splits, input_preprocessing = preprocess_jet_substructure(
+        input_file, config, input_preprocessing
+    )
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    for split, (X, y) in splits.items():
+        np.save(os.path.join(tmp_path, f"{split}_X.npy"), np.ascontiguousarray(X))
+        np.save(os.path.join(tmp_path, f"{split}_y.npy"), np.ascontiguousarray(y))
+    input_preprocessing.save(os.path.join(tmp_path, "preprocessing.npz"))
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # Another process populated the cache in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    print(f"Cached processed dataset in {cache_path}")
+
+
+# Return the processed splits and the fitted preprocessing, either by
+# preprocessing the h5 file or, if a cache directory is given, by memory mapping
+# a previously materialized copy. The arrays are mapped copy-on-write, so the
+# data is only paged in as needed and the mapped files are never modified.
+# The cache is keyed by the raw inputs only and holds the splits built with the
+# fitted preprocessing. A given input_preprocessing which equals the fitted one
+# (e.g., the artifact saved by train.py) reuses them; a different one gets its
+# own copy of the splits, next to them.
+def load_processed_splits(
+    input_file, config_file, config, cache_dir=None, input_preprocessing=None
+):
+    if not cache_dir:
+        return preprocess_jet_substructure(input_file, config, input_preprocessing)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(
+        cache_dir, "jsc-" + dataset_cache_key(input_file, config_file, cache_dir)
+    )
+    _materialize_splits(cache_path, input_file, config)
+    fitted = JetSubstructurePreprocessing.load(
+        os.path.join(cache_path, "preprocessing.npz")
+    )
+    if input_preprocessing is not None and not input_preprocessing.equals(fitted):
+        cache_path = f"{cache_path}-{input_preprocessing.digest()}"
+        _materialize_splits(cache_path, input_file, config, input_preprocessing)
+
+    splits = {}
+    for split in ("train", "test"):
+        X = np.load(os.path.join(cache_path, f"{split}_X.npy"), mmap_mode="c")
+        y = np.load(os.path.join(cache_path, f"{split}_y.npy"), mmap_mode="c")
+        splits[split] = (X, y)
+    input_preprocessing = JetSubstructurePreprocessing.load(
+        os.path.join(cache_path, "preprocessing.npz")
+    )
+    return splits, input_preprocessing
+
+
+# Load the YAML dataset configuration, returning the config along with the
+# input / output labels which end up in the processed arrays
+def load_dataset_config(config_file):
+    with open(config_file, 'r') as f:
+        config = yaml.safe_load(f)
+    # TODO: Add warnings about unused dictionary entries
+    feature_labels = config["Inputs"]
+    output_labels = config["Labels"]
+    if "j_index" in output_labels:
+        output_labels = output_labels[:-1]
+    return config, feature_labels, output_labels
+
+
+# A view of one split of the processed jet substructure data.
+# Several splits can share the same underlying X / y tensors.
+class JetSubstructureSplit(Dataset):
+
+    def __init__(
+        self, X, y, config, feature_labels, output_labels, split, preprocessing=None
+    ):
+        super().__init__()
+        self.X = X
+        self.y = y
+        self.config = config
+        self.feature_labels = feature_labels
+        self.output_labels = output_labels
+        self.split = split
+        self.preprocessing = preprocessing
 
     def __len__(self):
         return len(self.X)
 
     def __getitem__(self, idx):
         return (self.X[idx], self.y[idx])
+
+
+# Based off example from: https://github.com/hls-fpga-machine-learning/pytorch-training/blob/master/train/Data_loader.py
+# Creates a PyTorch Dataset from the h5 file input.
+# Returns labels as a one-hot encoded vector.
+# Input / output labels are contained in self.feature_labels / self.output_labels respectively
+# If cache_dir is specified, the processed splits are stored there on first use
+# and memory mapped from disk on subsequent instantiations.
+# Use load_jet_substructure_splits() when more than one split is required.
+# Pass a saved preprocessing artifact (or its path) as 'preprocessing' to
+# apply it instead of fitting the normalization / PCA again.
+class JetSubstructureDataset(JetSubstructureSplit):
+
+    def __init__(
+        self, input_file, config_file, split="train", cache_dir=None, preprocessing=None
+    ):
+        config, feature_labels, output_labels = load_dataset_config(config_file)
+        splits, input_preprocessing = load_processed_splits(
+            input_file,
+            config_file,
+            config,
+            cache_dir=cache_dir,
+            input_preprocessing=_as_preprocessing(preprocessing),
+        )
+        X, y = splits[split]
+        super().__init__(
+            torch.from_numpy(X),
+            torch.from_numpy(y),
+            config,
+            feature_labels,
+            output_labels,
+            split,
+            preprocessing=input_preprocessing,
+        )
+
+
+# Parse the dataset once and return the "train", "valid" and "test" splits.
+# This dataset is so small that the training set doubles as the validation set,
+# so "train" and "valid" are views of the same tensors rather than two copies.
+def load_jet_substructure_splits(
+    input_file, config_file, cache_dir=None, preprocessing=None
+):
+    config, feature_labels, output_labels = load_dataset_config(config_file)
+    splits, input_preprocessing = load_processed_splits(
+        input_file,
+        config_file,
+        config,
+        cache_dir=cache_dir,
+        input_preprocessing=_as_preprocessing(preprocessing),
+    )
+    X_train, y_train = map(torch.from_numpy, splits["train"])
+    X_test, y_test = map(torch.from_numpy, splits["test"])
+    labels = (config, feature_labels, output_labels)
+    return {
+        "train": JetSubstructureSplit(
+            X_train, y_train, *labels, "train", preprocessing=input_preprocessing
+        ),
+        "valid": JetSubstructureSplit(
+            X_train, y_train, *labels, "valid", preprocessing=input_preprocessing
+        ),
+        "test": JetSubstructureSplit(
+            X_test, y_test, *labels, "test", preprocessing=input_preprocessing
+        ),
+    }
+
+
+# Partition a split into num_folds (train, valid) pairs for cross-validation.
+# The processed data is already shuffled by train_test_split, so each
+# validation fold is a contiguous slice of the parent tensors and the
+# corresponding training fold indexes into them, neither copies any data.
+def kfold_splits(dataset, num_folds):
+    if num_folds < 2:
+        raise ValueError(f"num_folds must be at least 2, {num_folds} specified")
+    num_samples = len(dataset)
+    folds = []
+    for k in range(num_folds):
+        start = (k * num_samples) // num_folds
+        end = ((k + 1) * num_samples) // num_folds
+        valid = JetSubstructureSplit(
+            dataset.X[start:end],
+            dataset.y[start:end],
+            dataset.config,
+            dataset.feature_labels,
+            dataset.output_labels,
+            f"{dataset.split}_fold{k}_valid",
+            preprocessing=dataset.preprocessing,
+        )
+        train = Subset(
+            dataset,
+            torch.cat((torch.arange(0, start), torch.arange(end, num_samples))),
+        )
+        folds.append((train, valid))
+    return folds
+
+
+# Evaluate on h5 files which are too large to be loaded into memory at once.
+# Jets are read chunk_size rows at a time, normalized with the given (previously
+# fitted) preprocessing, or the path to one, and yielded in batches, so memory
+# use is bounded by the chunk size regardless of the file size. Unlike
+# JetSubstructureDataset, the whole file (or the rows in [start, stop)) is used
+# without deduplication or a train / test split. Can be iterated over directly
+# in place of a data loader.
+class JetSubstructureStream(IterableDataset):
+
+    def __init__(
+        self,
+        input_file,
+        config_file,
+        preprocessing,
+        batch_size=1024,
+        chunk_size=1 << 20,
+        start=0,
+        stop=None,
+    ):
+        super().__init__()
+        self.input_file = input_file
+        self.config, self.feature_labels, self.output_labels = load_dataset_config(
+            config_file
+        )
+        self.preprocessing = _as_preprocessing(preprocessing)
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.start = start
+        self.stop = stop
+
+    @property
+    def num_inputs(self):
+        if self.preprocessing.components is not None:
+            return self.preprocessing.components.shape[1]
+        return len(self.feature_labels) - int("j_index" in self.feature_labels)
+
+    @property
+    def num_outputs(self):
+        return len(self.output_labels)
+
+    def _row_range(self, tree):
+        stop = len(tree) if self.stop is None else min(self.stop, len(tree))
+        return self.start, stop
+
+    def __len__(self):
+        with h5py.File(self.input_file, 'r') as h5py_file:
+            start, stop = self._row_range(h5py_file["t_allpar_new"])
+        return max(stop - start, 0)
+
+    def __iter__(self):
+        with h5py.File(self.input_file, 'r') as h5py_file:
+            tree = h5py_file["t_allpar_new"]
+            start, stop = self._row_range(tree)
+            for chunk_start in range(start, stop, self.chunk_size):
+                chunk = tree[chunk_start : min(chunk_start + self.chunk_size, stop)]
+                X, y = _select_columns(chunk, self.feature_labels, self.config["Labels"])
+                X = self.preprocessing.apply(X)
+                y = torch.from_numpy(y)
+                for b in range(0, len(X), self.batch_size):
+                    yield X[b : b + self.batch_size], y[b : b + self.batch_size]
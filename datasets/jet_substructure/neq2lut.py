@@ -18,259 +18,115 @@
 #  limitations under the License.
 
 import os
-from argparse import ArgumentParser
 
-import torch
-import random
-import numpy as np
-from torch.utils.data import DataLoader
+from neuralut.convert import DatasetAdapter, main
+from neuralut.data import TensorBatchLoader
 
-from neuralut.nn import (
-    generate_truth_tables,
-    lut_inference,
-    module_list_to_verilog_module,
+from train import configs, test
+from dataset import (
+    JetSubstructureDataset,
+    JetSubstructurePreprocessing,
+    JetSubstructureStream,
 )
-
-from train import configs, model_config, dataset_config, test
-from dataset import JetSubstructureDataset
 from models import JetSubstructureNeqModel, JetSubstructureLutModel
-from neuralut.synthesis import synthesize_and_get_resource_counts
-
-other_options = {
-    "seed": 3,
-    "cuda": None,
-    "device": 1,
-    "log_dir": None,
-    "checkpoint": None,
-    "add_registers": False,
-}
-
-if __name__ == "__main__":
-    parser = ArgumentParser(
-        description="Synthesize convert a PyTorch trained model into verilog"
-    )
-    parser.add_argument(
-        "--arch",
-        type=str,
-        choices=configs.keys(),
-        default="jsc-s",
-        help="Specific the neural network model to use (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--batch-size",
-        type=int,
-        default=None,
-        metavar="N",
-        help="Batch size for evaluation (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--input-bitwidth",
-        type=int,
-        default=None,
-        help="Bitwidth to use at the input (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--hidden-bitwidth",
-        type=int,
-        default=None,
-        help="Bitwidth to use for activations in hidden layers (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--output-bitwidth",
-        type=int,
-        default=None,
-        help="Bitwidth to use at the output (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--input-fanin",
-        type=int,
-        default=None,
-        help="Fanin to use at the input (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--hidden-fanin",
-        type=int,
-        default=None,
-        help="Fanin to use for the hidden layers (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--output-fanin",
-        type=int,
-        default=None,
-        help="Fanin to use at the output (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--hidden-layers",
-        nargs="+",
-        type=int,
-        default=None,
-        help="A list of hidden layer neuron sizes (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--width_n",
-        type=int,
-        default=None,
-        metavar="",
-        help="Width of sub-network(N) (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--dataset-file",
-        type=str,
-        default="data/processed-pythia82-lhc13-all-pt1-50k-r1_h022_e0175_t220_nonu_truth.z",
-        help="The file to use as the dataset input (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--clock-period",
-        type=float,
-        default=1.0,
-        help="Target clock frequency to use during Vivado synthesis (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--dataset-config",
-        type=str,
-        default="config/yaml_IP_OP_config.yml",
-        help="The file to use to configure the input dataset (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--dataset-split",
-        type=str,
-        default="test",
-        choices=["train", "test"],
-        help="Dataset to use for evaluation (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--log-dir",
-        type=str,
-        default="0",
-        help="A location to store the log output of the training run and the output model (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--seed",
-        type=int,
-        required=True,
-        help="Seed to use for RNG (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--device",
-        type=int,
-        required=True,
-        help="Device_id for GPU (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--checkpoint",
-        type=str,
-        required=True,
-        help="The checkpoint file which contains the model weights",
-    )
-    parser.add_argument(
-        "--add-registers",
-        action="store_true",
-        default=False,
-        help="Add registers between each layer in generated verilog (default: %(default)s)",
-    )
-    parser.add_argument(
-        "--cuda",
-        action="store_true",
-        default=False,
-        help="Train on a GPU (default: %(default)s)",
-    )
-    args = parser.parse_args()
-    defaults = configs[args.arch]
-    options = vars(args)
-    del options["arch"]
-    config = {}
-    for k in options.keys():
-        config[k] = (
-            options[k] if options[k] is not None else defaults[k]
-        )  # Override defaults, if specified.
-
-    if not os.path.exists(config["log_dir"]):
-        os.makedirs(config["log_dir"])
-    
-    # Split up configuration options to be more understandable
-    model_cfg = {}
-    for k in model_config.keys():
-        model_cfg[k] = config[k]
-    dataset_cfg = {}
-    for k in dataset_config.keys():
-        dataset_cfg[k] = config[k]
-    options_cfg = {}
-    for k in other_options.keys():
-        options_cfg[k] = config[k]
-    model_cfg["cuda"] = options_cfg["cuda"]
-    # Set random seeds
-    random.seed(config["seed"])
-    np.random.seed(config["seed"])
-    torch.manual_seed(config["seed"])
-    os.environ["PYTHONHASHSEED"] = str(config["seed"])
-
-    if options_cfg["cuda"]:
-        torch.cuda.manual_seed_all(config["seed"])
-        torch.backends.cudnn.deterministic = True
-        torch.cuda.set_device(options_cfg["device"])
-
-    # Fetch the test set
-    dataset = {}
-    dataset[args.dataset_split] = JetSubstructureDataset(
-        dataset_cfg["dataset_file"],
-        dataset_cfg["dataset_config"],
-        split=args.dataset_split,
-    )
-    test_loader = DataLoader(
-        dataset[args.dataset_split], batch_size=config["batch_size"], shuffle=False
-    )
 
-    # Instantiate the PyTorch model
-    x, y = dataset[args.dataset_split][0]
-    model_cfg["input_length"] = len(x)
-    model_cfg["output_length"] = len(y)
-    model = JetSubstructureNeqModel(model_cfg)
-    if options_cfg["cuda"]:
-        model.cuda()
 
-    # Load the model weights
-    checkpoint = torch.load(options_cfg["checkpoint"], map_location="cuda:{}".format(options_cfg["device"]) if options_cfg["cuda"] else "cpu")
-    model.load_state_dict(checkpoint["model_dict"])
+# The jet substructure specific parts of the conversion, see neuralut.convert
+class JetSubstructureAdapter(DatasetAdapter):
+    configs = configs
+    default_arch = "jsc-2l"
+    default_dataset_cache = "data/cache"
+    neq_model_class = JetSubstructureNeqModel
+    lut_model_class = JetSubstructureLutModel
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dataset-file",
+            type=str,
+            default="data/processed-pythia82-lhc13-all-pt1-50k-r1_h022_e0175_t220_nonu_truth.z",
+            help="The file to use as the dataset input (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--dataset-config",
+            type=str,
+            default="config/yaml_IP_OP_config.yml",
+            help="The file to use to configure the input dataset (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--stream-file",
+            type=str,
+            default=None,
+            help="Evaluate on this h5 file, streamed in chunks, instead of the dataset split (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--stream-chunk-size",
+            type=int,
+            default=1 << 20,
+            help="Number of jets read from the streamed h5 file at a time (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--preprocessing",
+            type=str,
+            default=None,
+            help="A saved preprocessing artifact to apply to the input data, defaults to the preprocessing.npz saved next to the checkpoint, if present (default: %(default)s)",
+        )
+
+    def load_test_set(self, config, model_cfg):
+        # Reuse the preprocessing saved next to the checkpoint by train.py, if any,
+        # rather than refitting it on the training split
+        self.preprocessing_file = config["preprocessing"]
+        if self.preprocessing_file is None:
+            saved_preprocessing = os.path.join(
+                os.path.dirname(config["checkpoint"]), "preprocessing.npz"
+            )
+            if os.path.exists(saved_preprocessing):
+                self.preprocessing_file = saved_preprocessing
+        input_preprocessing = None
+        if self.preprocessing_file is not None:
+            print(f"Using preprocessing from {self.preprocessing_file}")
+            input_preprocessing = JetSubstructurePreprocessing.load(self.preprocessing_file)
+
+        if config["stream_file"] is not None:
+            if input_preprocessing is None:
+                raise Exception(
+                    "Streaming requires a preprocessing artifact, specify --preprocessing"
+                )
+            test_loader = JetSubstructureStream(
+                config["stream_file"],
+                config["dataset_config"],
+                input_preprocessing,
+                batch_size=config["batch_size"],
+                chunk_size=config["stream_chunk_size"],
+            )
+            model_cfg["input_length"] = test_loader.num_inputs
+            model_cfg["output_length"] = test_loader.num_outputs
+        else:
+            dataset = JetSubstructureDataset(
+                config["dataset_file"],
+                config["dataset_config"],
+                split=config["dataset_split"],
+                cache_dir=config["dataset_cache"],
+                preprocessing=input_preprocessing,
+            )
+            test_loader = TensorBatchLoader(
+                dataset, batch_size=config["batch_size"], shuffle=False
+            )
+            x, y = dataset[0]
+            model_cfg["input_length"] = len(x)
+            model_cfg["output_length"] = len(y)
+        return test_loader
+
+    def evaluation_params(self, config):
+        return {
+            "dataset_file": config["dataset_file"],
+            "dataset_split": config["dataset_split"],
+            "stream_file": config["stream_file"],
+            "preprocessing": self.preprocessing_file,
+        }
+
+    def test(self, model, loader, cuda):
+        return test(model, loader, cuda=cuda)
 
-    # Test the PyTorch model
-    print("Running inference on baseline model...")
-    baseline_accuracy = test(model, test_loader, cuda=options_cfg["cuda"])
-    print("Baseline accuracy: %f" % (baseline_accuracy))
 
-    lut_model = JetSubstructureLutModel(model_cfg)
-    if options_cfg["cuda"]:
-        lut_model.cuda()
-    lut_model.load_state_dict(checkpoint['model_dict'])
-
-    # Generate the truth tables in the LUT module
-    print("Converting to NEQs to LUTs...")
-    generate_truth_tables(lut_model, verbose=True)
-
-    # Test the LUT-based model
-    print("Running inference on LUT-based model...")
-    lut_inference(lut_model)
-    lut_accuracy = test(lut_model, test_loader, cuda=options_cfg["cuda"])
-    print("LUT-Based Model accuracy: %f" % (lut_accuracy))
-    modelSave = {"model_dict": lut_model.state_dict(), "test_accuracy": lut_accuracy}
-
-    torch.save(modelSave, options_cfg["log_dir"] + "/lut_based_model.pth")
-    print("Generating verilog in %s..." % (options_cfg["log_dir"]))
-    module_list_to_verilog_module(
-        lut_model.module_list,
-        "neuralut",
-        options_cfg["log_dir"],
-        add_registers=options_cfg["add_registers"],
-    )
-    print("Top level entity stored at: %s/neuralut.v ..." % (options_cfg["log_dir"]))
-
-    io_filename = None
-
-    print("Running inference simulation of Verilog-based model...")
-    lut_model.verilog_inference(options_cfg["log_dir"], "neuralut.v", logfile=io_filename, add_registers=options_cfg["add_registers"])
-    print("Testing Verilog-Based Model")
-    verilog_accuracy = test(lut_model, test_loader, cuda=options_cfg["cuda"])
-    print("Verilog-Based Model accuracy: %f" % (verilog_accuracy))
-
-    print("Running out-of-context synthesis")
-    ret = synthesize_and_get_resource_counts(options_cfg["log_dir"], "neuralut", fpga_part='xcvu9p-flgb2104-2-i', clk_period_ns='1.1', post_synthesis=1)
-    print("Max f: " + str(ret))
\ No newline at end of file
+if __name__ == "__main__":
+    main(JetSubstructureAdapter())
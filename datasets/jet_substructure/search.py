@@ -0,0 +1,85 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Search for JSC architectures trading off accuracy and LUTs, e.g.:
+#   python search.py --arch jsc-2l --hidden-layers 32 64 32,32 --hidden-fanins 2 3 \
+#       --hidden-bitwidths 3 4 --max-luts 50000 --epochs 20 --workers 4 --cuda --devices 0 1
+# Each candidate is trained with the options of --arch, apart from those which
+# are searched, and its checkpoints are stored in test_<work-dir>/<candidate>.
+# See neuralut.search for the cost model and the other options.
+
+import os
+import random
+
+import numpy as np
+import torch
+import wandb
+
+from neuralut.data import holdout_split
+from neuralut.search import main
+
+from dataset import load_jet_substructure_splits
+from models import JetSubstructureNeqModel
+from train import configs, connectivity_config, model_config, train, training_config
+
+DATASET_FILE = "data/processed-pythia82-lhc13-all-pt1-50k-r1_h022_e0175_t220_nonu_truth.z"
+DATASET_CONFIG = "config/yaml_IP_OP_config.yml"
+DATASET_CACHE = "data/cache"
+VALID_FRACTION = 0.1
+
+
+# Train one candidate, runs in a worker process
+def train_candidate(candidate):
+    config = candidate["config"]
+    os.makedirs("test_" + candidate["log_dir"], exist_ok=True)
+    random.seed(config["seed"])
+    np.random.seed(config["seed"])
+    torch.manual_seed(config["seed"])
+    if candidate["cuda"]:
+        torch.cuda.manual_seed_all(config["seed"])
+        torch.cuda.set_device(candidate["device"])
+
+    dataset = load_jet_substructure_splits(DATASET_FILE, DATASET_CONFIG, cache_dir=DATASET_CACHE)
+    # The candidates are ranked on a held-out part of the training set, the same
+    # for all of them, so that the test set is not used to select them
+    dataset["train"], dataset["valid"] = holdout_split(dataset["train"], fraction=VALID_FRACTION)
+    model_cfg = {k: config.get(k) for k in list(model_config) + list(connectivity_config)}
+    x, y = dataset["train"][0]
+    model_cfg["input_length"] = len(x)
+    model_cfg["output_length"] = len(y)
+    model_cfg["cuda"] = candidate["cuda"]
+    model = JetSubstructureNeqModel(model_cfg)
+    train_cfg = {k: config.get(k) for k in training_config}
+    train_cfg["monitor"] = "valid"
+    options = {
+        "cuda": candidate["cuda"],
+        "bf16": False,
+        "compile": False,
+        "log_dir": candidate["log_dir"],
+    }
+    # train() logs to wandb, which is not needed for the candidates
+    wandb.init(project="NeuraLUT", mode="disabled")
+    try:
+        return train(model, dataset, train_cfg, options)
+    finally:
+        wandb.finish()
+
+
+if __name__ == "__main__":
+    main(train_candidate, configs, default_arch="jsc-2l", output_length=5)
@@ -0,0 +1,161 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import hashlib
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torchvision import datasets
+
+MNIST_MEAN = 0.1307
+MNIST_STD = 0.3081
+
+
+# Feed the contents of a file into a hashlib digest, one chunk at a time
+def _update_digest(digest, path, chunk_size=1 << 20):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+
+# Save an array such that readers never observe a partially written file
+def _save_array(path, array):
+    tmp_path = f"{path[:-len('.npy')]}.tmp-{os.getpid()}.npy"
+    np.save(tmp_path, np.ascontiguousarray(array))
+    os.replace(tmp_path, path)
+
+
+# Decode the MNIST images and apply the same ToTensor() / Normalize() steps
+# as the original torchvision pipeline, flattening each image to 784 features
+def _decode_mnist(root, train):
+    mnist = datasets.MNIST(root, download=False, train=train)
+    X = mnist.data.reshape(-1, 784).float().div(255)
+    X = X.sub(MNIST_MEAN).div(MNIST_STD)
+    return X.numpy(), mnist.targets.numpy()
+
+
+# The raw files torchvision's MNIST decodes a split from
+def _mnist_source_files(root, train):
+    prefix = "train" if train else "t10k"
+    raw_folder = os.path.join(root, datasets.MNIST.__name__, "raw")
+    return [
+        os.path.join(raw_folder, f"{prefix}-images-idx3-ubyte"),
+        os.path.join(raw_folder, f"{prefix}-labels-idx1-ubyte"),
+    ]
+
+
+# A hash of the raw files of a split and of the normalization, or None if the
+# raw files are not where torchvision keeps them (the split is then not cached)
+def mnist_cache_key(root, train):
+    files = _mnist_source_files(root, train)
+    if not all(os.path.exists(f) for f in files):
+        return None
+    digest = hashlib.sha256()
+    for f in files:
+        _update_digest(digest, f)
+    digest.update(f"{MNIST_MEAN},{MNIST_STD}".encode())
+    return digest.hexdigest()[:16]
+
+
+# MNIST as a pair of tensors: X holds the normalized, flattened images and y the
+# class labels. If cache_dir is specified the decoded split is stored there on
+# first use and memory mapped from disk on subsequent instantiations, keyed by
+# a hash of the raw files and the normalization.
+class MnistDataset(Dataset):
+
+    def __init__(self, root, train=True, cache_dir=None):
+        super().__init__()
+        self.split = "train" if train else "test"
+        key = mnist_cache_key(root, train) if cache_dir else None
+        if key is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            X_path = os.path.join(cache_dir, f"mnist-{self.split}-X-{key}.npy")
+            y_path = os.path.join(cache_dir, f"mnist-{self.split}-y-{key}.npy")
+            if not (os.path.exists(X_path) and os.path.exists(y_path)):
+                X, y = _decode_mnist(root, train)
+                _save_array(X_path, X)
+                _save_array(y_path, y)
+                print(f"Cached decoded MNIST {self.split} split in {cache_dir}")
+            X = np.load(X_path, mmap_mode="c")
+            y = np.load(y_path, mmap_mode="c")
+        else:
+            X, y = _decode_mnist(root, train)
+        self.X = torch.from_numpy(X)
+        self.y = torch.from_numpy(y)
+
+    def __len__(self):
+        return len(self.X)
+
+    def __getitem__(self, idx):
+        return (self.X[idx], self.y[idx])
+
+
+# The integer codes produced by the first layer's input quantizer for every
+# image in 'dataset'. These only depend on the trained model, so they are
+# computed once per checkpoint and can be fed directly into a LUT-based or
+# Verilog-based model in place of the images (see MnistNeqModel.quantized_input).
+# If cache_dir is specified the codes are cached there, keyed by a hash of the
+# checkpoint file.
+class QuantizedMnistDataset(Dataset):
+
+    def __init__(
+        self, dataset, input_quant, checkpoint=None, cache_dir=None, batch_size=1024
+    ):
+        super().__init__()
+        self.split = dataset.split
+        self.y = dataset.y
+        codes_path = None
+        if cache_dir and checkpoint is not None:
+            digest = hashlib.sha256()
+            _update_digest(digest, checkpoint)
+            os.makedirs(cache_dir, exist_ok=True)
+            codes_path = os.path.join(
+                cache_dir,
+                f"mnist-{self.split}-codes-{digest.hexdigest()[:16]}.npy",
+            )
+        if codes_path is not None and os.path.exists(codes_path):
+            codes = np.load(codes_path, mmap_mode="c")
+        else:
+            codes = self.encode(dataset.X, input_quant, batch_size)
+            if codes_path is not None:
+                _save_array(codes_path, codes)
+        self.X = torch.from_numpy(codes).long()
+
+    @staticmethod
+    def encode(X, input_quant, batch_size):
+        device = next(input_quant.parameters()).device
+        training, is_bin_output = input_quant.training, input_quant.is_bin_output
+        input_quant.eval()
+        input_quant.bin_output()
+        codes = []
+        with torch.no_grad():
+            for start in range(0, len(X), batch_size):
+                x = X[start : start + batch_size].to(device)
+                codes.append(input_quant(x).cpu().to(torch.int16))
+        input_quant.train(training)
+        input_quant.is_bin_output = is_bin_output
+        return torch.cat(codes, 0).numpy()
+
+    def __len__(self):
+        return len(self.X)
+
+    def __getitem__(self, idx):
+        return (self.X[idx], self.y[idx])
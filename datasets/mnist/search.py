@@ -0,0 +1,85 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Search for MNIST architectures trading off accuracy and LUTs, e.g.:
+#   python search.py --arch hdr-5l --hidden-layers 256,100,100,100 128,64,64 \
+#       --hidden-fanins 4 6 --max-luts 200000 --epochs 5 --workers 2 --cuda --devices 0 1
+# Each candidate is trained with the options of --arch, apart from those which
+# are searched, and its checkpoints are stored in test_<work-dir>/<candidate>.
+# See neuralut.search for the cost model and the other options.
+
+import os
+import random
+
+import numpy as np
+import torch
+import wandb
+
+from neuralut.data import holdout_split
+from neuralut.search import main
+
+from dataset import MnistDataset
+from models import MnistNeqModel
+from train import configs, connectivity_config, model_config, train, training_config
+
+DATASET_CACHE = "mnist_data/cache"
+VALID_FRACTION = 0.1
+
+
+# Train one candidate, runs in a worker process
+def train_candidate(candidate):
+    config = candidate["config"]
+    os.makedirs("test_" + candidate["log_dir"], exist_ok=True)
+    random.seed(config["seed"])
+    np.random.seed(config["seed"])
+    torch.manual_seed(config["seed"])
+    if candidate["cuda"]:
+        torch.cuda.manual_seed_all(config["seed"])
+        torch.cuda.set_device(candidate["device"])
+
+    dataset = {}
+    # The candidates are ranked on a held-out part of the training set, the same
+    # for all of them, so that the test set is not used to select them
+    dataset["train"], dataset["valid"] = holdout_split(
+        MnistDataset("mnist_data", train=True, cache_dir=DATASET_CACHE), fraction=VALID_FRACTION
+    )
+    dataset["test"] = MnistDataset("mnist_data", train=False, cache_dir=DATASET_CACHE)
+    model_cfg = {k: config.get(k) for k in list(model_config) + list(connectivity_config)}
+    model_cfg["input_length"] = 784
+    model_cfg["output_length"] = 10
+    model_cfg["cuda"] = candidate["cuda"]
+    model = MnistNeqModel(model_cfg)
+    train_cfg = {k: config.get(k) for k in training_config}
+    train_cfg["monitor"] = "valid"
+    options = {
+        "cuda": candidate["cuda"],
+        "bf16": False,
+        "compile": False,
+        "log_dir": candidate["log_dir"],
+    }
+    # train() logs to wandb, which is not needed for the candidates
+    wandb.init(project="NeuraLUT", mode="disabled")
+    try:
+        return train(model, dataset, train_cfg, options)
+    finally:
+        wandb.finish()
+
+
+if __name__ == "__main__":
+    main(train_candidate, configs, default_arch="hdr-5l", output_length=10)
@@ -29,9 +29,29 @@ import random
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
 
-from torchvision import datasets, transforms
+from neuralut.checkpoint import AsyncCheckpointer, EarlyStopping
+from neuralut.data import TensorBatchLoader
+from neuralut.distributed import (
+    all_reduce_sum,
+    cleanup_distributed,
+    convert_distributed_batchnorm,
+    get_rank,
+    get_world_size,
+    init_distributed,
+    is_main_process,
+)
+from neuralut.models import load_layer_lists
+from neuralut.rewire import ConnectivitySearch
+from neuralut.nn import (
+    compare_truth_tables,
+    compile_subnetworks,
+    fanout_report,
+    set_compute_dtype,
+)
+
+from dataset import MnistDataset
 from models import MnistNeqModel
 
 configs = {
@@ -50,6 +70,10 @@ configs = {
         "learning_rate": 0.003,
         "seed": 8971561,
         "checkpoint": None,
+        "connectivity": "random",
+        "max_fanout": None,
+        "neuron_fanins": None,
+        "channel_bitwidths": None,
     },
 }
 
@@ -63,6 +87,16 @@ model_config = {
     "hidden_fanin": None,
     "output_fanin": None,
     "width_n": None,
+    "neuron_fanins": None,
+    "channel_bitwidths": None,
+}
+
+# Options for the connectivity of the FeatureMasks
+connectivity_config = {
+    "connectivity": None,
+    "max_fanout": None,
+    "cover_inputs": None,
+    "group_neurons": None,
 }
 
 training_config = {
@@ -71,59 +105,59 @@ training_config = {
     "epochs": None,
     "learning_rate": None,
     "seed": None,
+    "rewire_interval": None,
+    "rewire_fraction": None,
+    "eval_interval": None,
+    "eval_splits": None,
+    "monitor": None,
+    "keep_best": None,
+    "patience": None,
+    "min_delta": None,
+}
+
+dataset_config = {
+    "dataset_cache": None,
 }
 
 other_options = {
     "cuda": None,
+    "bf16": None,
+    "compile": None,
     "log_dir": None,
     "checkpoint": None,
     "device": 1,
 }
 
 
-def train(model, train_cfg, options):
+def train(model, datasets, train_cfg, options):
+    # When launched with torchrun, each process trains on its own shard of the
+    # training set (batch_size is the global batch size) and evaluates its own
+    # shard of the validation / test sets, see neuralut.distributed
+    rank, world_size = get_rank(), get_world_size()
+    distributed = world_size > 1
+    if train_cfg["batch_size"] % world_size != 0:
+        raise Exception(f"The batch size must be a multiple of the number of processes ({world_size})")
+    if distributed and train_cfg["rewire_interval"]:
+        raise Exception("Rewiring the connectivity is not supported with distributed training")
+    if distributed:
+        # The batch statistics of the BatchNorms (e.g., in the quantizers'
+        # pre-transforms) are computed over the batches of all processes
+        convert_distributed_batchnorm(model)
+    shard = {"rank": rank, "world_size": world_size}
+
     # Create data loaders for training and inference:
-    train_loader = DataLoader(
-        datasets.MNIST(
-            "mnist_data",
-            download=False,
-            train=True,
-            transform=transforms.Compose(
-                [transforms.ToTensor(), transforms.Normalize((0.1307,), (0.3081,))]
-            ),
-        ),
-        batch_size=train_cfg["batch_size"],
+    train_loader = TensorBatchLoader(
+        datasets["train"],
+        batch_size=train_cfg["batch_size"] // world_size,
         shuffle=True,
+        seed=train_cfg["seed"],
+        **shard,
     )
-    val_loader = DataLoader(
-        datasets.MNIST(
-            "mnist_data",
-            download=False,
-            train=True,
-            transform=transforms.Compose(
-                [
-                    transforms.ToTensor(),  # first, convert image to PyTorch tensor
-                    transforms.Normalize((0.1307,), (0.3081,)),  # normalize inputs
-                ]
-            ),
-        ),
-        batch_size=train_cfg["batch_size"],
-        shuffle=False,
-    )
-    test_loader = DataLoader(
-        datasets.MNIST(
-            "mnist_data",
-            download=False,
-            train=False,
-            transform=transforms.Compose(
-                [
-                    transforms.ToTensor(),  # first, convert image to PyTorch tensor
-                    transforms.Normalize((0.1307,), (0.3081,)),  # normalize inputs
-                ]
-            ),
-        ),
-        batch_size=train_cfg["batch_size"],
-        shuffle=False,
+    val_loader = TensorBatchLoader(
+        datasets["valid"], batch_size=train_cfg["batch_size"], shuffle=False, pad_shards=False, **shard
+    )
+    test_loader = TensorBatchLoader(
+        datasets["test"], batch_size=train_cfg["batch_size"], shuffle=False, pad_shards=False, **shard
     )
 
     # Configure optimizer
@@ -165,6 +199,17 @@ def train(model, train_cfg, options):
         optimizer, T_0=steps * 100, T_mult=1
     )
 
+    # Optionally learn the connectivity during the first 75% of the training
+    search = None
+    if train_cfg["rewire_interval"]:
+        search = ConnectivitySearch(
+            model,
+            optimizer,
+            update_interval=train_cfg["rewire_interval"],
+            swap_fraction=train_cfg["rewire_fraction"],
+            end_step=int(0.75 * steps * train_cfg["epochs"]),
+        )
+
     # Configure criterion
     criterion = nn.CrossEntropyLoss()
 
@@ -172,22 +217,62 @@ def train(model, train_cfg, options):
     if options["cuda"]:
         model.cuda()
 
+    # Run the sub-networks in bf16, the quantizers and BatchNorms stay in fp32
+    if options["bf16"]:
+        set_compute_dtype(model, torch.bfloat16)
+
+    # Compile the sub-networks, the quantizers are left in eager mode
+    if options["compile"]:
+        compile_subnetworks(model)
+
+    # The gradients are averaged over all processes, the buffers (e.g., the
+    # running statistics) are already the same in all of them
+    train_model = model
+    if distributed:
+        train_model = DistributedDataParallel(
+            model,
+            device_ids=[options["device"]] if options["cuda"] else None,
+            broadcast_buffers=False,
+        )
+
+
+    # The validation / test splits are evaluated every eval_interval epochs, the
+    # monitored one selects the best checkpoints and stops the training once it
+    # stops improving. Checkpoints are written in a background thread.
+    eval_interval = train_cfg.get("eval_interval") or 1
+    eval_splits = train_cfg.get("eval_splits") or ["valid", "test"]
+    monitor = train_cfg.get("monitor") or "test"
+    if monitor not in eval_splits:
+        raise Exception(f"The monitored split {monitor} must be one of the evaluated splits {eval_splits}")
+    # Only the main process writes checkpoints
+    checkpointer = None
+    if is_main_process():
+        checkpointer = AsyncCheckpointer(
+            "test_" + options["log_dir"], keep_best=train_cfg.get("keep_best") or 1
+        )
+    early_stopping = EarlyStopping(
+        patience=train_cfg.get("patience") or 0,
+        min_delta=train_cfg.get("min_delta") or 0.0,
+    )
 
     # Main training loop
     maxAcc = 0.0
+    maxValAcc = 0.0
     num_epochs = train_cfg["epochs"]
     for epoch in range(0, num_epochs):
         # Train for this epoch
-        model.train()
+        train_loader.set_epoch(epoch)
+        train_model.train()
         accLoss = 0.0
         correct = 0
+        num_samples = 0
         for batch_idx, (data, target) in enumerate(train_loader):
             if options["cuda"]:
                 data, target = data.cuda(), target.cuda()
             optimizer.zero_grad()
             data = data.reshape(-1, 784)
             target = torch.nn.functional.one_hot(target, num_classes=10)
-            output = model(data)
+            output = train_model(data)
             loss = criterion(output, torch.max(target, 1)[1])
             pred = output.detach().max(1, keepdim=True)[1]
             target_label = torch.max(target.detach(), 1, keepdim=True)[1]
@@ -195,40 +280,78 @@ def train(model, train_cfg, options):
             curAcc = 100.0 * curCorrect / len(data)
             correct += curCorrect
             accLoss += loss.detach() * len(data)
+            num_samples += len(data)
             loss.backward()
             optimizer.step()
+            if search is not None:
+                search.step()
             scheduler.step()
 
-        accLoss /= len(train_loader.dataset)
-        accuracy = 100.0 * correct / len(train_loader.dataset)
-        val_accuracy = test(model, val_loader, options["cuda"])
-        test_accuracy = test(model, test_loader, options["cuda"])
-        modelSave = {
-            "model_dict": model.state_dict(),
-            "optim_dict": optimizer.state_dict(),
-            "val_accuracy": val_accuracy,
-            "test_accuracy": test_accuracy,
-            "epoch": epoch,
+        correct, accLoss, num_samples = all_reduce_sum([correct, accLoss, num_samples])
+        accLoss /= num_samples
+        accuracy = 100.0 * correct / num_samples
+        log = {
+            "Train Acc (%)": accuracy,
+            "Train Loss(%)": accLoss,
         }
-        torch.save(modelSave, "test_" + options["log_dir"] + "/checkpoint.pth")
-        if maxAcc < test_accuracy:
-            torch.save(modelSave, "test_" + options["log_dir"] + "/best_accuracy.pth")
-            maxAcc = test_accuracy
-
-        wandb.log(
-            {
-                "Train Acc (%)": accuracy.detach().cpu().numpy(),
-                "Train Loss(%)": accLoss.detach().cpu().numpy(),
-                "Test Acc (%)": test_accuracy,
-                "Valid Acc(%)": val_accuracy,
+
+        # Evaluate every eval_interval epochs, and after the last one
+        if (epoch + 1) % eval_interval == 0 or epoch == num_epochs - 1:
+            val_accuracy = test(model, val_loader, options["cuda"]) if "valid" in eval_splits else None
+            test_accuracy = test(model, test_loader, options["cuda"]) if "test" in eval_splits else None
+            modelSave = {
+                "model_dict": model.state_dict(),
+                "optim_dict": optimizer.state_dict(),
+                "val_accuracy": val_accuracy,
+                "test_accuracy": test_accuracy,
+                "epoch": epoch,
             }
-        )
+            monitored = test_accuracy if monitor == "test" else val_accuracy
+            if checkpointer is not None:
+                checkpointer.save_best(modelSave, monitored, epoch, latest="checkpoint.pth")
+            if test_accuracy is not None:
+                maxAcc = max(maxAcc, test_accuracy)
+                log["Test Acc (%)"] = test_accuracy
+            if val_accuracy is not None:
+                maxValAcc = max(maxValAcc, val_accuracy)
+                log["Valid Acc(%)"] = val_accuracy
+            stop = early_stopping.step(monitored)
+        else:
+            stop = False
 
+        wandb.log(log)
+        if stop:
+            print(
+                f"Stopping at epoch {epoch}, the {monitor} accuracy did not improve for "
+                f"{early_stopping.patience} evaluations (best: {early_stopping.best:.2f}%)"
+            )
+            break
+    if checkpointer is not None:
+        checkpointer.close()
 
+    # Rewiring changed the connectivity reported before the training
+    if search is not None:
+        fanout_report(model, verbose=True)
+
+    # The truth tables are always calculated in fp32, report how many of their
+    # entries differ from the bf16 sub-networks which were trained
+    if options["bf16"]:
+        set_compute_dtype(model, None)
+        for name, (mismatches, entries) in compare_truth_tables(
+            model, torch.bfloat16
+        ).items():
+            print(
+                f"{name}: {mismatches}/{entries} truth table entries differ between fp32 and bf16"
+            )
+    return {"val_accuracy": maxValAcc, "test_accuracy": maxAcc}
+
+
+@torch.no_grad()
 def test(model, dataset_loader, cuda):
     model.eval()
     correct = 0
     accLoss = 0.0
+    num_samples = 0
     for batch_idx, (data, target) in enumerate(dataset_loader):
         if cuda:
             data, target = data.cuda(), target.cuda()
@@ -242,7 +365,10 @@ def test(model, dataset_loader, cuda):
         curCorrect = pred.eq(target_label).long().sum()
         curAcc = 100.0 * curCorrect / len(data)
         correct += curCorrect
-    accuracy = 100 * float(correct) / len(dataset_loader.dataset)
+        num_samples += len(data)
+    # Each process evaluates its own shard of a distributed loader
+    correct, num_samples = all_reduce_sum([correct, num_samples])
+    accuracy = 100 * float(correct) / num_samples
     return accuracy
 
 
@@ -290,6 +416,75 @@ if __name__ == "__main__":
         default=False,
         help="Train on a GPU (default: %(default)s)",
     )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        default=False,
+        help="Compute the sub-networks in bfloat16, the quantizers and BatchNorms stay in fp32 (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        default=False,
+        help="Compile the sub-networks with torch.compile (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rewire_interval",
+        type=int,
+        default=0,
+        metavar="",
+        help="Rewire the connectivity every N training steps, keeping the fan-in fixed, 0 disables it (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rewire_fraction",
+        type=float,
+        default=0.1,
+        metavar="",
+        help="The fraction of neurons of each layer rewired at the first update, it decays to 0 at 75%% of the training (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--eval_interval",
+        type=int,
+        default=1,
+        metavar="",
+        help="Evaluate the model (and write checkpoints) every N epochs (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--eval_splits",
+        nargs="+",
+        type=str,
+        default=["valid", "test"],
+        choices=["valid", "test"],
+        help="The splits evaluated (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--monitor",
+        type=str,
+        default="test",
+        choices=["valid", "test"],
+        help="The split whose accuracy selects the best checkpoints and triggers early stopping (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--keep_best",
+        type=int,
+        default=1,
+        metavar="",
+        help="With N > 1, also keep the N best checkpoints as best_epoch<epoch>.pth, besides best_accuracy.pth (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--patience",
+        type=int,
+        default=0,
+        metavar="",
+        help="Stop once the monitored accuracy did not improve for N evaluations, 0 disables it (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--min_delta",
+        type=float,
+        default=0.0,
+        metavar="",
+        help="The improvement of the monitored accuracy (in %%) which resets the patience (default: %(default)s)",
+    )
     parser.add_argument(
         "--seed",
         type=int,
@@ -346,6 +541,46 @@ if __name__ == "__main__":
         metavar="",
         help="Width of sub-network(N) (default: %(default)s)",
     )
+    parser.add_argument(
+        "--neuron_fanins",
+        type=str,
+        default=None,
+        metavar="",
+        help="A JSON file with a list of per-neuron fan-ins (or null) for each layer (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--channel_bitwidths",
+        type=str,
+        default=None,
+        metavar="",
+        help="A JSON file with a list of the bitwidths of the input channels (or null) for each layer (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--connectivity",
+        type=str,
+        default=None,
+        choices=["random", "local", "balanced"],
+        help="How the inputs of each neuron are sampled: uniformly at random, from a window of nearby inputs, or such that the fanout of all inputs is balanced (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max_fanout",
+        type=int,
+        default=None,
+        metavar="",
+        help="Bound the number of neurons each input is connected to, in every layer (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cover_inputs",
+        action="store_true",
+        default=False,
+        help="Connect every input of a layer to at least one neuron (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--group_neurons",
+        action="store_true",
+        default=False,
+        help="Give neurons which share inputs neighbouring indices, to improve placement locality (default: %(default)s)",
+    )
     parser.add_argument(
         "--hidden_layers",
         nargs="+",
@@ -361,6 +596,13 @@ if __name__ == "__main__":
         metavar="",
         help="A location to store the log output of the training run and the output model (default: %(default)s)",
     )
+    parser.add_argument(
+        "--dataset_cache",
+        type=str,
+        default="mnist_data/cache",
+        metavar="",
+        help="A directory to cache the decoded MNIST splits in, pass an empty string to disable caching (default: %(default)s)",
+    )
     parser.add_argument(
         "--checkpoint",
         type=str,
@@ -376,6 +618,8 @@ if __name__ == "__main__":
         help="Device_id for GPU",
     )
     args = parser.parse_args()
+    # Join the other processes when launched with torchrun
+    init_distributed(backend="gloo")
     defaults = configs[args.arch]
     options = vars(args)
     del options["arch"]
@@ -385,16 +629,21 @@ if __name__ == "__main__":
             options[k] if options[k] is not None else defaults[k]
         )  # Override defaults, if specified.
     
-    if not os.path.exists("test_" + config["log_dir"]):
-        os.makedirs("test_" + config["log_dir"])
+    os.makedirs("test_" + config["log_dir"], exist_ok=True)
 
     # Split up configuration options to be more understandable
     model_cfg = {}
     for k in model_config.keys():
         model_cfg[k] = config[k]
+    for k in connectivity_config.keys():
+        model_cfg[k] = config[k]
+    load_layer_lists(model_cfg)
     train_cfg = {}
     for k in training_config.keys():
         train_cfg[k] = config[k]
+    dataset_cfg = {}
+    for k in dataset_config.keys():
+        dataset_cfg[k] = config[k]
     options_cfg = {}
     for k in other_options.keys():
         options_cfg[k] = config[k]
@@ -409,6 +658,16 @@ if __name__ == "__main__":
         torch.backends.cudnn.deterministic = True
         torch.cuda.set_device(options_cfg["device"])
 
+    # Fetch the datasets
+    dataset = {}
+    dataset["train"] = MnistDataset(
+        "mnist_data", train=True, cache_dir=dataset_cfg["dataset_cache"]
+    )
+    dataset["valid"] = dataset["train"]  # The training set doubles as the validation set
+    dataset["test"] = MnistDataset(
+        "mnist_data", train=False, cache_dir=dataset_cfg["dataset_cache"]
+    )
+
     # Instantiate model
 
     model_cfg["input_length"] = 784
@@ -418,11 +677,15 @@ if __name__ == "__main__":
         print(f"Loading pre-trained checkpoint {options_cfg['checkpoint']}")
         checkpoint = torch.load(options_cfg["checkpoint"], map_location="cpu")
         model.load_state_dict(checkpoint["model_dict"])
+    # The connectivity is stored in the checkpoint, so report it once loaded
+    fanout_report(model, verbose=True)
 
     # start a new wandb run to track this script
     wandb.init(
         # set the wandb project where this run will be logged
         project="NeuraLUT",
+        # only the main process logs
+        mode=None if is_main_process() else "disabled",
         # track hyperparameters and run metadata
         config={
             "hidden_layers": model_cfg["hidden_layers"],
@@ -447,5 +710,6 @@ if __name__ == "__main__":
     wandb.define_metric("Valid Acc(%)", summary="max")
     wandb.define_metric("Train Loss(%)", summary="min")
     wandb.watch(model, log_freq=10)
-    train(model, train_cfg, options_cfg)
-    wandb.finish()
\ No newline at end of file
+    train(model, dataset, train_cfg, options_cfg)
+    wandb.finish()
+    cleanup_distributed()
\ No newline at end of file
@@ -0,0 +1,155 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Checkpointing helpers for the training loops: AsyncCheckpointer writes
+# checkpoints in a background thread and keeps the best k of them, and
+# EarlyStopping detects when the monitored accuracy stopped improving.
+
+import os
+import queue
+import threading
+
+import torch
+
+
+# A copy of a (nested) checkpoint dictionary with its tensors on the CPU, so
+# that training can modify the originals while the copy is written
+def _snapshot(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        copy = type(obj)((k, _snapshot(v)) for k, v in obj.items())
+        if hasattr(obj, "_metadata"):
+            # The versions of the modules, used by load_state_dict()
+            copy._metadata = obj._metadata
+        return copy
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+    return obj
+
+
+# Writes checkpoints to directory in a background thread, the training loop only
+# pays for copying the state to the CPU. Files are written to a temporary name
+# and renamed, so an interrupted write never leaves a truncated checkpoint.
+# save_best() keeps the keep_best checkpoints with the highest metric as
+# best_epoch<epoch>.pth (if keep_best > 1), and the best one as best_name.
+# At most max_pending snapshots wait to be written, save() blocks beyond that.
+class AsyncCheckpointer:
+    def __init__(
+        self,
+        directory: str,
+        keep_best: int = 1,
+        best_name: str = "best_accuracy.pth",
+        max_pending: int = 2,
+    ) -> None:
+        self.directory = directory
+        self.keep_best = keep_best
+        self.best_name = best_name
+        self.best = []  # (metric, epoch) of the retained checkpoints, best first
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self) -> None:
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                state, names, removed = task
+                for name in names:
+                    path = os.path.join(self.directory, name)
+                    tmp_path = f"{path}.tmp"
+                    torch.save(state, tmp_path)
+                    os.replace(tmp_path, path)
+                for name in removed:
+                    path = os.path.join(self.directory, name)
+                    if os.path.exists(path):
+                        os.remove(path)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise Exception(f"Writing a checkpoint failed: {error}") from error
+
+    def _submit(self, state: dict, names: list, removed=()) -> None:
+        self._check()
+        if not names and not removed:
+            return
+        self._queue.put((_snapshot(state), list(names), list(removed)))
+
+    def save(self, state: dict, name: str = "checkpoint.pth") -> None:
+        self._submit(state, [name])
+
+    # Record a checkpoint with the given metric (higher is better), returns
+    # whether it is the best so far. If latest is set, the checkpoint is also
+    # written under that name, from the same snapshot.
+    def save_best(self, state: dict, metric: float, epoch: int, latest: str = None) -> bool:
+        is_best = not self.best or metric > self.best[0][0]
+        names = [latest] if latest is not None else []
+        if is_best:
+            names.append(self.best_name)
+        removed = []
+        if self.keep_best > 1:
+            self.best.append((metric, epoch))
+            self.best.sort(key=lambda b: -b[0])
+            if (metric, epoch) in self.best[: self.keep_best]:
+                names.append(f"best_epoch{epoch}.pth")
+            removed = [f"best_epoch{e}.pth" for _, e in self.best[self.keep_best:]]
+            self.best = self.best[: self.keep_best]
+            removed = [n for n in removed if n not in names]
+        elif is_best:
+            self.best = [(metric, epoch)]
+        self._submit(state, names, removed)
+        return is_best
+
+    # Wait for the pending writes, raising an Exception if any failed
+    def wait(self) -> None:
+        self._queue.join()
+        self._check()
+
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._check()
+
+
+# Stop when the monitored metric (higher is better) did not improve by more
+# than min_delta for patience evaluations. patience=0 never stops.
+class EarlyStopping:
+    def __init__(self, patience: int = 0, min_delta: float = 0.0) -> None:
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = None
+        self.stale = 0
+
+    # Record an evaluation, returns whether training should stop
+    def step(self, metric: float) -> bool:
+        if self.best is None or metric > self.best + self.min_delta:
+            self.best = metric
+            self.stale = 0
+        else:
+            self.stale += 1
+        return self.patience > 0 and self.stale >= self.patience
@@ -0,0 +1,584 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Convert a trained NeqModel into LUTs and Verilog. The conversion is the same
+# for all datasets, the dataset specific parts (loading the test set, the
+# architectures, evaluation) are provided by a DatasetAdapter, e.g.:
+#   python neq2lut.py --arch jsc-2l --checkpoint ... (from datasets/jet_substructure)
+# or, equivalently:
+#   python -m neuralut.convert --adapter neq2lut:JetSubstructureAdapter --arch jsc-2l ...
+# See add_arguments() for the stage selection options.
+
+import importlib
+import os
+import random
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+from .instrument import enable, span
+from .models import load_layer_lists
+from .nn import (
+    fanout_report,
+    generate_truth_tables,
+    load_truth_tables,
+    lut_inference,
+    module_list_to_verilog_module,
+    prune_dead_neurons,
+    save_truth_tables,
+)
+from .pipeline import Pipeline, file_digest
+from .reports import format_layer_costs, layer_costs, read_synthesis_report
+from .synthesis import synthesize_and_get_resource_counts
+from .synthesis_cache import SynthesisCache
+
+# The options which configure the model, the remaining ones don't affect it
+MODEL_CONFIG_KEYS = [
+    "hidden_layers",
+    "input_bitwidth",
+    "hidden_bitwidth",
+    "output_bitwidth",
+    "input_fanin",
+    "hidden_fanin",
+    "output_fanin",
+    "width_n",
+    "neuron_fanins",
+    "channel_bitwidths",
+]
+
+STAGES = ["baseline_test", "truth_tables", "lut_test", "verilog", "simulation", "synthesis"]
+
+
+# The dataset specific parts of the conversion. Subclasses set the
+# architectures (configs, see train.py), the model classes and the test
+# function, and load the test set in load_test_set().
+class DatasetAdapter:
+    configs = {}
+    default_arch = None
+    default_dataset_cache = None
+    neq_model_class = None
+    lut_model_class = None
+
+    # Add the dataset specific command line options
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        pass
+
+    # Return the test set loader, and set the input_length / output_length of
+    # model_cfg
+    def load_test_set(self, config: dict, model_cfg: dict):
+        raise Exception(f"{type(self).__name__} must implement load_test_set()")
+
+    # Anything the test set depends on, so that the accuracy tests are rerun
+    # if it changes
+    def evaluation_params(self, config: dict) -> dict:
+        return {"dataset_split": config["dataset_split"]}
+
+    # The loader used to test the LUT-based and Verilog-based models, once the
+    # truth tables were generated. Defaults to the test set loader.
+    def lut_test_loader(self, lut_model, config: dict):
+        return self.test_loader
+
+    # Called before the LUT-based or Verilog-based model is tested
+    def prepare_lut_model(self, lut_model) -> None:
+        lut_inference(lut_model)
+
+    # Return the accuracy of a model on a loader
+    def test(self, model, loader, cuda: bool) -> float:
+        raise Exception(f"{type(self).__name__} must implement test()")
+
+
+def add_arguments(parser: ArgumentParser, adapter: DatasetAdapter) -> None:
+    parser.add_argument(
+        "--arch",
+        type=str,
+        choices=adapter.configs.keys(),
+        default=adapter.default_arch,
+        help="Specific the neural network model to use (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Batch size for evaluation (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--input-bitwidth",
+        type=int,
+        default=None,
+        help="Bitwidth to use at the input (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--hidden-bitwidth",
+        type=int,
+        default=None,
+        help="Bitwidth to use for activations in hidden layers (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output-bitwidth",
+        type=int,
+        default=None,
+        help="Bitwidth to use at the output (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--input-fanin",
+        type=int,
+        default=None,
+        help="Fanin to use at the input (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--hidden-fanin",
+        type=int,
+        default=None,
+        help="Fanin to use for the hidden layers (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output-fanin",
+        type=int,
+        default=None,
+        help="Fanin to use at the output (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--hidden-layers",
+        nargs="+",
+        type=int,
+        default=None,
+        help="A list of hidden layer neuron sizes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--width_n",
+        type=int,
+        default=None,
+        metavar="",
+        help="Width of sub-network(N) (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--neuron-fanins",
+        type=str,
+        default=None,
+        help="A JSON file with a list of per-neuron fan-ins (or null) for each layer, the checkpoint's are used otherwise (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--channel-bitwidths",
+        type=str,
+        default=None,
+        help="A JSON file with a list of the bitwidths of the input channels (or null) for each layer, the checkpoint's are used otherwise (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--clock-period",
+        type=float,
+        default=1.1,
+        help="Target clock period in ns to use during Vivado synthesis (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--synthesis-cache",
+        type=str,
+        default=None,
+        help="A directory to cache synthesis results in, keyed by the Verilog and the synthesis options (default: $NEURALUT_SYNTHESIS_CACHE or ~/.cache/neuralut/synthesis)",
+    )
+    parser.add_argument(
+        "--synthesis-cache-size",
+        type=float,
+        default=10.0,
+        help="Size of the synthesis cache in GiB, the least recently used results are evicted beyond it (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-synthesis-cache",
+        action="store_true",
+        default=False,
+        help="Always run synthesis, without looking up or storing its results in the cache (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-layer-reports",
+        action="store_true",
+        default=False,
+        help="Don't run Vivado again after synthesis to write the per-layer utilization and timing reports (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--dataset-cache",
+        type=str,
+        default=adapter.default_dataset_cache,
+        help="A directory to cache the preprocessed dataset in, pass an empty string to disable caching (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--dataset-split",
+        type=str,
+        default="test",
+        choices=["train", "test"],
+        help="Dataset to use for evaluation (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--log-dir",
+        type=str,
+        default="0",
+        help="A location to store the log output of the training run and the output model (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        required=True,
+        help="Seed to use for RNG (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--device",
+        type=int,
+        required=True,
+        help="Device_id for GPU (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        required=True,
+        help="The checkpoint file which contains the model weights",
+    )
+    parser.add_argument(
+        "--add-registers",
+        action="store_true",
+        default=False,
+        help="Add registers between each layer in generated verilog (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        default=False,
+        help="Remove neurons which are not connected to the next layer before generating the LUTs, the saved LUT-based model then has the pruned layer sizes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--fold-thresholds",
+        action="store_true",
+        default=False,
+        help="Fold the output BatchNorm / quantizers into per-neuron thresholds when generating truth tables (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--strict-input-encoder",
+        action="store_true",
+        default=False,
+        help="Fail, rather than warn, if the exported input encoder does not reproduce the input quantizer's codes on the test set (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        default=False,
+        help="Rerun all stages of the conversion, rather than resuming from the first incomplete one (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--skip-baseline-test",
+        action="store_true",
+        default=False,
+        help="Don't test the accuracy of the trained model (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--skip-lut-test",
+        action="store_true",
+        default=False,
+        help="Don't test the accuracy of the LUT-based model (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--skip-simulation",
+        action="store_true",
+        default=False,
+        help="Don't simulate the generated Verilog (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--skip-synthesis",
+        action="store_true",
+        default=False,
+        help="Don't run out-of-context synthesis (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--export-only",
+        action="store_true",
+        default=False,
+        help="Only generate the truth tables and the Verilog (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--simulate-only",
+        action="store_true",
+        default=False,
+        help="Only simulate the Verilog, generating it first if necessary (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cuda",
+        action="store_true",
+        default=False,
+        help="Train on a GPU (default: %(default)s)",
+    )
+    adapter.add_arguments(parser)
+
+
+# The stages selected by the command line options
+def selected_stages(config: dict) -> list:
+    if config["export_only"] and config["simulate_only"]:
+        raise Exception("Only one of --export-only and --simulate-only can be set")
+    if config["export_only"]:
+        return ["truth_tables", "verilog"]
+    if config["simulate_only"]:
+        return ["simulation"]
+    skipped = {
+        "baseline_test": config["skip_baseline_test"],
+        "lut_test": config["skip_lut_test"],
+        "simulation": config["skip_simulation"],
+        "synthesis": config["skip_synthesis"],
+    }
+    return [s for s in STAGES if not skipped.get(s, False)]
+
+
+def convert(adapter: DatasetAdapter, config: dict) -> dict:
+    if not os.path.exists(config["log_dir"]):
+        os.makedirs(config["log_dir"])
+    log_dir = config["log_dir"]
+    # Record the time and memory spent in each stage, the JSON report is
+    # updated as each stage completes
+    instrumentation = enable(report_path=os.path.join(log_dir, "instrumentation.json"))
+
+    model_cfg = load_layer_lists({k: config[k] for k in MODEL_CONFIG_KEYS})
+    model_cfg["cuda"] = config["cuda"]
+    # Set random seeds
+    random.seed(config["seed"])
+    np.random.seed(config["seed"])
+    torch.manual_seed(config["seed"])
+    os.environ["PYTHONHASHSEED"] = str(config["seed"])
+    if config["cuda"]:
+        torch.cuda.manual_seed_all(config["seed"])
+        torch.backends.cudnn.deterministic = True
+        torch.cuda.set_device(config["device"])
+
+    # Fetch the test set
+    adapter.test_loader = adapter.load_test_set(config, model_cfg)
+
+    # Instantiate the PyTorch model
+    model = adapter.neq_model_class(model_cfg)
+    if config["cuda"]:
+        model.cuda()
+
+    # Load the model weights
+    checkpoint = torch.load(config["checkpoint"], map_location="cuda:{}".format(config["device"]) if config["cuda"] else "cpu")
+    model.load_state_dict(checkpoint["model_dict"])
+    fanout_report(model, verbose=True)
+
+    lut_model = adapter.lut_model_class(model_cfg)
+    if config["cuda"]:
+        lut_model.cuda()
+    lut_model.load_state_dict(checkpoint['model_dict'])
+    if config["prune"]:
+        # Drop the neurons which no later layer is connected to, before
+        # generating their truth tables and Verilog
+        print("Pruning dead neurons...")
+        with span("prune"):
+            prune_dead_neurons(lut_model.module_list, verbose=True)
+
+    # The conversion runs as a sequence of stages, whose results and artifacts
+    # are recorded in <log_dir>/pipeline.json. A rerun skips the stages which
+    # completed previously (unless --restart is set), and resumes from the first
+    # incomplete stage, or the first one whose inputs changed.
+    pipeline = Pipeline(
+        log_dir,
+        fingerprint={
+            "checkpoint": file_digest(config["checkpoint"]),
+            "model": {k: v for k, v in model_cfg.items() if k != "cuda"},
+            "prune": config["prune"],
+            "fold_thresholds": config["fold_thresholds"],
+        },
+        restart=config["restart"],
+    )
+    evaluation = adapter.evaluation_params(config)
+    truth_tables_path = os.path.join(log_dir, "truth_tables.pth")
+
+    # Test the PyTorch model
+    def test_baseline():
+        print("Running inference on baseline model...")
+        with span("test", model="baseline"):
+            baseline_accuracy = adapter.test(model, adapter.test_loader, cuda=config["cuda"])
+        print("Baseline accuracy: %f" % (baseline_accuracy))
+        return {"accuracy": baseline_accuracy}
+
+    # Generate the truth tables in the LUT module
+    def generate_luts():
+        print("Converting to NEQs to LUTs...")
+        generate_truth_tables(
+            lut_model, verbose=True, fold_thresholds=config["fold_thresholds"]
+        )
+        save_truth_tables(lut_model, truth_tables_path)
+
+    # Test the LUT-based model
+    def test_luts():
+        print("Running inference on LUT-based model...")
+        adapter.prepare_lut_model(lut_model)
+        loader = adapter.lut_test_loader(lut_model, config)
+        with span("test", model="lut"):
+            lut_accuracy = adapter.test(lut_model, loader, cuda=config["cuda"])
+        print("LUT-Based Model accuracy: %f" % (lut_accuracy))
+        modelSave = {"model_dict": lut_model.state_dict(), "test_accuracy": lut_accuracy}
+        torch.save(modelSave, log_dir + "/lut_based_model.pth")
+        return {"accuracy": lut_accuracy}
+
+    def export_verilog():
+        # Export the first layer's input quantization as per-feature thresholds,
+        # which map raw features to LUT input codes without torch
+        input_encoder = lut_model.module_list[0].input_quant.export_input_encoder(
+            lut_model.module_list[0].in_features
+        )
+        input_encoder.save(log_dir + "/input_encoder.npz")
+        print("Input encoder stored at: %s/input_encoder.npz" % (log_dir))
+        # Check that the encoder reproduces the codes of the input quantizer
+        # on the test set, they can differ for inputs halfway between two levels
+        input_quant = lut_model.module_list[0].input_quant
+        mismatches, num_codes = 0, 0
+        with span("check_input_encoder"):
+            for data, _ in adapter.test_loader:
+                x = data.reshape(len(data), -1)
+                mismatches += input_quant.count_encoder_mismatches(input_encoder, x)
+                num_codes += x.numel()
+        if mismatches > 0:
+            message = "The input encoder differs from the input quantizer in %d of %d codes of the test set" % (mismatches, num_codes)
+            if config["strict_input_encoder"]:
+                raise Exception(message)
+            print("Warning: " + message)
+        print("Generating verilog in %s..." % (log_dir))
+        module_list_to_verilog_module(
+            lut_model.module_list,
+            "neuralut",
+            log_dir,
+            add_registers=config["add_registers"],
+        )
+        print("Top level entity stored at: %s/neuralut.v ..." % (log_dir))
+        return {"input_encoder_mismatches": mismatches}
+
+    def verilog_files():
+        files = ["input_encoder.npz", "neuralut.v", "myreg.v"]
+        for i, layer in enumerate(lut_model.module_list):
+            files.append(f"layer{i}.v")
+            files += [f"layer{i}_N{n}.v" for n in range(layer.out_features)]
+        return files
+
+    def simulate_verilog():
+        io_filename = None
+        adapter.prepare_lut_model(lut_model)
+        print("Running inference simulation of Verilog-based model...")
+        lut_model.verilog_inference(log_dir, "neuralut.v", logfile=io_filename, add_registers=config["add_registers"])
+        print("Testing Verilog-Based Model")
+        loader = adapter.lut_test_loader(lut_model, config)
+        with span("test", model="verilog"):
+            verilog_accuracy = adapter.test(lut_model, loader, cuda=config["cuda"])
+        print("Verilog-Based Model accuracy: %f" % (verilog_accuracy))
+        return {"accuracy": verilog_accuracy}
+
+    synthesis_config = {
+        "fpga_part": "xcvu9p-flgb2104-2-i",
+        "clk_period_ns": config["clock_period"],
+        "post_synthesis": 1,
+        "layer_reports": not config["no_layer_reports"],
+    }
+
+    def synthesize():
+        print("Running out-of-context synthesis")
+        if config["no_synthesis_cache"]:
+            ret = synthesize_and_get_resource_counts(log_dir, "neuralut", **synthesis_config)
+        else:
+            cache = SynthesisCache(config["synthesis_cache"], max_size_gb=config["synthesis_cache_size"])
+            ret = cache.synthesize(log_dir, "neuralut", **synthesis_config)
+        # Attribute the LUTs / FFs to the layers, next to their truth table sizes
+        report = read_synthesis_report(ret["vivado_proj_folder"], "neuralut", synthesis_config["clk_period_ns"])
+        ret["layers"] = layer_costs(report, lut_model.module_list)
+        print(format_layer_costs(ret["layers"]))
+        if report.paths:
+            worst = report.paths[0]
+            print(
+                "Worst path: %.3f ns slack, layer %s to layer %s (%s -> %s)"
+                % (worst.slack_ns, worst.start_layer, worst.end_layer, worst.source, worst.destination)
+            )
+            ret["worst_path"] = worst.to_dict()
+        return ret
+
+    pipeline.add("baseline_test", test_baseline, params=evaluation)
+    pipeline.add(
+        "truth_tables",
+        generate_luts,
+        load=lambda: load_truth_tables(lut_model, truth_tables_path),
+        outputs=["truth_tables.pth"],
+    )
+    pipeline.add(
+        "lut_test",
+        test_luts,
+        depends=["truth_tables"],
+        outputs=["lut_based_model.pth"],
+        params=evaluation,
+    )
+    pipeline.add(
+        "verilog",
+        export_verilog,
+        depends=["truth_tables"],
+        outputs=verilog_files,
+        params={"add_registers": config["add_registers"]},
+    )
+    pipeline.add(
+        "simulation",
+        simulate_verilog,
+        depends=["truth_tables", "verilog"],
+        params=evaluation,
+    )
+    pipeline.add(
+        "synthesis", synthesize, depends=["verilog"], params=synthesis_config
+    )
+    results = pipeline.run(stages=selected_stages(config))
+
+    if "baseline_test" in results:
+        print("Baseline accuracy: %f" % (results["baseline_test"]["accuracy"]))
+    if "lut_test" in results:
+        print("LUT-Based Model accuracy: %f" % (results["lut_test"]["accuracy"]))
+    if "simulation" in results:
+        print("Verilog-Based Model accuracy: %f" % (results["simulation"]["accuracy"]))
+    if "synthesis" in results:
+        print("Max f: %s MHz" % (results["synthesis"]["fmax_mhz"]))
+
+    print(instrumentation.summary())
+    print("Instrumentation report stored at: %s" % (instrumentation.report_path))
+    return results
+
+
+# Parse the command line and run the conversion with a DatasetAdapter
+def main(adapter: DatasetAdapter, argv=None) -> dict:
+    parser = ArgumentParser(
+        description="Synthesize convert a PyTorch trained model into verilog"
+    )
+    add_arguments(parser, adapter)
+    args = parser.parse_args(argv)
+    defaults = adapter.configs[args.arch]
+    options = vars(args)
+    del options["arch"]
+    config = {}
+    for k in options.keys():
+        config[k] = (
+            options[k] if options[k] is not None else defaults.get(k)
+        )  # Override defaults, if specified.
+    return convert(adapter, config)
+
+
+# python -m neuralut.convert --adapter <module>:<class> ..., where <module> is
+# importable from the current directory
+if __name__ == "__main__":
+    adapter_parser = ArgumentParser(add_help=False)
+    adapter_parser.add_argument("--adapter", type=str, required=True)
+    adapter_args, argv = adapter_parser.parse_known_args()
+    module_name, _, class_name = adapter_args.adapter.partition(":")
+    sys.path.insert(0, os.getcwd())
+    adapter = getattr(importlib.import_module(module_name), class_name)()
+    main(adapter, argv)
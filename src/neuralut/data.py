@@ -0,0 +1,195 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import queue
+import threading
+
+import torch
+from torch.utils.data import Subset
+
+
+# Return the X / y tensors backing a dataset, along with the indices of the
+# rows which belong to it (None if the dataset spans all rows).
+# Nested Subsets of a tensor-backed dataset are resolved into a single index tensor.
+def get_dataset_tensors(dataset):
+    indices = None
+    while isinstance(dataset, Subset):
+        subset_indices = torch.as_tensor(dataset.indices, dtype=torch.int64)
+        indices = subset_indices if indices is None else subset_indices[indices]
+        dataset = dataset.dataset
+    if not (hasattr(dataset, "X") and hasattr(dataset, "y")):
+        raise Exception(
+            f"Expected a dataset with X and y tensors, {type(dataset)} found"
+        )
+    return dataset.X, dataset.y, indices
+
+
+# Split a dataset into (train, valid) Subsets, holding out a random fraction of
+# its samples (fixed by seed) to select models on data they were not trained on.
+def holdout_split(dataset, fraction=0.1, seed=0):
+    num_samples = len(dataset)
+    num_valid = int(round(num_samples * fraction))
+    if not 0 < num_valid < num_samples:
+        raise Exception(
+            f"Holding out {fraction} of {num_samples} samples leaves an empty split"
+        )
+    order = torch.randperm(num_samples, generator=torch.Generator().manual_seed(seed))
+    return Subset(dataset, order[num_valid:]), Subset(dataset, order[:num_valid])
+
+
+# Sentinels passed from the prefetching thread to the consumer
+class _EndOfEpoch:
+    pass
+
+
+class _ProducerError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+# A drop-in replacement for DataLoader over datasets which keep all of their
+# samples in X / y tensors. Rather than fetching and collating samples one at
+# a time, each batch is a slice of the underlying tensors (or a single
+# index_select when shuffling). Batches can optionally be prepared ahead of
+# time in a background thread, with at most 'prefetch' batches in flight.
+# For distributed training, each of world_size processes iterates over its own
+# shard (every world_size-th sample, starting at rank) of the, possibly
+# shuffled, samples. The shuffled order then only depends on seed and the
+# epoch set with set_epoch(), so that all processes agree on it. If pad_shards
+# is set, samples are repeated so that all shards have the same number of
+# batches, as needed by DistributedDataParallel; leave it unset for evaluation.
+class TensorBatchLoader:
+    def __init__(
+        self,
+        dataset,
+        batch_size: int = 1,
+        shuffle: bool = False,
+        drop_last: bool = False,
+        prefetch: int = 0,
+        generator: torch.Generator = None,
+        rank: int = 0,
+        world_size: int = 1,
+        pad_shards: bool = True,
+        seed: int = 0,
+    ) -> None:
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.prefetch = prefetch
+        self.generator = generator
+        self.rank = rank
+        self.world_size = world_size
+        self.pad_shards = pad_shards
+        self.seed = seed
+        self.epoch = 0
+        self.X, self.y, self.indices = get_dataset_tensors(dataset)
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    # The number of samples in the shard of this process
+    def num_shard_samples(self) -> int:
+        num_samples = len(self.dataset)
+        if self.world_size == 1:
+            return num_samples
+        if self.pad_shards:
+            return (num_samples + self.world_size - 1) // self.world_size
+        return len(range(self.rank, num_samples, self.world_size))
+
+    def __len__(self):
+        num_samples = self.num_shard_samples()
+        if self.drop_last:
+            return num_samples // self.batch_size
+        return (num_samples + self.batch_size - 1) // self.batch_size
+
+    def batches(self):
+        num_samples = len(self.dataset)
+        order = self.indices
+        if self.shuffle:
+            # A new permutation per epoch
+            generator = self.generator
+            if self.world_size > 1:
+                generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(num_samples, generator=generator)
+            if self.indices is not None:
+                order = self.indices[order]
+        if self.world_size > 1:
+            if order is None:
+                order = torch.arange(num_samples)
+            # Wraps around to pad the last shards
+            shard = torch.arange(
+                self.rank, self.num_shard_samples() * self.world_size, self.world_size
+            )
+            order = order[shard % num_samples]
+        end = len(self) * self.batch_size
+        for start in range(0, end, self.batch_size):
+            if order is None:
+                yield (
+                    self.X[start : start + self.batch_size],
+                    self.y[start : start + self.batch_size],
+                )
+            else:
+                batch_indices = order[start : start + self.batch_size]
+                yield (
+                    self.X.index_select(0, batch_indices),
+                    self.y.index_select(0, batch_indices),
+                )
+
+    def prefetched_batches(self):
+        batch_queue = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        # Returns False if the consumer stopped iterating early
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.batches():
+                    if not put(batch):
+                        return
+                put(_EndOfEpoch())
+            except Exception as e:
+                put(_ProducerError(e))
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = batch_queue.get()
+                if isinstance(item, _EndOfEpoch):
+                    break
+                if isinstance(item, _ProducerError):
+                    raise item.exception
+                yield item
+        finally:
+            stop.set()
+            producer.join()
+
+    def __iter__(self):
+        if self.prefetch > 0:
+            return self.prefetched_batches()
+        return self.batches()
@@ -0,0 +1,138 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Data-parallel training over several processes, e.g., CPU nodes with the gloo
+# backend. The processes are launched by torchrun, which sets the RANK,
+# WORLD_SIZE and MASTER_ADDR / MASTER_PORT environment variables:
+#   torchrun --standalone --nproc_per_node=4 train.py ...
+# Without them, init_distributed() does nothing and training runs in a single
+# process as before.
+
+import itertools
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.distributed.nn.functional import all_reduce as differentiable_all_reduce
+
+
+# Join the process group described by the environment, if any, returns
+# (rank, world_size)
+def init_distributed(backend: str = "gloo"):
+    world_size = int(os.environ.get("WORLD_SIZE", "1"))
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    return get_rank(), get_world_size()
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+# Only the main process writes checkpoints and logs
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def cleanup_distributed() -> None:
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+
+# The sums of the values over all processes, as floats
+def all_reduce_sum(values: list) -> list:
+    if not is_distributed():
+        return [float(v) for v in values]
+    t = torch.tensor([float(v) for v in values], dtype=torch.float64)
+    dist.all_reduce(t)
+    return t.tolist()
+
+
+# A BatchNorm1d whose batch statistics are computed over the batches of all
+# processes during training, so that the quantizers see the same scale as with
+# a single process. Unlike nn.SyncBatchNorm it runs on the CPU (gloo). Its
+# state dict is the one of BatchNorm1d, so checkpoints load into either, and
+# it is folded like BatchNorm1d (see fold_affine_transforms()).
+class DistributedBatchNorm1d(nn.BatchNorm1d):
+    def forward(self, x):
+        if not (self.training and is_distributed()):
+            return super().forward(x)
+        channels = x.shape[1]
+        dims = [0] + list(range(2, x.dim()))
+        count = x.numel() // channels
+        x32 = x.float()
+        local = torch.cat(
+            [x32.sum(dims), (x32 * x32).sum(dims), x32.new_tensor([count])]
+        )
+        total = differentiable_all_reduce(local)
+        n = total[-1]
+        mean = total[:channels] / n
+        var = (total[channels : 2 * channels] / n - mean * mean).clamp(min=0)
+        if self.track_running_stats:
+            with torch.no_grad():
+                self.num_batches_tracked += 1
+                if self.momentum is None:
+                    momentum = 1.0 / float(self.num_batches_tracked)
+                else:
+                    momentum = self.momentum
+                self.running_mean.mul_(1 - momentum).add_(momentum * mean.detach())
+                unbiased_var = var.detach() * n / (n - 1).clamp(min=1)
+                self.running_var.mul_(1 - momentum).add_(momentum * unbiased_var)
+        shape = [1, channels] + [1] * (x.dim() - 2)
+        weight = self.weight if self.affine else None
+        bias = self.bias if self.affine else None
+        y = (x32 - mean.reshape(shape)) * torch.rsqrt(var.reshape(shape) + self.eps)
+        if weight is not None:
+            y = y * weight.reshape(shape) + bias.reshape(shape)
+        return y.to(x.dtype)
+
+
+# Replace the BatchNorm1ds of a model (e.g., the pre-transforms of its
+# quantizers) with DistributedBatchNorm1ds, in place. A BatchNorm shared by
+# several modules (e.g., a quantizer which is the output quantizer of a layer
+# and the input quantizer of the next) is replaced by a single instance.
+def convert_distributed_batchnorm(module: nn.Module, _replaced=None) -> nn.Module:
+    replaced = {} if _replaced is None else _replaced
+    for name, child in module.named_children():
+        if type(child) == nn.BatchNorm1d:
+            if child not in replaced:
+                bn = DistributedBatchNorm1d(
+                    child.num_features,
+                    eps=child.eps,
+                    momentum=child.momentum,
+                    affine=child.affine,
+                    track_running_stats=child.track_running_stats,
+                )
+                bn.load_state_dict(child.state_dict())
+                tensors = itertools.chain(child.parameters(), child.buffers())
+                bn.to(next(tensors, torch.empty(0)).device)
+                replaced[child] = bn
+            setattr(module, name, replaced[child])
+        else:
+            convert_distributed_batchnorm(child, replaced)
+    return module
@@ -0,0 +1,104 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# This module intentionally only depends on numpy, so that encoders exported
+# from a trained model can be used in environments without torch / brevitas.
+import numpy as np
+
+
+# Maps raw input features to the integer codes produced by a layer's input
+# quantizer (including its BatchNorm / bias / scale pre-transforms).
+# Each feature c is described by a sorted vector of thresholds[c], such that:
+#   code = min_code + #{k : sign[c] * x[c] >= thresholds[c, k]}
+# Channels with a reduced bitwidth drop the LSBs of their codes (drop_bits[c]).
+# Use QuantBrevitasActivation.export_input_encoder() to create one.
+class InputEncoder:
+    def __init__(
+        self, thresholds, sign, min_code: int, offset: int = 0, drop_bits=None
+    ) -> None:
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)  # [C, L-1]
+        self.sign = np.asarray(sign, dtype=np.float64)  # [C]
+        self.min_code = int(min_code)
+        self.offset = int(offset)  # Added to obtain the unsigned codes used in HDL
+        if drop_bits is None:
+            drop_bits = np.zeros(self.thresholds.shape[0], dtype=np.int64)
+        self.drop_bits = np.asarray(drop_bits, dtype=np.int64)  # [C]
+
+    @property
+    def num_features(self):
+        return self.thresholds.shape[0]
+
+    # Returns the codes as returned by the quantizer in bin_output() mode.
+    # Set unsigned=True to obtain the bit patterns of each feature fed to the
+    # generated Verilog (reduced channels are shifted down to their bitwidth).
+    def encode(self, x, unsigned: bool = False):
+        x = np.asarray(x, dtype=np.float64)
+        if x.ndim != 2 or x.shape[1] != self.num_features:
+            raise Exception(
+                f"Expected an input of shape [N, {self.num_features}], {x.shape} found"
+            )
+        x = x * self.sign
+        codes = np.empty(x.shape, dtype=np.int64)
+        for c in range(self.num_features):
+            codes[:, c] = np.searchsorted(self.thresholds[c], x[:, c], side="right")
+        codes += self.min_code
+        # Round the codes of the reduced channels down
+        codes = np.floor_divide(codes, 2**self.drop_bits) * 2**self.drop_bits
+        if unsigned:
+            reduced = self.drop_bits > 0
+            # Reduced channels use the full signed range of their bits
+            reduced_offset = np.where(
+                self.offset > 0, 2 ** (self.bitwidth() - self.drop_bits - 1), 0
+            )
+            codes = np.where(
+                reduced,
+                (codes >> self.drop_bits) + reduced_offset,
+                codes + self.offset,
+            )
+        return codes
+
+    # The full bitwidth of the codes, before any LSBs are dropped
+    def bitwidth(self) -> int:
+        return int(np.ceil(np.log2(self.thresholds.shape[1] + 1)))
+
+    def __call__(self, x, unsigned: bool = False):
+        return self.encode(x, unsigned=unsigned)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                thresholds=self.thresholds,
+                sign=self.sign,
+                min_code=self.min_code,
+                offset=self.offset,
+                drop_bits=self.drop_bits,
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(
+                arrays["thresholds"],
+                arrays["sign"],
+                int(arrays["min_code"]),
+                int(arrays["offset"]),
+                # Encoders saved before per-channel bitwidths were supported
+                arrays["drop_bits"] if "drop_bits" in arrays else None,
+            )
@@ -17,15 +17,156 @@ import torch.nn as nn
 from torch import Tensor
 from torch.nn import init
 
+
+# Connectivity samplers. Each returns a [out_features, fan_in] matrix holding
+# the (sorted) indices of the inputs connected to each neuron. The whole matrix
+# is built at once, pass a torch.Generator to make the sampling reproducible
+# independently of the global RNG.
+
+
+def _check_fanin(in_features: int, fan_in: int) -> None:
+    if fan_in > in_features:
+        raise Exception(
+            f"Can not connect {fan_in} distinct inputs, only {in_features} available"
+        )
+
+
+# Each neuron is connected to a uniformly random subset of the inputs
+def random_fanin_indices(
+    in_features: int, out_features: int, fan_in: int, generator=None
+) -> Tensor:
+    _check_fanin(in_features, fan_in)
+    # The top-k of i.i.d. noise is a random subset, without replacement
+    scores = torch.rand(out_features, in_features, generator=generator)
+    return scores.topk(fan_in, dim=1).indices.sort(dim=1).values
+
+
+# Neurons are spread evenly over the inputs, and each is connected to a random
+# subset of the 'window' inputs closest to its position. Neighbouring neurons
+# therefore share (and are placed near) the same inputs.
+def local_fanin_indices(
+    in_features: int, out_features: int, fan_in: int, window: int = None, generator=None
+) -> Tensor:
+    _check_fanin(in_features, fan_in)
+    if window is None:
+        window = 2 * fan_in
+    window = min(max(window, fan_in), in_features)
+    centers = (torch.arange(out_features, dtype=torch.float64) + 0.5) * (
+        in_features / out_features
+    )
+    starts = (centers - window / 2).round().long().clamp(0, in_features - window)
+    scores = torch.rand(out_features, window, generator=generator)
+    offsets = scores.topk(fan_in, dim=1).indices
+    return (starts.unsqueeze(1) + offsets).sort(dim=1).values
+
+
+# The out_features * fan_in connections are dealt from consecutive random
+# permutations of the inputs, so the fanout of every input is either
+# floor(out_features * fan_in / in_features) or the ceiling of it. In particular
+# every input is used if out_features * fan_in >= in_features.
+def balanced_fanin_indices(
+    in_features: int, out_features: int, fan_in: int, generator=None
+) -> Tensor:
+    _check_fanin(in_features, fan_in)
+    num_connections = out_features * fan_in
+    permutations = []
+    for start in range(0, num_connections, in_features):
+        permutation = torch.randperm(in_features, generator=generator)
+        # A neuron may straddle two permutations, its first 'tail' inputs come
+        # from the end of the previous one. Start this permutation with inputs
+        # which are distinct from those.
+        tail = start % fan_in
+        if tail > 0:
+            used = torch.zeros(in_features, dtype=torch.bool)
+            used[permutations[-1][-tail:]] = True
+            free, taken = permutation[~used[permutation]], permutation[used[permutation]]
+            head = free[: fan_in - tail]
+            rest = torch.cat([free[fan_in - tail :], taken])
+            rest = rest[torch.randperm(len(rest), generator=generator)]
+            permutation = torch.cat([head, rest])
+        permutations.append(permutation)
+    indices = torch.cat(permutations)[:num_connections]
+    return indices.reshape(out_features, fan_in).sort(dim=1).values
+
+
+# Repair step for sampled connectivity: move connections between inputs, one at
+# a time, until no input has a fanout above max_fanout and (if cover_inputs)
+# every input is connected to at least one neuron.
+def rebalance_fanin_indices(
+    indices: Tensor,
+    in_features: int,
+    max_fanout: int = None,
+    cover_inputs: bool = False,
+    generator=None,
+) -> Tensor:
+    out_features, fan_in = indices.shape
+    num_connections = out_features * fan_in
+    if max_fanout is not None and num_connections > in_features * max_fanout:
+        raise Exception(
+            f"Can not bound the fanout by {max_fanout}, {num_connections} connections to {in_features} inputs are required"
+        )
+    if cover_inputs and num_connections < in_features:
+        raise Exception(
+            f"Can not use all {in_features} inputs with only {num_connections} connections"
+        )
+    indices = indices.clone()
+    fanout = torch.bincount(indices.flatten(), minlength=in_features)
+
+    # Reconnect a random neuron from input src to input dst
+    def move(src, dst) -> bool:
+        rows = (indices == src).any(dim=1) & ~(indices == dst).any(dim=1)
+        rows = rows.nonzero(as_tuple=True)[0]
+        if len(rows) == 0:
+            return False
+        row = rows[torch.randint(len(rows), (1,), generator=generator)].item()
+        indices[row] = torch.where(indices[row] == src, dst, indices[row])
+        fanout[src] -= 1
+        fanout[dst] += 1
+        return True
+
+    # Random tie-breaking between inputs with the same fanout
+    def by_fanout(descending=False):
+        noise = torch.rand(in_features, generator=generator) * 0.5
+        return (fanout.double() + noise).argsort(descending=descending)
+
+    if max_fanout is not None:
+        while fanout.max() > max_fanout:
+            src = fanout.argmax().item()
+            if not any(
+                move(src, dst.item())
+                for dst in by_fanout()
+                if fanout[dst] < max_fanout
+            ):
+                raise Exception(f"Failed to reduce the fanout of input {src}")
+    if cover_inputs:
+        while (fanout == 0).any():
+            dst = by_fanout()[0].item()
+            if not any(
+                move(src.item(), dst) for src in by_fanout(True) if fanout[src] > 1
+            ):
+                raise Exception(f"Failed to connect input {dst}")
+    return indices.sort(dim=1).values
+
+
+# Reorder the neurons (rows) lexicographically by their inputs, so that neurons
+# sharing inputs get neighbouring indices, i.e., neighbouring LUTs in the HDL
+def group_fanin_indices(indices: Tensor) -> Tensor:
+    order = torch.arange(indices.shape[0])
+    for j in reversed(range(indices.shape[1])):
+        order = order[indices[order, j].sort(stable=True).indices]
+    return indices[order]
+
+
 # TODO: Expand to support tensors larger than 2 dimensions
-def random_restrict_fanin(mask: Tensor, fan_in: int) -> Tensor:
+def random_restrict_fanin(mask: Tensor, fan_in: int, generator=None) -> Tensor:
     vector_size, num_vectors = nn.init._calculate_fan_in_and_fan_out(mask)
     init.constant_(mask, 0.0)
     if len(mask.shape) == 2:
-        for i in range(num_vectors):
-            x = torch.randperm(vector_size)[:fan_in]
-            mask[i][x] = 1
+        indices = random_fanin_indices(
+            vector_size, num_vectors, fan_in, generator=generator
+        )
+        with torch.no_grad():
+            mask.scatter_(1, indices.to(mask.device), 1.0)
     else:
         assert False, "Unsupported mask shape, specified: %s" % (str(mask.shape))
     return mask
-
@@ -0,0 +1,307 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Per-stage timing and memory instrumentation. Library functions open spans with
+#   with span("truth_tables", layer=name) as s:
+#       ...
+#       s.add_items(num_entries)
+# which are free unless an Instrumentation is enabled (see enable()). Each span
+# records its wall time, CPU time, the peak RSS of the process while it was
+# open and an item count, spans opened inside others are nested. The CPU time
+# and peak RSS of child processes (e.g., the Verilator build or Vivado) are
+# recorded too. They cover all children of the process, including those started
+# by other threads while the span was open.
+
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+# The current resident set size of this process in bytes, or its peak so far
+# where /proc is not available
+def current_rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+# The user + system CPU time of the terminated (and waited for) child processes
+def _child_cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+# The peak RSS of the largest terminated child process so far, in bytes
+def _child_maxrss() -> int:
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _child_pids(pid: int) -> list:
+    pids = []
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return pids
+    for tid in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                pids += [int(p) for p in f.read().split()]
+        except (OSError, ValueError):
+            pass
+    return pids
+
+
+# The total resident set size of the running descendants of this process in
+# bytes, or 0 where /proc is not available
+def children_rss() -> int:
+    total = 0
+    pids = _child_pids(os.getpid())
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                total += int(f.read().split()[1]) * _PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            continue
+        pids += _child_pids(pid)
+    return total
+
+
+class Span:
+    def __init__(self, name: str, parent=None, **attributes) -> None:
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.children = []
+        self.items = None
+        self.error = None
+        self.start_time = time.time()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self._child_cpu_start = _child_cpu_time()
+        self._child_maxrss_start = _child_maxrss()
+        self.wall_time = None
+        self.cpu_time = None  # Including the child processes
+        self.child_cpu_time = None
+        self.peak_rss = current_rss()
+        self.child_peak_rss = 0
+
+    def add_items(self, n: int) -> None:
+        self.items = (self.items or 0) + int(n)
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def sample(self, rss: int, child_rss: int = 0) -> None:
+        if rss > self.peak_rss:
+            self.peak_rss = rss
+        if child_rss > self.child_peak_rss:
+            self.child_peak_rss = child_rss
+
+    def finish(self) -> None:
+        self.sample(current_rss(), children_rss())
+        # A child which exited between two samples is only seen by
+        # RUSAGE_CHILDREN, if it was the largest one so far
+        child_maxrss = _child_maxrss()
+        if child_maxrss > self._child_maxrss_start:
+            self.sample(0, child_maxrss)
+        self.wall_time = time.perf_counter() - self._wall_start
+        self.child_cpu_time = _child_cpu_time() - self._child_cpu_start
+        self.cpu_time = time.process_time() - self._cpu_start + self.child_cpu_time
+
+    def to_dict(self) -> dict:
+        d = {
+            "name": self.name,
+            "start_time": self.start_time,
+            "wall_time_s": self.wall_time,
+            "cpu_time_s": self.cpu_time,
+            "child_cpu_time_s": self.child_cpu_time,
+            "peak_rss_mb": self.peak_rss / 2**20,
+            "child_peak_rss_mb": self.child_peak_rss / 2**20,
+            "items": self.items,
+        }
+        if self.items is not None and self.wall_time:
+            d["throughput"] = self.items / self.wall_time
+        if self.attributes:
+            d["attributes"] = self.attributes
+        if self.error is not None:
+            d["error"] = self.error
+        if self.children:
+            d["children"] = [c.to_dict() for c in self.children]
+        return d
+
+
+# Returned by span() when instrumentation is disabled
+class _NullSpan:
+    def add_items(self, n: int) -> None:
+        pass
+
+    def set(self, **attributes) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+# Records a tree of spans. The RSS is sampled every sample_interval seconds by
+# a background thread, so that the peak of each open span is known. If
+# report_path is set, the JSON report is rewritten whenever a top-level span
+# finishes, so that it survives a crash in a later stage.
+class Instrumentation:
+    def __init__(self, report_path: str = None, sample_interval: float = 0.05) -> None:
+        self.report_path = report_path
+        self.sample_interval = sample_interval
+        self.roots = []
+        self.start_time = time.time()
+        self._local = threading.local()
+        self._open = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        if sample_interval:
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.sample_interval):
+            rss, child_rss = current_rss(), children_rss()
+            with self._lock:
+                for s in self._open:
+                    s.sample(rss, child_rss)
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name: str, items: int = None, **attributes):
+        stack = self._stack()
+        s = Span(name, parent=stack[-1] if stack else None, **attributes)
+        if items is not None:
+            s.add_items(items)
+        with self._lock:
+            (s.parent.children if s.parent is not None else self.roots).append(s)
+            self._open.add(s)
+        stack.append(s)
+        try:
+            yield s
+        except BaseException as e:
+            s.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            stack.pop()
+            s.finish()
+            with self._lock:
+                self._open.discard(s)
+            if s.parent is None and self.report_path is not None:
+                self.save(self.report_path)
+
+    def report(self) -> dict:
+        with self._lock:
+            spans = [s.to_dict() for s in self.roots]
+        return {
+            "start_time": self.start_time,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "argv": sys.argv,
+            "peak_rss_mb": max([current_rss()] + [s.peak_rss for s in self.roots]) / 2**20,
+            "spans": spans,
+        }
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(tmp_path, path)
+
+    # One line per span, indented by depth
+    def summary(self) -> str:
+        lines = []
+
+        def visit(s, depth):
+            d = s.to_dict()
+            line = (
+                f"{'  '*depth}{s.name:<{40-2*depth}}"
+                f"{d['wall_time_s'] or 0:>10.3f} s wall"
+                f"{d['cpu_time_s'] or 0:>10.3f} s CPU"
+                f"{d['peak_rss_mb']:>10.1f} MiB"
+            )
+            if s.child_peak_rss:
+                line += f" (+{d['child_peak_rss_mb']:.1f} MiB children)"
+            if s.items is not None:
+                line += f"{s.items:>12} items"
+            lines.append(line)
+            for c in s.children:
+                visit(c, depth + 1)
+
+        with self._lock:
+            roots = list(self.roots)
+        for s in roots:
+            visit(s, 0)
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+
+
+_active = None
+
+
+# Record the spans opened by the library in an Instrumentation, which is returned
+def enable(report_path: str = None, sample_interval: float = 0.05) -> Instrumentation:
+    global _active
+    disable()
+    _active = Instrumentation(report_path, sample_interval)
+    return _active
+
+
+def disable() -> None:
+    global _active
+    if _active is not None:
+        _active.close()
+    _active = None
+
+
+def get_instrumentation() -> Instrumentation:
+    return _active
+
+
+# A span of the enabled Instrumentation, if any
+@contextmanager
+def span(name: str, items: int = None, **attributes):
+    if _active is None:
+        yield _NULL_SPAN
+    else:
+        with _active.span(name, items, **attributes) as s:
+            yield s
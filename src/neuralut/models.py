@@ -0,0 +1,297 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+from functools import reduce
+from os.path import realpath
+
+import torch
+import torch.nn as nn
+
+from brevitas.core.quant import QuantType
+from brevitas.core.scaling import ScalingImplType
+from brevitas.nn import QuantHardTanh, QuantReLU
+
+from pyverilator import PyVerilator
+
+from .instrument import span
+from .quant import QuantBrevitasActivation
+from .nn import (
+    SparseLinearNeq,
+    ScalarBiasScale,
+    FeatureMask,
+)
+
+
+# The optional per-layer lists neuron_fanins / channel_bitwidths of a model
+# config can also be given as the path to a JSON file (e.g., on the command
+# line), load them in place
+def load_layer_lists(model_config: dict) -> dict:
+    for k in ("neuron_fanins", "channel_bitwidths"):
+        if isinstance(model_config.get(k), str):
+            with open(model_config[k]) as f:
+                model_config[k] = json.load(f)
+    return model_config
+
+
+# A feed-forward stack of SparseLinearNeqs, as used for all datasets, which
+# can also be evaluated by simulating its generated Verilog with Verilator.
+class NeqModel(nn.Module):
+    def __init__(self, model_config):
+        super(NeqModel, self).__init__()
+        self.model_config = model_config
+        self.is_cuda = model_config["cuda"]
+        self.num_neurons = (
+            [model_config["input_length"]]
+            + model_config["hidden_layers"]
+            + [model_config["output_length"]]
+        )
+        # Connectivity options of the FeatureMasks, see FeatureMask
+        mask_config = {
+            k: model_config[k]
+            for k in ["connectivity", "max_fanout", "cover_inputs", "group_neurons"]
+            if model_config.get(k) is not None
+        }
+        # Reordering the output neurons would permute the classes
+        output_mask_config = {
+            k: v for k, v in mask_config.items() if k != "group_neurons"
+        }
+        layer_list = []
+        for i in range(1, len(self.num_neurons)):
+            in_features = self.num_neurons[i - 1]
+            out_features = self.num_neurons[i]
+            bn = nn.BatchNorm1d(out_features)
+            if i == 1:
+                bn_in = nn.BatchNorm1d(in_features)
+                input_bias = ScalarBiasScale(scale=False, bias_init=-0.25)
+                input_quant = QuantBrevitasActivation(
+                    QuantHardTanh(
+                        model_config["input_bitwidth"],
+                        max_val=1.0,
+                        narrow_range=False,
+                        quant_type=QuantType.INT,
+                        scaling_impl_type=ScalingImplType.PARAMETER,
+                    ),
+                    pre_transforms=[bn_in, input_bias],
+                )
+                output_quant = QuantBrevitasActivation(
+                    QuantReLU(
+                        bit_width=model_config["hidden_bitwidth"],
+                        max_val=1.61,
+                        quant_type=QuantType.INT,
+                        scaling_impl_type=ScalingImplType.PARAMETER,
+                    ),
+                    pre_transforms=[bn],
+                )
+                imask = FeatureMask(
+                    in_features,
+                    out_features,
+                    fan_in=model_config["input_fanin"],
+                    cuda=model_config["cuda"],
+                    **mask_config,
+                )
+                layer = SparseLinearNeq(
+                    in_features,
+                    out_features,
+                    input_quant=input_quant,
+                    output_quant=output_quant,
+                    imask=imask,
+                    fan_in=model_config["input_fanin"],
+                    width_n=model_config["width_n"],
+                    cuda=model_config["cuda"],
+                )
+                layer_list.append(layer)
+            elif i == len(self.num_neurons) - 1:
+                output_bias_scale = ScalarBiasScale(bias_init=0.33)
+                output_quant = QuantBrevitasActivation(
+                    QuantHardTanh(
+                        bit_width=model_config["output_bitwidth"],
+                        max_val=1.33,
+                        narrow_range=False,
+                        quant_type=QuantType.INT,
+                        scaling_impl_type=ScalingImplType.PARAMETER,
+                    ),
+                    pre_transforms=[bn],
+                    post_transforms=[output_bias_scale],
+                )
+                imask = FeatureMask(
+                    in_features,
+                    out_features,
+                    fan_in=model_config["output_fanin"],
+                    cuda=model_config["cuda"],
+                    **output_mask_config,
+                )
+                layer = SparseLinearNeq(
+                    in_features,
+                    out_features,
+                    input_quant=layer_list[-1].output_quant,
+                    output_quant=output_quant,
+                    imask=imask,
+                    fan_in=model_config["output_fanin"],
+                    width_n=model_config["width_n"],
+                    apply_input_quant=False,
+                    cuda=model_config["cuda"],
+                )
+                layer_list.append(layer)
+            else:
+                output_quant = QuantBrevitasActivation(
+                    QuantReLU(
+                        bit_width=model_config["hidden_bitwidth"],
+                        max_val=1.61,
+                        quant_type=QuantType.INT,
+                        scaling_impl_type=ScalingImplType.PARAMETER,
+                    ),
+                    pre_transforms=[bn],
+                )
+                imask = FeatureMask(
+                    in_features,
+                    out_features,
+                    fan_in=model_config["hidden_fanin"],
+                    cuda=model_config["cuda"],
+                    **mask_config,
+                )
+                layer = SparseLinearNeq(
+                    in_features,
+                    out_features,
+                    input_quant=layer_list[-1].output_quant,
+                    output_quant=output_quant,
+                    imask=imask,
+                    fan_in=model_config["hidden_fanin"],
+                    width_n=model_config["width_n"],
+                    apply_input_quant=False,
+                    cuda=model_config["cuda"],
+                )
+                layer_list.append(layer)
+        self.module_list = nn.ModuleList(layer_list)
+        # Optional per-layer lists of per-neuron fan-ins (<= the layer's fan-in) and
+        # of per-channel bitwidths of each layer's input (<= its quantizer's bitwidth)
+        for layer, fan_ins in zip(
+            self.module_list, model_config.get("neuron_fanins") or []
+        ):
+            if fan_ins is not None:
+                layer.imask.set_fan_ins(fan_ins)
+        for layer, bitwidths in zip(
+            self.module_list, model_config.get("channel_bitwidths") or []
+        ):
+            if bitwidths is not None:
+                layer.input_quant.set_channel_bitwidths(bitwidths)
+        self.is_verilog_inference = False
+        self.latency = 1
+        self.verilog_dir = None
+        self.top_module_filename = None
+        self.dut = None
+        self.logfile = None
+        self.is_quantized_input = False
+
+    def verilog_inference(
+        self,
+        verilog_dir,
+        top_module_filename,
+        logfile: str = None,
+        add_registers: bool = False,
+    ):
+        self.verilog_dir = realpath(verilog_dir)
+        self.top_module_filename = top_module_filename
+        with span("verilator_build"):
+            self.dut = PyVerilator.build(
+                f"{self.verilog_dir}/{self.top_module_filename}",
+                verilog_path=[self.verilog_dir],
+                build_dir=f"{self.verilog_dir}/verilator",
+            )
+        self.is_verilog_inference = True
+        self.logfile = logfile
+        if add_registers:
+            self.latency = len(self.num_neurons)
+
+    def pytorch_inference(self):
+        self.is_verilog_inference = False
+
+    # Feed the model with the integer codes of the first layer's input
+    # quantizer (e.g., from a QuantizedMnistDataset) rather than raw inputs.
+    # Only valid in LUT-based or Verilog-based inference.
+    def quantized_input(self, enabled: bool = True):
+        self.is_quantized_input = enabled
+        self.module_list[0].apply_input_quant = not enabled
+
+    def verilog_forward(self, x):
+        with span("verilog_forward", items=x.shape[0]):
+            return self._verilog_forward(x)
+
+    def _verilog_forward(self, x):
+        # Get integer output from the first layer
+        input_quant = self.module_list[0].input_quant
+        output_quant = self.module_list[-1].output_quant
+        input_bitwidths = input_quant.get_channel_bitwidths(self.module_list[0].in_features)
+        output_bitwidths = output_quant.get_channel_bitwidths(self.module_list[-1].out_features)
+        _, output_bitwidth = output_quant.get_scale_factor_bits()
+        output_bitwidth = int(output_bitwidth)
+        total_input_bits = sum(input_bitwidths)
+        total_output_bits = sum(output_bitwidths)
+        num_layers = len(self.module_list)
+        input_quant.bin_output()
+        self.module_list[0].apply_input_quant = False
+        y = torch.zeros(x.shape[0], self.module_list[-1].out_features)
+        if not self.is_quantized_input:
+            x = input_quant(x)
+        self.dut.io.rst = 0
+        self.dut.io.clk = 0
+        for i in range(x.shape[0]):
+            x_i = x[i, :]
+            y_i = self.pytorch_forward(x[i : i + 1, :])[0]
+            xv_i = [input_quant.get_bin_str_from_int(z, self.is_cuda, channel=c) for c, z in enumerate(x_i)]
+            ys_i = [output_quant.get_bin_str_from_int(z, self.is_cuda, channel=c) for c, z in enumerate(y_i)]
+            xvc_i = reduce(lambda a, b: a + b, xv_i[::-1])
+            ysc_i = reduce(lambda a, b: a + b, ys_i[::-1])
+            self.dut["M0"] = int(xvc_i, 2)
+            for j in range(self.latency + 1):
+                res = self.dut[f"M{num_layers}"]
+                result = f"{res:0{int(total_output_bits)}b}"
+                self.dut.io.clk = 1
+                self.dut.io.clk = 0
+            expected = f"{int(ysc_i,2):0{int(total_output_bits)}b}"
+            result = f"{res:0{int(total_output_bits)}b}"
+            assert expected == result
+            # Split the result into the outputs, the first output is in the LSBs.
+            # Reduced outputs are shifted back to the full bitwidth.
+            res_split = []
+            end = len(result)
+            for c, bits in enumerate(output_bitwidths):
+                res_split.append(int(result[end - bits : end], 2) << (output_bitwidth - bits))
+                end -= bits
+            yv_i = torch.Tensor(res_split)
+            y[i, :] = yv_i
+            # Dump the I/O pairs
+            if self.logfile is not None:
+                with open(self.logfile, "a") as f:
+                    f.write(
+                        f"{int(xvc_i,2):0{int(total_input_bits)}b}{int(ysc_i,2):0{int(total_output_bits)}b}\n"
+                    )
+        return y
+
+    def pytorch_forward(self, x):
+        for l in self.module_list:
+            x = l(x)
+        return x
+
+    def forward(self, x):
+        if self.is_verilog_inference:
+            return self.verilog_forward(x)
+        else:
+            return self.pytorch_forward(x)
+
@@ -29,7 +29,14 @@ import itertools
 import math, os
 import numpy as np
 
-from .init import random_restrict_fanin
+from .init import (
+    random_fanin_indices,
+    local_fanin_indices,
+    balanced_fanin_indices,
+    rebalance_fanin_indices,
+    group_fanin_indices,
+    random_restrict_fanin,
+)
 from .util import fetch_mask_indices, generate_permutation_matrix
 from .verilog import (
     generate_lut_verilog,
@@ -39,22 +46,56 @@ from .verilog import (
     generate_register_verilog,
 )
 from .bench import generate_lut_bench, generate_lut_input_string, sort_to_bench
+from .instrument import span
 
 # TODO: Create a container module which performs this function.
 # Generate all truth tables for NEQs for a given nn.Module()
-def generate_truth_tables(model: nn.Module, verbose: bool = False) -> None:
+def generate_truth_tables(
+    model: nn.Module, verbose: bool = False, fold_thresholds: bool = False
+) -> None:
     training = model.training
     model.eval()
+    with span("generate_truth_tables"):
+        for name, module in model.named_modules():
+            if type(module) == SparseLinearNeq:
+                if verbose:
+                    print(f"Calculating truth tables for {name}")
+                with span("truth_tables", layer=name) as s:
+                    module.calculate_truth_tables(fold_thresholds=fold_thresholds)
+                    s.add_items(sum(len(t[1]) for t in module.neuron_truth_tables))
+                if verbose:
+                    print(
+                        f"Truth tables generated for {len(module.neuron_truth_tables)} neurons"
+                    )
+    model.training = training
+
+
+# Store the truth tables of all NEQs of a model, so that they can be restored
+# with load_truth_tables() rather than generated again
+def save_truth_tables(model: nn.Module, path: str) -> None:
+    truth_tables = {}
     for name, module in model.named_modules():
         if type(module) == SparseLinearNeq:
-            if verbose:
-                print(f"Calculating truth tables for {name}")
-            module.calculate_truth_tables()
-            if verbose:
-                print(
-                    f"Truth tables generated for {len(module.neuron_truth_tables)} neurons"
+            if module.neuron_truth_tables is None:
+                raise Exception(f"The truth tables of {name} have not been generated")
+            truth_tables[name] = (module.neuron_truth_tables, module.output_thresholds)
+    torch.save(truth_tables, path)
+
+
+def load_truth_tables(model: nn.Module, path: str) -> None:
+    device = "cuda" if next(model.parameters()).is_cuda else "cpu"
+    truth_tables = torch.load(path, map_location=device)
+    for name, module in model.named_modules():
+        if type(module) == SparseLinearNeq:
+            if name not in truth_tables:
+                raise Exception(f"No truth tables found for {name} in {path}")
+            neuron_truth_tables, output_thresholds = truth_tables[name]
+            if len(neuron_truth_tables) != module.out_features:
+                raise Exception(
+                    f"Expected truth tables for {module.out_features} neurons in {name}, {len(neuron_truth_tables)} found"
                 )
-    model.training = training
+            module.neuron_truth_tables = neuron_truth_tables
+            module.output_thresholds = output_thresholds
 
 
 # TODO: Create a container module which performs this function.
@@ -71,6 +112,104 @@ def neq_inference(model: nn.Module) -> None:
             module.neq_inference()
 
 
+# TODO: Create a container module which performs this function.
+def set_compute_dtype(model: nn.Module, dtype) -> None:
+    for name, module in model.named_modules():
+        if type(module) == SparseLinearNeq:
+            module.set_compute_dtype(dtype)
+
+
+# TODO: Create a container module which performs this function.
+def compile_subnetworks(model: nn.Module, **kwargs) -> None:
+    for name, module in model.named_modules():
+        if type(module) == SparseLinearNeq:
+            module.compile_subnetwork(**kwargs)
+
+
+# The fanout distribution of the inputs of each NEQ, i.e., to how many of its
+# neurons each input is connected. histogram[k] counts the inputs with fanout k.
+def fanout_report(model: nn.Module, verbose: bool = False) -> dict:
+    report = {}
+    for name, module in model.named_modules():
+        if type(module) == SparseLinearNeq:
+            fanout = module.imask.fanout()
+            report[name] = {
+                "min": int(fanout.min()),
+                "max": int(fanout.max()),
+                "mean": float(fanout.double().mean()),
+                "unused": int((fanout == 0).sum()),
+                "histogram": torch.bincount(fanout).tolist(),
+            }
+            if verbose:
+                print(
+                    f"{name}: fanout min {report[name]['min']}, max {report[name]['max']}, "
+                    f"mean {report[name]['mean']:.2f}, {report[name]['unused']}/{module.in_features} inputs unused"
+                )
+    return report
+
+
+# Remove the neurons whose outputs are not connected to any neuron of the next
+# layer, starting from the outputs (whose neurons are all kept), and renumber
+# the inputs of the following layers. The pruned module_list computes the same
+# function. The model inputs can not be removed, the unused ones are reported.
+def prune_dead_neurons(module_list: nn.ModuleList, verbose: bool = False) -> dict:
+    for m in module_list:
+        if type(m) != SparseLinearNeq:
+            raise Exception(f"Expect type(module) == SparseLinearNeq, {type(m)} found")
+    last = module_list[-1]
+    report = {"neurons": [None] * len(module_list)}
+    report["neurons"][-1] = (last.out_features, last.out_features)
+    for i in reversed(range(len(module_list) - 1)):
+        layer, next_layer = module_list[i], module_list[i + 1]
+        num_neurons = layer.out_features
+        live = torch.zeros(num_neurons, dtype=torch.bool)
+        live[next_layer.imask.imask[next_layer.imask.slot_mask()].cpu()] = True
+        neurons = live.nonzero(as_tuple=True)[0]
+        mapping = torch.full((num_neurons,), -1, dtype=torch.int64)
+        mapping[neurons] = torch.arange(len(neurons))
+        layer.select_neurons(neurons)
+        next_layer.remap_inputs(mapping, len(neurons))
+        report["neurons"][i] = (num_neurons, len(neurons))
+    used = module_list[0].imask.fanout() > 0
+    report["unused_inputs"] = (~used).nonzero(as_tuple=True)[0].tolist()
+    if verbose:
+        for i, (before, after) in enumerate(report["neurons"]):
+            print(f"Layer {i}: kept {after}/{before} neurons")
+        print(
+            f"{len(report['unused_inputs'])}/{len(used)} model inputs are unused: {report['unused_inputs']}"
+        )
+    return report
+
+
+# Check how many truth table entries of each NEQ would differ if the
+# sub-networks were evaluated in compute_dtype instead of fp32.
+# Returns {name: (mismatched entries, total entries)}.
+def compare_truth_tables(model: nn.Module, compute_dtype) -> dict:
+    training = model.training
+    model.eval()
+    mismatches = {}
+    for name, module in model.named_modules():
+        if type(module) == SparseLinearNeq:
+            num_entries = sum(module.get_truth_table_sizes())
+            mismatches[name] = (
+                module.count_truth_table_mismatches(compute_dtype),
+                num_entries,
+            )
+    model.train(training)
+    return mismatches
+
+
+# Quantize x [N, C] given per-channel thresholds, as returned by
+# QuantBrevitasActivation.get_thresholds()
+def threshold_quantize(
+    x: Tensor, sign: Tensor, thresholds: Tensor, min_code: int
+) -> Tensor:
+    sign = sign.to(x.device)
+    thresholds = thresholds.to(x.device)
+    x = (x.double() * sign).unsqueeze(-1)  # N x C x 1
+    return (x >= thresholds.unsqueeze(0)).sum(dim=-1) + min_code
+
+
 # TODO: Should this go in with the other verilog functions?
 # TODO: Support non-linear topologies
 def module_list_to_verilog_module(
@@ -79,6 +218,15 @@ def module_list_to_verilog_module(
     output_directory: str,
     add_registers: bool = True,
     generate_bench: bool = False,
+):
+    with span("verilog_export"):
+        _module_list_to_verilog_module(
+            module_list, module_name, output_directory, add_registers, generate_bench
+        )
+
+
+def _module_list_to_verilog_module(
+    module_list, module_name, output_directory, add_registers, generate_bench
 ):
     input_bitwidth = None
     output_bitwidth = None
@@ -87,9 +235,10 @@ def module_list_to_verilog_module(
         m = module_list[i]
         if type(m) == SparseLinearNeq:
             module_prefix = f"layer{i}"
-            module_input_bits, module_output_bits = m.gen_layer_verilog(
-                module_prefix, output_directory, generate_bench=generate_bench
-            )
+            with span("layer_verilog", items=m.out_features, layer=module_prefix):
+                module_input_bits, module_output_bits = m.gen_layer_verilog(
+                    module_prefix, output_directory, generate_bench=generate_bench
+                )
             if i == 0:
                 input_bitwidth = module_input_bits
             elif i == len(module_list) - 1:
@@ -122,6 +271,15 @@ def module_list_to_verilog_module(
         f.write(module_list_verilog)
 
 
+# Keep only the given rows (outputs) of a SparseLinear
+def _select_rows(linear: nn.Linear, rows: Tensor) -> None:
+    rows = rows.to(linear.weight.device)
+    linear.weight = Parameter(linear.weight.detach()[rows].clone())
+    if linear.bias is not None:
+        linear.bias = Parameter(linear.bias.detach()[rows].clone())
+    linear.out_features = len(rows)
+
+
 class SparseLinear(nn.Linear):
     def __init__(
         self,
@@ -134,7 +292,9 @@ class SparseLinear(nn.Linear):
         )
 
     def forward(self, input: Tensor) -> Tensor:
-        return (input * self.weight).sum(dim=-1) + self.bias
+        # Cast the parameters to the dtype of the input, e.g., for bf16 compute
+        weight, bias = self.weight.to(input.dtype), self.bias.to(input.dtype)
+        return (input * weight).sum(dim=-1) + bias
 
 
 # TODO: Perhaps make this two classes, separating the LUT and NEQ code.
@@ -171,19 +331,19 @@ class SparseLinearNeq(nn.Module):
         self.output_quant = output_quant
         self.is_lut_inference = False
         self.neuron_truth_tables = None
+        self.output_thresholds = None
         self.apply_input_quant = apply_input_quant
         self.apply_output_quant = apply_output_quant
         self.cuda = cuda
+        self.compute_dtype = None  # If set, the dtype used by the sub-networks
 
     # TODO: Move the verilog string templates to elsewhere
     # TODO: Move this to another class
-    # TODO: Update this code to support custom bitwidths per input/output
     def gen_layer_verilog(self, module_prefix, directory, generate_bench: bool = True):
-        _, input_bitwidth = self.input_quant.get_scale_factor_bits()
-        _, output_bitwidth = self.output_quant.get_scale_factor_bits()
-        input_bitwidth, output_bitwidth = int(input_bitwidth), int(output_bitwidth)
-        total_input_bits = self.in_features * input_bitwidth
-        total_output_bits = self.out_features * output_bitwidth
+        input_bitwidths = self.input_quant.get_channel_bitwidths(self.in_features)
+        output_bitwidths = self.output_quant.get_channel_bitwidths(self.out_features)
+        total_input_bits = sum(input_bitwidths)
+        total_output_bits = sum(output_bitwidths)
         layer_contents = f"module {module_prefix} (input [{total_input_bits-1}:0] M0, output [{total_output_bits-1}:0] M1);\n\n"
         output_offset = 0
         for index in range(self.out_features):
@@ -201,10 +361,12 @@ class SparseLinearNeq(nn.Module):
                 with open(f"{directory}/{module_name}.bench", "w") as f:
                     f.write(neuron_bench)
             connection_string = generate_neuron_connection_verilog(
-                indices, input_bitwidth
+                indices, input_bitwidths
             )  # Generate the string which connects the synapses to this neuron
+            neuron_input_bits = sum(input_bitwidths[int(i)] for i in indices)
+            output_bitwidth = output_bitwidths[index]
             wire_name = f"{module_name}_wire"
-            connection_line = f"wire [{len(indices)*input_bitwidth-1}:0] {wire_name} = {{{connection_string}}};\n"
+            connection_line = f"wire [{neuron_input_bits-1}:0] {wire_name} = {{{connection_string}}};\n"
             inst_line = f"{module_name} {module_name}_inst (.M0({wire_name}), .M1(M1[{output_offset+output_bitwidth-1}:{output_offset}]));\n\n"
             layer_contents += connection_line + inst_line
             output_offset += output_bitwidth
@@ -222,17 +384,18 @@ class SparseLinearNeq(nn.Module):
             float_output_states,
             bin_output_states,
         ) = self.neuron_truth_tables[index]
-        _, input_bitwidth = self.input_quant.get_scale_factor_bits()
-        _, output_bitwidth = self.output_quant.get_scale_factor_bits()
-        cat_input_bitwidth = len(indices) * input_bitwidth
+        channels = [int(i) for i in indices]
+        input_bitwidths = self.input_quant.get_channel_bitwidths(self.in_features)
+        output_bitwidth = self.output_quant.get_channel_bitwidths(self.out_features)[index]
+        cat_input_bitwidth = sum(input_bitwidths[c] for c in channels)
         lut_string = ""
         num_entries = input_perm_matrix.shape[0]
         for i in range(num_entries):
             entry_str = ""
             for idx in range(len(indices)):
                 val = input_perm_matrix[i, idx]
-                entry_str += self.input_quant.get_bin_str_from_int(val, is_cuda=self.cuda)
-            res_str = self.output_quant.get_bin_str_from_int(bin_output_states[i], is_cuda=self.cuda)
+                entry_str += self.input_quant.get_bin_str_from_int(val, is_cuda=self.cuda, channel=channels[idx])
+            res_str = self.output_quant.get_bin_str_from_int(bin_output_states[i], is_cuda=self.cuda, channel=index)
             lut_string += f"\t\t\t{int(cat_input_bitwidth)}'b{entry_str}: M1r = {int(output_bitwidth)}'b{res_str};\n"
         return generate_lut_verilog(
             module_name, int(cat_input_bitwidth), int(output_bitwidth), lut_string
@@ -247,15 +410,19 @@ class SparseLinearNeq(nn.Module):
             float_output_states,
             bin_output_states,
         ) = self.neuron_truth_tables[index]
-        _, input_bitwidth = self.input_quant.get_scale_factor_bits()
-        _, output_bitwidth = self.output_quant.get_scale_factor_bits()
-        cat_input_bitwidth = len(indices) * input_bitwidth
+        channels = [int(i) for i in indices]
+        input_bitwidths = self.input_quant.get_channel_bitwidths(self.in_features)
+        output_bitwidth = self.output_quant.get_channel_bitwidths(self.out_features)[index]
+        cat_input_bitwidth = sum(input_bitwidths[c] for c in channels)
         lut_string = ""
         num_entries = input_perm_matrix.shape[0]
         # Sort the input_perm_matrix to match the bench format
         input_state_space_bin_str = list(
             map(
-                lambda y: list(map(lambda z: self.input_quant.get_bin_str_from_int(z, is_cuda=self.cuda), y)),
+                lambda y: [
+                    self.input_quant.get_bin_str_from_int(z, is_cuda=self.cuda, channel=c)
+                    for z, c in zip(y, channels)
+                ],
                 input_perm_matrix,
             )
         )
@@ -268,7 +435,7 @@ class SparseLinearNeq(nn.Module):
             output_bin_str = reduce(
                 lambda b, c: b + c,
                 map(
-                    lambda a: self.output_quant.get_bin_str_from_int(a, is_cuda=self.cuda)[
+                    lambda a: self.output_quant.get_bin_str_from_int(a, is_cuda=self.cuda, channel=index)[
                         int(output_bitwidth) - 1 - i
                     ],
                     sorted_bin_output_states,
@@ -291,6 +458,55 @@ class SparseLinearNeq(nn.Module):
         self.input_quant.float_output()
         self.output_quant.float_output()
 
+    # Run the sub-networks in a reduced precision dtype (e.g., torch.bfloat16),
+    # the quantizers and their BatchNorms stay in fp32. Pass None to disable.
+    # Truth tables are always calculated in fp32.
+    def set_compute_dtype(self, dtype):
+        self.compute_dtype = dtype
+
+    # Keep only the given neurons (a sorted tensor of indices) of this layer.
+    # The inputs of the next layer must be renumbered with remap_inputs().
+    def select_neurons(self, neurons: Tensor) -> None:
+        neurons = neurons.cpu()
+        rows = (
+            neurons.unsqueeze(1) * self.width_n + torch.arange(self.width_n)
+        ).flatten()
+        for fc in [self.fc1, self.fc2, self.fc3, self.res0]:
+            _select_rows(fc, rows)
+        for fc in [self.fc4, self.res1]:
+            _select_rows(fc, neurons)
+        self.output_quant.select_channels(neurons)
+        self.imask.imask = self.imask.imask[neurons.to(self.imask.imask.device)].clone()
+        self.imask.fan_ins = self.imask.fan_ins[neurons.to(self.imask.fan_ins.device)].clone()
+        self.imask.out_features = len(neurons)
+        if self.neuron_truth_tables is not None:
+            self.neuron_truth_tables = [
+                self.neuron_truth_tables[n] for n in neurons.tolist()
+            ]
+        if self.output_thresholds is not None:
+            sign, thresholds, min_code = self.output_thresholds
+            self.output_thresholds = (sign[neurons], thresholds[neurons], min_code)
+        self.out_features = len(neurons)
+
+    # Renumber the inputs of this layer, mapping[i] is the new index of input i,
+    # or -1 if it was removed.
+    def remap_inputs(self, mapping: Tensor, in_features: int) -> None:
+        # Point the padding slots at a connected input, so they stay valid
+        imask = torch.where(
+            self.imask.slot_mask(), self.imask.imask, self.imask.imask[:, :1]
+        )
+        imask = mapping.to(imask.device)[imask]
+        if (imask < 0).any():
+            raise Exception("Cannot remove an input which is still connected")
+        self.imask.imask = imask
+        self.imask.in_features = in_features
+        self.in_features = in_features
+        if self.neuron_truth_tables is not None:
+            self.neuron_truth_tables = [
+                (mapping.to(t[0].device)[t[0]],) + tuple(t[1:])
+                for t in self.neuron_truth_tables
+            ]
+
     # TODO: This function might be a useful utility outside of this class..
     def table_lookup(
         self,
@@ -298,7 +514,7 @@ class SparseLinearNeq(nn.Module):
         input_perm_matrix: Tensor,
         bin_output_states: Tensor,
     ) -> Tensor:
-        fan_in_size = self.fan_in
+        fan_in_size = input_perm_matrix.shape[1]
         ci_bcast = connected_input.unsqueeze(2)  # Reshape to B x Fan-in x 1
         if self.cuda:
             ci_bcast = ci_bcast.cuda()
@@ -345,164 +561,376 @@ class SparseLinearNeq(nn.Module):
             )
         return y
 
+    # The per-neuron sub-networks, evaluated for all neurons at once.
+    # x holds the connected inputs of each neuron, [B, out_features, fan_in],
+    # and the pre-quantization output [B, out_features] is returned.
+    # All shapes only depend on the layer configuration (the batch dimension is
+    # left to reshape), so this can be traced or compiled, see compile_subnetwork().
+    def subnetwork(self, x: Tensor) -> Tensor:
+        # Compute in the dtype of the parameters (e.g., for the fp16 permutation
+        # matrices), unless a compute_dtype is set, and return that dtype
+        dtype = self.fc1.weight.dtype
+        x = x.to(self.compute_dtype if self.compute_dtype is not None else dtype)
+        if self.imask.is_heterogeneous:
+            # Zero the padding slots of neurons with a reduced fan-in
+            x = x * self.imask.slot_mask().to(x.dtype)
+        out_features, width_n, fan_in = self.out_features, self.width_n, self.fan_in
+        # Each row of fc1 / res0 sees all of the inputs of its neuron
+        x = x.unsqueeze(2).expand(-1, out_features, width_n, fan_in)
+        x = x.reshape(-1, out_features * width_n, fan_in)
+        residual0 = self.res0(x)
+        x = self.fc1(x)
+        x = self.relu(x)
+        # Each row of fc2 sees all of the hidden units of its neuron
+        x = x.reshape(-1, out_features, 1, width_n)
+        x = x.expand(-1, out_features, width_n, width_n)
+        x = x.reshape(-1, out_features * width_n, width_n)
+        x = self.fc2(x)
+        x = x + residual0
+        x = self.relu(x)
+        x = x.reshape(-1, out_features, width_n)
+        residual1 = self.res1(x)
+        x = x.unsqueeze(2).expand(-1, out_features, width_n, width_n)
+        x = x.reshape(-1, out_features * width_n, width_n)
+        x = self.fc3(x)
+        x = self.relu(x)
+        x = x.reshape(-1, out_features, width_n)
+        x = self.fc4(x)
+        x = x + residual1
+        return x.to(dtype)
+
+    # Replace the sub-networks of this layer with a compiled version, the keyword
+    # arguments are passed to torch.compile. The quantizers are left in eager mode.
+    def compile_subnetwork(self, **kwargs):
+        self.subnetwork = torch.compile(self.subnetwork, **kwargs)
+
     def forward(self, x: Tensor) -> Tensor:
         if self.is_lut_inference:
             x = self.lut_forward(x)
         else:
             if self.apply_input_quant:
                 x = self.input_quant(x)
-            x = x[:, self.imask()]
-            x = x.repeat(1,1,self.width_n).reshape(x.size(0), x.size(1)*self.width_n, self.fan_in)
-            residual0 = self.res0(x)
-            x = self.fc1(x)
-            x = self.relu(x)
-            x = x.reshape(x.size(0), int(x.size(1)/self.width_n), self.width_n)
-            x = x.repeat(1,1,self.width_n).reshape(x.size(0), x.size(1)*self.width_n, self.width_n)
-            x = self.fc2(x)
-            x = x + residual0
-            x = self.relu(x)
-            x = x.reshape(x.size(0), int(x.size(1)/self.width_n), self.width_n)
-            residual1 = self.res1(x)
-            x = x.repeat(1,1,self.width_n).reshape(x.size(0), x.size(1)*self.width_n, self.width_n)
-            x = self.fc3(x)
-            x = self.relu(x)
-            x = x.reshape(x.size(0), int(x.size(1)/self.width_n), self.width_n)
-            x = self.fc4(x)
-            x = x + residual1
+            x = self.subnetwork(x[:, self.imask()])
             if self.apply_output_quant:
                 x = self.output_quant(x)
         return x
 
+    # x is either [B, fan_in], the same inputs for all neurons, or
+    # [B, out_features, fan_in] with the inputs of each neuron
     def forward_to_fill_luts(self, x: Tensor) -> Tensor:
         if self.apply_input_quant:
             x = self.input_quant(x)
-        x = x.repeat(1, self.out_features)
-        x = x.reshape(x.shape[0], self.out_features, self.fan_in)
-        x = x.repeat(1,1,self.width_n).reshape(x.size(0), x.size(1)*self.width_n, self.fan_in)
-        residual0 = self.res0(x)
-        x = self.fc1(x)
-        x = self.relu(x)
-        x = x.reshape(x.size(0), int(x.size(1)/self.width_n), self.width_n)
-        x = x.repeat(1,1,self.width_n).reshape(x.size(0), x.size(1)*self.width_n, self.width_n)
-        x = self.fc2(x)
-        x = x + residual0
-        x = self.relu(x)
-        x = x.reshape(x.size(0), int(x.size(1)/self.width_n), self.width_n)
-        residual1 = self.res1(x)
-        x = x.repeat(1,1,self.width_n).reshape(x.size(0), x.size(1)*self.width_n, self.width_n)
-        x = self.fc3(x)
-        x = self.relu(x)
-        x = x.reshape(x.size(0), int(x.size(1)/self.width_n), self.width_n)
-        x = self.fc4(x)
-        x = x + residual1
+        if x.dim() == 2:
+            x = x.unsqueeze(1).expand(-1, self.out_features, -1)
+        x = self.subnetwork(x)
         if self.apply_output_quant:
             x = self.output_quant(x)
         return x
 
-    # Consider using masked_select instead of fetching the indices
-    def calculate_truth_tables(self):
-        with torch.no_grad():
-            # Precalculate all of the input value permutations
-            input_state_space = list()  # TODO: is a list the right data-structure here?
-            bin_state_space = list()
-            neuron_state_space = (
-                self.input_quant.get_state_space(is_cuda=self.cuda)
-            )  # TODO: this call should include the index of the element of interest
-            bin_space = (
-                self.input_quant.get_bin_state_space(is_cuda=self.cuda)
-            )  # TODO: this call should include the index of the element of interest
-            input_state_space.append(neuron_state_space)
-            bin_state_space.append(bin_space)
-            neuron_truth_tables = list()
+    # Return matrices of all possible input states of a neuron, as float values
+    # and as their binary (integer) representation
+    def get_input_permutation_matrices(self):
+        # Precalculate all of the input value permutations
+        input_state_space = list()  # TODO: is a list the right data-structure here?
+        bin_state_space = list()
+        neuron_state_space = (
+            self.input_quant.get_state_space(is_cuda=self.cuda)
+        )  # TODO: this call should include the index of the element of interest
+        bin_space = (
+            self.input_quant.get_bin_state_space(is_cuda=self.cuda)
+        )  # TODO: this call should include the index of the element of interest
+        input_state_space.append(neuron_state_space)
+        bin_state_space.append(bin_space)
+
+        # Retrieve the possible state space of the current neuron
+        connected_state_space = [input_state_space[0] for i in range(self.fan_in)]
+        bin_connected_state_space = [bin_state_space[0] for i in range(self.fan_in)]
+        # Generate a matrix containing all possible input states
+        input_permutation_matrix = generate_permutation_matrix(
+            connected_state_space, self.cuda
+        )  # matrix of all input combinations
+        if self.cuda:
+            input_permutation_matrix = input_permutation_matrix.cuda()
+        bin_input_permutation_matrix = generate_permutation_matrix(
+            bin_connected_state_space, self.cuda
+        )
+        return input_permutation_matrix, bin_input_permutation_matrix
+
+    # The number of entries in the truth table of each neuron
+    def get_truth_table_sizes(self) -> list:
+        imask = self.imask.imask.cpu()
+        fan_ins = self.imask.fan_ins.tolist()
+        num_states = {}
+        sizes = []
+        for n in range(self.out_features):
+            size = 1
+            for c in imask[n, : fan_ins[n]].tolist():
+                if c not in num_states:
+                    _, bin_state_space = self.input_quant.get_channel_state_spaces(
+                        c, is_cuda=False
+                    )
+                    num_states[c] = bin_state_space.nelement()
+                size *= num_states[c]
+            sizes.append(size)
+        return sizes
+
+    # Whether all neurons have the full fan-in and all inputs the full bitwidth,
+    # i.e., whether all neurons share the same input states
+    def is_uniform(self) -> bool:
+        return not (
+            self.imask.is_heterogeneous or self.input_quant.has_channel_bitwidths()
+        )
 
-            # Retrieve the possible state space of the current neuron
-            connected_state_space = [input_state_space[0] for i in range(self.fan_in)]
-            bin_connected_state_space = [bin_state_space[0] for i in range(self.fan_in)]
-            # Generate a matrix containing all possible input states
-            input_permutation_matrix = generate_permutation_matrix(
-                connected_state_space, self.cuda
-            )  # matrix of all input combinations
-            if self.cuda:
-                input_permutation_matrix = input_permutation_matrix.cuda()
-            bin_input_permutation_matrix = generate_permutation_matrix(
-                bin_connected_state_space, self.cuda
+    # The input states of every neuron: a float matrix [P, out_features, fan_in]
+    # to evaluate all of the sub-networks on at once, and a list with the binary
+    # matrix [P_n, fan_ins[n]] of the P_n <= P input states of each neuron.
+    # Rows P_n and above of neuron n in the float matrix are padding.
+    def get_neuron_permutation_matrices(self):
+        if self.is_uniform():
+            (
+                input_permutation_matrix,
+                bin_input_permutation_matrix,
+            ) = self.get_input_permutation_matrices()
+            return (
+                input_permutation_matrix.unsqueeze(1).expand(-1, self.out_features, -1),
+                [bin_input_permutation_matrix] * self.out_features,
             )
+        fan_ins = self.imask.fan_ins.tolist()
+        imask = self.imask.imask.cpu()
+        channel_state_spaces = {}
+        input_permutation_matrices, bin_input_permutation_matrices = [], []
+        for n in range(self.out_features):
+            connected_state_space, bin_connected_state_space = [], []
+            for c in imask[n, : fan_ins[n]].tolist():
+                if c not in channel_state_spaces:
+                    channel_state_spaces[c] = self.input_quant.get_channel_state_spaces(
+                        c, is_cuda=self.cuda
+                    )
+                connected_state_space.append(channel_state_spaces[c][0])
+                bin_connected_state_space.append(channel_state_spaces[c][1])
+            input_permutation_matrices.append(
+                generate_permutation_matrix(connected_state_space, self.cuda)
+            )
+            bin_input_permutation_matrices.append(
+                generate_permutation_matrix(bin_connected_state_space, self.cuda)
+            )
+        num_states = max(len(m) for m in input_permutation_matrices)
+        input_permutation_matrix = torch.zeros(
+            (num_states, self.out_features, self.fan_in),
+            dtype=input_permutation_matrices[0].dtype,
+        )
+        for n, m in enumerate(input_permutation_matrices):
+            input_permutation_matrix[: len(m), n, : m.shape[1]] = m
+            input_permutation_matrix[len(m) :, n, : m.shape[1]] = m[0]
+        if self.cuda:
+            input_permutation_matrix = input_permutation_matrix.cuda()
+        return input_permutation_matrix, bin_input_permutation_matrices
 
-            # TODO: Update this block to just run inference on the fc layer, once BN has been moved to output_quant
+    # Count the truth table entries which change if the sub-networks are
+    # evaluated in compute_dtype rather than fp32, i.e., how far the behaviour
+    # of a model trained with reduced precision is from its LUTs.
+    def count_truth_table_mismatches(self, compute_dtype) -> int:
+        with torch.no_grad():
+            input_permutation_matrix, bin_input_permutation_matrices = (
+                self.get_neuron_permutation_matrices()
+            )
+            saved_compute_dtype = self.compute_dtype
             apply_input_quant, apply_output_quant = (
                 self.apply_input_quant,
                 self.apply_output_quant,
             )
-            self.apply_input_quant, self.apply_output_quant = False, False
             is_bin_output = self.output_quant.is_bin_output
-            self.output_quant.float_output()
-            step = input_permutation_matrix.shape[0]
-            output_states = self.output_quant(
-                self.forward_to_fill_luts(input_permutation_matrix[0:step, :])
-            )
-            for segment in range(step, input_permutation_matrix.shape[0], step):
-                output_states = torch.cat(
-                    (
-                        output_states,
-                        self.output_quant(
-                            self.forward_to_fill_luts(
-                                input_permutation_matrix[segment : segment + step, :]
-                            )
-                        ),
-                    ),
-                    0,
-                )  # Calculate float for the current input
+            self.apply_input_quant, self.apply_output_quant = False, False
             self.output_quant.bin_output()
-            bin_output_states = self.output_quant(
-                self.forward_to_fill_luts(input_permutation_matrix[0:step, :])
-            )  # Calculate bin for the current input
-            for segment in range(step, input_permutation_matrix.shape[0], step):
-                bin_output_states = torch.cat(
-                    (
-                        bin_output_states,
-                        self.output_quant(
-                            self.forward_to_fill_luts(
-                                input_permutation_matrix[segment : segment + step, :]
-                            )
-                        ),
-                    ),
-                    0,
-                )  # Calculate float for the current input
+            bin_output_states = []
+            for dtype in (None, compute_dtype):
+                self.compute_dtype = dtype
+                bin_output_states.append(
+                    self.output_quant(self.forward_to_fill_luts(input_permutation_matrix))
+                )
+            self.compute_dtype = saved_compute_dtype
+            self.apply_input_quant, self.apply_output_quant = (
+                apply_input_quant,
+                apply_output_quant,
+            )
             self.output_quant.is_bin_output = is_bin_output
+        mismatches = bin_output_states[0] != bin_output_states[1]
+        # Ignore the padding rows of neurons with fewer input states
+        num_states = torch.tensor([len(m) for m in bin_input_permutation_matrices])
+        mismatches &= (
+            torch.arange(mismatches.shape[0]).unsqueeze(1) < num_states.unsqueeze(0)
+        ).to(mismatches.device)
+        return int(mismatches.sum())
+
+    # If fold_thresholds is set, the output quantizer (and its BatchNorm) is
+    # evaluated as a per-neuron threshold compare, see threshold_quantize().
+    # The thresholds are kept in self.output_thresholds.
+    def calculate_truth_tables(self, fold_thresholds: bool = False):
+        with torch.no_grad():
+            neuron_truth_tables = list()
+            (
+                input_permutation_matrix,
+                bin_input_permutation_matrices,
+            ) = self.get_neuron_permutation_matrices()
+
+            compute_dtype = self.compute_dtype
+            self.compute_dtype = None  # The truth tables are always calculated in fp32
+            apply_input_quant, apply_output_quant = (
+                self.apply_input_quant,
+                self.apply_output_quant,
+            )
+            self.apply_input_quant, self.apply_output_quant = False, False
+            step = input_permutation_matrix.shape[0]
+            # Evaluate the sub-networks once, the output quantizer is applied below
+            fc_output_states = torch.cat(
+                [
+                    self.forward_to_fill_luts(
+                        input_permutation_matrix[segment : segment + step]
+                    )
+                    for segment in range(0, input_permutation_matrix.shape[0], step)
+                ],
+                0,
+            )
             self.apply_input_quant, self.apply_output_quant = (
                 apply_input_quant,
                 apply_output_quant,
             )
+            self.compute_dtype = compute_dtype
+            if fold_thresholds:
+                # Fold the output quantizer's BatchNorm into per-neuron thresholds,
+                # so that quantization becomes a threshold compare
+                self.output_thresholds = self.output_quant.get_thresholds(
+                    self.out_features
+                )
+                bin_output_states = self.output_quant.reduce_codes(
+                    threshold_quantize(fc_output_states, *self.output_thresholds)
+                )
+                scale_factor, _ = self.output_quant.get_scale_factor_bits()
+                output_states = self.output_quant.apply_post_transforms(
+                    bin_output_states.type(fc_output_states.dtype) * scale_factor
+                )
+            else:
+                is_bin_output = self.output_quant.is_bin_output
+                self.output_quant.float_output()
+                output_states = self.output_quant(fc_output_states)  # Calculate float for the current input
+                self.output_quant.bin_output()
+                bin_output_states = self.output_quant(fc_output_states)  # Calculate bin for the current input
+                self.output_quant.is_bin_output = is_bin_output
+            fan_ins = self.imask.fan_ins.tolist()
             for n in range(self.out_features):
                 # Append the connectivity, input permutations and output permutations to the neuron truth tables
+                num_states = len(bin_input_permutation_matrices[n])
                 neuron_truth_tables.append(
                     (
-                        self.imask()[n],
-                        bin_input_permutation_matrix,
-                        output_states[:, n],
-                        bin_output_states[:, n],
+                        self.imask()[n, : fan_ins[n]],
+                        bin_input_permutation_matrices[n],
+                        output_states[:num_states, n],
+                        bin_output_states[:num_states, n],
                     )
                 )  # Change this to be the binary output states
         self.neuron_truth_tables = neuron_truth_tables
 
 
 
+# The indices of the inputs connected to each neuron, imask[i] holds the (sorted)
+# inputs of neuron i. If a seed is given, the connectivity does not depend on
+# the global RNG. Connectivity strategies:
+#   random:   uniformly random inputs per neuron
+#   local:    random inputs from a window around each neuron's position
+#   balanced: the fanout of every input is within one of the mean fanout
+# The sampled connectivity can be repaired to bound the fanout of every input
+# (max_fanout) and to use every input (cover_inputs). If group_neurons is set,
+# neurons sharing inputs are given neighbouring indices. Don't set it for the
+# output layer, as it reorders the neurons.
 class FeatureMask(nn.Module):
-    def __init__(self, in_features: int, out_features: int, fan_in: int, cuda: bool):
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+        fan_in: int,
+        cuda: bool,
+        seed=None,
+        connectivity: str = "random",
+        window: int = None,
+        max_fanout: int = None,
+        cover_inputs: bool = False,
+        group_neurons: bool = False,
+    ):
         super(FeatureMask, self).__init__()
         self.in_features = in_features
         self.out_features = out_features
         self.fan_in = fan_in
+        self.seed = seed
+        self.connectivity = connectivity
+        self.window = window
+        self.max_fanout = max_fanout
+        self.cover_inputs = cover_inputs
+        self.group_neurons = group_neurons
         if cuda:
             self.register_buffer('imask', torch.zeros((self.out_features, self.fan_in)).long().cuda(), persistent=True)
         else:
             self.register_buffer('imask', torch.zeros((self.out_features, self.fan_in)).long(), persistent=True)
+        # The fan-in of each neuron, only its first fan_ins[i] inputs are connected.
+        # See set_fan_ins().
+        self.register_buffer('fan_ins', torch.full((self.out_features,), self.fan_in, dtype=torch.int64, device=self.imask.device))
+        self.is_heterogeneous = False  # Cached (fan_ins < fan_in).any(), to avoid syncing
         self.reset_parameters()
 
+    # Checkpoints from before per-neuron fan-ins were supported
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        key = prefix + "fan_ins"
+        if key not in state_dict:
+            # Checkpoints without fan_ins have the full fan-in, fill it in a copy
+            # so that the caller's state_dict is left as it is
+            state_dict = dict(state_dict)
+            state_dict[key] = torch.full_like(self.fan_ins, self.fan_in)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        self.is_heterogeneous = bool((self.fan_ins < self.fan_in).any())
+
+    # Reduce the fan-in of individual neurons, neuron i keeps the first
+    # fan_ins[i] inputs of imask[i]. The remaining slots of imask are padding,
+    # they are masked out of the sub-networks and don't appear in the LUTs.
+    def set_fan_ins(self, fan_ins) -> None:
+        fan_ins = torch.as_tensor(fan_ins, dtype=torch.int64)
+        if fan_ins.shape != (self.out_features,):
+            raise Exception(f"Expected {self.out_features} fan-ins, {tuple(fan_ins.shape)} found")
+        if (fan_ins < 1).any() or (fan_ins > self.fan_in).any():
+            raise Exception(f"Fan-ins must be between 1 and {self.fan_in}")
+        self.fan_ins.copy_(fan_ins)
+        self.is_heterogeneous = bool((fan_ins < self.fan_in).any())
+
+    # A boolean [out_features, fan_in] mask of the connected slots of imask
+    def slot_mask(self) -> Tensor:
+        return torch.arange(self.fan_in, device=self.fan_ins.device) < self.fan_ins.unsqueeze(1)
+
     def reset_parameters(self) -> None:
-        for i in range(self.out_features):
-            self.imask[i, :] = torch.randperm(self.in_features)[:self.fan_in]
-            self.imask = torch.sort(self.imask, 1).values
+        generator = None
+        if self.seed is not None:
+            generator = torch.Generator().manual_seed(self.seed)
+        shape = (self.in_features, self.out_features, self.fan_in)
+        if self.connectivity == "random":
+            imask = random_fanin_indices(*shape, generator=generator)
+        elif self.connectivity == "local":
+            imask = local_fanin_indices(*shape, window=self.window, generator=generator)
+        elif self.connectivity == "balanced":
+            imask = balanced_fanin_indices(*shape, generator=generator)
+        else:
+            raise Exception(f"Unknown connectivity strategy: {self.connectivity}")
+        if self.max_fanout is not None or self.cover_inputs:
+            imask = rebalance_fanin_indices(
+                imask,
+                self.in_features,
+                max_fanout=self.max_fanout,
+                cover_inputs=self.cover_inputs,
+                generator=generator,
+            )
+        if self.group_neurons:
+            imask = group_fanin_indices(imask)
+        self.imask.copy_(imask)
+
+    # The number of neurons connected to each input
+    def fanout(self) -> Tensor:
+        return torch.bincount(self.imask[self.slot_mask()].cpu(), minlength=self.in_features)
 
     def forward(self):
         return self.imask
@@ -0,0 +1,209 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import hashlib
+import json
+import os
+import time
+
+from .instrument import span
+
+
+# The sha256 hex digest of a file, read one chunk at a time
+def file_digest(path, chunk_size=1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# The sha256 hex digest of a JSON-serializable object
+def object_digest(obj) -> str:
+    return hashlib.sha256(
+        json.dumps(obj, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class _Stage:
+    def __init__(self, name, run, load, depends, outputs, params) -> None:
+        self.name = name
+        self.run = run
+        self.load = load
+        self.depends = list(depends)
+        self.outputs = outputs
+        self.params = params
+        self.key = None
+        self.result = None
+        self.loaded = False  # Whether the in-memory state of this stage is available
+
+
+# A sequence of stages whose completion is recorded in a manifest
+# (<work_dir>/pipeline.json), so that a rerun skips the completed stages and
+# resumes from the first incomplete one.
+# Each stage has:
+#  - run(): does the work and returns a JSON-serializable result, which is
+#    stored in the manifest and returned for skipped stages as well.
+#  - load(): optionally restores the in-memory state of a skipped stage from its
+#    artifacts, it is only called if a later stage depending on it must run.
+#  - outputs: the artifacts written by run(), relative to work_dir (or a callable
+#    returning them). A stage is rerun if any of them was removed or modified.
+#  - params: anything else its result depends on.
+# A stage is invalidated if the fingerprint of the pipeline (e.g., the digest
+# of the checkpoint and the configuration), its params, or the key of any stage
+# it depends on changed, and every stage depending on a rerun stage is rerun
+# (the next time it is selected).
+class Pipeline:
+    def __init__(self, work_dir: str, fingerprint, restart: bool = False) -> None:
+        self.work_dir = work_dir
+        self.fingerprint = object_digest(fingerprint)
+        self.manifest_path = os.path.join(work_dir, "pipeline.json")
+        self.stages = {}
+        self.manifest = {"fingerprint": self.fingerprint, "stages": {}}
+        if not restart and os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+            if self.manifest.get("fingerprint") != self.fingerprint:
+                print("The checkpoint or configuration changed, all stages will be rerun")
+                self.manifest = {"fingerprint": self.fingerprint, "stages": {}}
+
+    def add(self, name, run, load=None, depends=(), outputs=(), params=None) -> None:
+        if name in self.stages:
+            raise Exception(f"A stage named {name} already exists")
+        for d in depends:
+            if d not in self.stages:
+                raise Exception(f"Stage {name} depends on the unknown stage {d}")
+        self.stages[name] = _Stage(name, run, load, depends, outputs, params)
+
+    def _outputs(self, stage) -> list:
+        outputs = stage.outputs() if callable(stage.outputs) else stage.outputs
+        return [os.path.join(self.work_dir, o) for o in outputs]
+
+    @staticmethod
+    def _output_state(paths) -> dict:
+        return {
+            p: [os.path.getsize(p), os.path.getmtime(p)] if os.path.exists(p) else None
+            for p in paths
+        }
+
+    # Whether a stage can be skipped, returns the reason for rerunning it otherwise
+    def _check(self, stage):
+        entry = self.manifest["stages"].get(stage.name)
+        if entry is None or entry.get("status") not in ["done", "invalidated"]:
+            return "not completed"
+        if entry["status"] == "invalidated":
+            return f"stage {entry['invalidated_by']} was rerun"
+        if entry["key"] != stage.key:
+            return "its inputs changed"
+        if self._output_state(entry["outputs"]) != entry["output_state"]:
+            return "its outputs were modified"
+        return None
+
+    def _save_manifest(self) -> None:
+        os.makedirs(self.work_dir, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    # Restore the in-memory state of a skipped stage and of those it depends on
+    def _load(self, stage) -> None:
+        if stage.loaded:
+            return
+        for d in stage.depends:
+            self._load(self.stages[d])
+        if stage.load is not None:
+            print(f"Loading the artifacts of stage {stage.name}")
+            stage.load()
+        stage.loaded = True
+
+    # Mark the completed stages depending (transitively) on a rerun stage as
+    # invalidated, including those which are not run now
+    def _invalidate_dependents(self, name) -> None:
+        invalidated = {name}
+        for stage in self.stages.values():
+            if any(d in invalidated for d in stage.depends):
+                invalidated.add(stage.name)
+                entry = self.manifest["stages"].get(stage.name)
+                if entry is not None and entry.get("status") == "done":
+                    entry["status"] = "invalidated"
+                    entry["invalidated_by"] = name
+
+    # The given stages and those they depend on
+    def _with_dependencies(self, names) -> set:
+        selected = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name not in self.stages:
+                raise Exception(f"Unknown stage {name}")
+            if name not in selected:
+                selected.add(name)
+                pending += self.stages[name].depends
+        return selected
+
+    # Run the stages which are incomplete or invalidated, returns the result of
+    # every completed stage. If stages is given, only those (and the stages they
+    # depend on) are run.
+    def run(self, stages=None) -> dict:
+        selected = self._with_dependencies(stages) if stages is not None else None
+        results = {}
+        for stage in self.stages.values():
+            stage.key = object_digest(
+                [self.fingerprint, stage.params]
+                + [self.stages[d].key for d in stage.depends]
+            )
+            reason = self._check(stage)
+            if reason is None:
+                print(f"Skipping stage {stage.name}, completed previously")
+                stage.result = self.manifest["stages"][stage.name]["result"]
+                results[stage.name] = stage.result
+                continue
+            if selected is not None and stage.name not in selected:
+                print(f"Skipping stage {stage.name}, not selected")
+                continue
+            print(f"Running stage {stage.name}, {reason}")
+            for d in stage.depends:
+                self._load(self.stages[d])
+            entry = {"status": "running", "key": stage.key, "started_at": time.time()}
+            self.manifest["stages"][stage.name] = entry
+            self._save_manifest()
+            try:
+                with span("stage", stage=stage.name):
+                    stage.result = stage.run()
+            except BaseException as e:
+                entry["status"] = "failed"
+                entry["error"] = f"{type(e).__name__}: {e}"
+                self._save_manifest()
+                raise
+            stage.loaded = True
+            self._invalidate_dependents(stage.name)
+            outputs = self._outputs(stage)
+            entry.update(
+                {
+                    "status": "done",
+                    "completed_at": time.time(),
+                    "result": stage.result,
+                    "outputs": outputs,
+                    "output_state": self._output_state(outputs),
+                }
+            )
+            self._save_manifest()
+            results[stage.name] = stage.result
+        return results
@@ -26,6 +26,9 @@ from brevitas.core.quant import RescalingIntQuant, ClampedBinaryQuant
 from brevitas.core.scaling import ScalingImplType
 import brevitas.nn as bnn
 
+from .nn import ScalarBiasScale, ScalarScaleBias
+from .encoder import InputEncoder
+
 # TODO: Put this inside an abstract base class
 def get_int_state_space(bits: int, signed: bool, narrow_range: bool, is_cuda: bool):
     start = int(
@@ -59,6 +62,53 @@ def get_float_state_space(
     return state_space
 
 
+# Fold a list of per-channel affine transforms into y = scale * x + bias, with
+# one (fp64) entry per channel in scale / bias. BatchNorm1d is folded using its
+# running statistics, i.e., as it behaves in eval() mode.
+def fold_affine_transforms(transforms, num_channels: int):
+    scale = torch.ones(num_channels, dtype=torch.float64)
+    bias = torch.zeros(num_channels, dtype=torch.float64)
+    as_fp64 = lambda p: p.detach().cpu().double()
+    for t in transforms:
+        if isinstance(t, nn.BatchNorm1d):
+            if t.running_mean is None:
+                raise Exception("Cannot fold a BatchNorm1d without running statistics")
+            t_scale = 1.0 / torch.sqrt(as_fp64(t.running_var) + t.eps)
+            t_bias = -as_fp64(t.running_mean) * t_scale
+            if t.affine:
+                t_scale = t_scale * as_fp64(t.weight)
+                t_bias = t_bias * as_fp64(t.weight) + as_fp64(t.bias)
+        elif isinstance(t, ScalarBiasScale):  # (x + b) * w
+            t_scale = as_fp64(t.weight) if t.weight is not None else 1.0
+            t_bias = as_fp64(t.bias) * t_scale if t.bias is not None else 0.0
+        elif isinstance(t, ScalarScaleBias):  # x * w + b
+            t_scale = as_fp64(t.weight) if t.weight is not None else 1.0
+            t_bias = as_fp64(t.bias) if t.bias is not None else 0.0
+        elif isinstance(t, nn.Identity):
+            continue
+        else:
+            raise Exception(f"Cannot fold a transform of type {type(t)}")
+        scale, bias = t_scale * scale, t_scale * bias + t_bias
+    return scale, bias
+
+
+# Keep only the given channels of a list of (per-channel) transforms
+def select_transform_channels(transforms, channels: Tensor) -> None:
+    for t in transforms:
+        if isinstance(t, nn.BatchNorm1d):
+            if t.affine:
+                t.weight = nn.Parameter(t.weight.detach()[channels.to(t.weight.device)].clone())
+                t.bias = nn.Parameter(t.bias.detach()[channels.to(t.bias.device)].clone())
+            if t.running_mean is not None:
+                t.running_mean = t.running_mean[channels.to(t.running_mean.device)].clone()
+                t.running_var = t.running_var[channels.to(t.running_var.device)].clone()
+            t.num_features = len(channels)
+        elif isinstance(t, (ScalarBiasScale, ScalarScaleBias, nn.Identity)):
+            continue  # Shared by all channels
+        else:
+            raise Exception(f"Cannot select the channels of a transform of type {type(t)}")
+
+
 # TODO: Add an abstract class with a specific interface which all brevitas-based classes inherit from?
 class QuantBrevitasActivation(nn.Module):
     def __init__(
@@ -69,6 +119,66 @@ class QuantBrevitasActivation(nn.Module):
         self.pre_transforms = nn.ModuleList(pre_transforms)
         self.post_transforms = nn.ModuleList(post_transforms)
         self.is_bin_output = False
+        # The number of LSBs dropped from the integer code of each channel, a
+        # single entry applies to all channels. See set_channel_bitwidths().
+        self.register_buffer("drop_bits", torch.zeros(1, dtype=torch.int64))
+        self.is_reduced = False  # Cached (drop_bits > 0).any(), to avoid syncing
+
+    # Checkpoints may hold per-channel drop_bits, or none at all (older ones)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        key = prefix + "drop_bits"
+        if key in state_dict:
+            self.drop_bits = torch.zeros_like(state_dict[key]).to(self.drop_bits.device)
+        else:
+            # Keep the current drop_bits, filled in a copy so that the caller's
+            # state_dict is left as it is
+            state_dict = dict(state_dict)
+            state_dict[key] = self.drop_bits.clone()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        self.is_reduced = bool((self.drop_bits > 0).any())
+
+    # Reduce the bitwidth of individual channels by dropping the LSBs of their
+    # integer codes (rounding down), the scale factor is shared by all channels.
+    # bitwidths is a list with one entry per channel, e.g., to make the inputs
+    # of the next layer which it is least sensitive to cheaper.
+    # Codes keep their full scale, e.g., a 4-bit channel reduced to 2 bits has
+    # the codes 0, 4, 8 and 12; they are only shifted in the generated HDL.
+    def set_channel_bitwidths(self, bitwidths):
+        if self.get_quant_type() != QuantType.INT:
+            raise Exception("Per-channel bitwidths are only supported for integer quantization")
+        _, bits = self.get_scale_factor_bits()
+        bitwidths = torch.as_tensor(bitwidths, dtype=torch.int64)
+        if (bitwidths < 1).any() or (bitwidths > int(bits)).any():
+            raise Exception(f"Channel bitwidths must be between 1 and {int(bits)}")
+        self.drop_bits = (int(bits) - bitwidths).to(self.drop_bits.device)
+        self.is_reduced = bool((self.drop_bits > 0).any())
+
+    def has_channel_bitwidths(self) -> bool:
+        return self.is_reduced
+
+    def get_drop_bits(self, channel: int) -> int:
+        return int(self.drop_bits[channel if self.drop_bits.numel() > 1 else 0])
+
+    # The bitwidth of each of num_channels channels
+    def get_channel_bitwidths(self, num_channels: int) -> list:
+        _, bits = self.get_scale_factor_bits()
+        return [int(bits) - self.get_drop_bits(c) for c in range(num_channels)]
+
+    # Drop the LSBs of integer codes, [..., channels]
+    def reduce_codes(self, x: Tensor) -> Tensor:
+        if not self.has_channel_bitwidths():
+            return x
+        step = torch.pow(2, self.drop_bits.to(x.device))
+        return torch.div(x, step, rounding_mode="floor") * step
+
+    # Keep only the given channels, e.g., after pruning the neurons of a layer
+    def select_channels(self, channels: Tensor) -> None:
+        channels = channels.cpu()
+        select_transform_channels(self.pre_transforms, channels)
+        select_transform_channels(self.post_transforms, channels)
+        if self.drop_bits.numel() > 1:
+            self.drop_bits = self.drop_bits[channels.to(self.drop_bits.device)].clone()
+            self.is_reduced = bool((self.drop_bits > 0).any())
 
     # TODO: Move to a base class
     # TODO: Move the string templates to verilog.py
@@ -92,7 +202,8 @@ class QuantBrevitasActivation(nn.Module):
         else:
             raise Exception("Unknown quantization type: {}".format(quant_type))
 
-    def get_bin_str_from_int(self, x, is_cuda):
+    # If a channel is given, its bitwidth is used (see set_channel_bitwidths())
+    def get_bin_str_from_int(self, x, is_cuda, channel=None):
         quant_type = self.get_quant_type()
         scale_factor, bits = self.get_scale_factor_bits()
         if quant_type == QuantType.INT:
@@ -104,6 +215,12 @@ class QuantBrevitasActivation(nn.Module):
             offset = 2 ** (bits - 1) - int(narrow_range) if signed else 0
             if int(x) - x != 0:
                 raise Exception("Value is not an integer, either run lut_inference first or change function to get_bin_str_from_float")
+            drop_bits = self.get_drop_bits(channel) if channel is not None else 0
+            if drop_bits > 0:
+                # Reduced channels use the full signed range of their bits
+                bits = int(bits) - drop_bits
+                offset = 2 ** (bits - 1) if signed else 0
+                return f"{(int(x) >> drop_bits) + offset:0{bits}b}"
             return f"{int(x+offset):0{int(bits)}b}"
         elif quant_type == QuantType.BINARY:
             return f"{int(x):0{int(bits)}b}"
@@ -182,6 +299,76 @@ class QuantBrevitasActivation(nn.Module):
             raise Exception("Unknown quantization type: {}".format(quant_type))
         return state_space
 
+    # The float and binary state spaces of a single channel, which only differ
+    # from get_state_space() / get_bin_state_space() for reduced channels
+    def get_channel_state_spaces(self, channel: int, is_cuda):
+        bin_state_space = self.get_bin_state_space(is_cuda)
+        drop_bits = self.get_drop_bits(channel)
+        if drop_bits == 0:
+            return self.get_state_space(is_cuda), bin_state_space
+        bin_state_space = bin_state_space[torch.remainder(bin_state_space, 2**drop_bits) == 0]
+        scale_factor, _ = self.get_scale_factor_bits()
+        state_space = self.apply_post_transforms(scale_factor * bin_state_space)
+        return state_space, bin_state_space
+
+    # Express the integer output of this quantizer, including its pre-transforms,
+    # as per-channel thresholds on its input x. The output code of channel c is:
+    #   min_code + #{k : sign[c] * x[c] >= thresholds[c, k]}
+    # Inputs exactly halfway between two levels are rounded up, rather than to even.
+    def get_thresholds(self, num_channels: int):
+        if self.get_quant_type() != QuantType.INT:
+            raise Exception("Thresholds are only supported for integer quantization")
+        scale_factor, _ = self.get_scale_factor_bits()
+        codes = self.get_bin_state_space(is_cuda=False).double()
+        # The boundaries between consecutive levels, at the input of the brevitas module
+        boundaries = ((codes[1:] - 0.5) * float(scale_factor)).unsqueeze(0)
+        scale, bias = fold_affine_transforms(self.pre_transforms, num_channels)
+        sign = torch.ones(num_channels, dtype=torch.float64)
+        sign[scale < 0] = -1.0
+        thresholds = (boundaries - bias.unsqueeze(1)) / scale.abs().unsqueeze(1)
+        # A zero scale maps every input to the same level
+        constant = scale == 0
+        if constant.any():
+            reached = bias[constant].unsqueeze(1) >= boundaries
+            thresholds[constant] = torch.where(
+                reached,
+                torch.full_like(thresholds[constant], -math.inf),
+                torch.full_like(thresholds[constant], math.inf),
+            )
+        return sign, thresholds, int(codes[0])
+
+    # Export a torch-free encoder which maps raw features to the same integer
+    # codes as this quantizer in bin_output() mode.
+    def export_input_encoder(self, num_channels: int) -> InputEncoder:
+        sign, thresholds, min_code = self.get_thresholds(num_channels)
+        _, bits = self.get_scale_factor_bits()
+        tensor_quant = (
+            self.brevitas_module.act_quant_proxy.fused_activation_quant_proxy.tensor_quant
+        )
+        narrow_range = tensor_quant.int_quant.narrow_range
+        signed = tensor_quant.int_quant.signed
+        offset = 2 ** (int(bits) - 1) - int(narrow_range) if signed else 0
+        drop_bits = [self.get_drop_bits(c) for c in range(num_channels)]
+        return InputEncoder(
+            thresholds.numpy(), sign.numpy(), min_code, offset, drop_bits=drop_bits
+        )
+
+    # The number of codes of the inputs x [N, C] (e.g., the test set) for which an
+    # exported encoder differs from this quantizer in bin_output() mode. Inputs
+    # exactly halfway between two levels are rounded up by the encoder but to
+    # even by torch.round(), so they can differ.
+    def count_encoder_mismatches(self, encoder: InputEncoder, x) -> int:
+        device = next(self.parameters()).device
+        training, is_bin_output = self.training, self.is_bin_output
+        self.eval()
+        self.bin_output()
+        with torch.no_grad():
+            codes = self(x.to(device)).cpu().numpy()
+        self.train(training)
+        self.is_bin_output = is_bin_output
+        encoded = encoder.encode(x.detach().cpu().double().numpy())
+        return int((encoded != codes).sum())
+
     def apply_pre_transforms(self, x):
         for i in range(len(self.pre_transforms)):
             x = self.pre_transforms[i](x)
@@ -198,8 +385,14 @@ class QuantBrevitasActivation(nn.Module):
             x = self.apply_pre_transforms(x)
             x = self.brevitas_module(x)
             x = torch.round(x / s).type(torch.int64)
+            x = self.reduce_codes(x)
         else:
             x = self.apply_pre_transforms(x)
             x = self.brevitas_module(x)
+            if self.has_channel_bitwidths():
+                # Drop the LSBs of the reduced channels, with a straight-through gradient
+                s, _ = self.get_scale_factor_bits()
+                reduced = self.reduce_codes(torch.round(x / s)) * s
+                x = x + (reduced - x).detach()
             x = self.apply_post_transforms(x)
         return x
\ No newline at end of file
@@ -0,0 +1,344 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Parse the reports of a synthesis run (the results_<top> folder written by
+# vivadocompile.sh) into a SynthesisReport:
+#  - res.txt: the total resource counts and the WNS,
+#  - hierarchical utilization reports (report_utilization -hierarchical): the
+#    LUT / FF counts of each instance, attributed to the layer and neuron of the
+#    generated Verilog (layer<i>_inst, layer<i>_N<n>_inst),
+#  - timing reports (report_timing -max_paths <n>): the worst paths, with the
+#    layers they start and end in,
+#  - Vivado logs: any ERROR lines.
+# vivadocompile.sh only writes res.txt, the hierarchical utilization and timing
+# reports are written by synthesis.write_layer_reports().
+# Reports are recognized by their contents, so any *.rpt / *.txt / *.log file
+# in the folder is considered. Problems are recorded in SynthesisReport.errors
+# rather than replaced by zeros, a report with errors is failed.
+
+import glob
+import json
+import os
+import re
+
+_LAYER_RE = re.compile(r"layer(\d+)(?:_N(\d+))?")
+_SLACK_RE = re.compile(r"^Slack(?:\s*\((MET|VIOLATED)\))?\s*:\s*(-?[\d.]+|-?inf)\s*ns", re.MULTILINE)
+_FLOAT_RE = re.compile(r"-?\d+(?:\.\d+)?")
+
+
+# The layer and neuron indices of an instance name or a pin path of the generated
+# Verilog, e.g., layer1_inst/layer1_N7_inst/... is (1, 7). The last component
+# naming a neuron is used, or the first one naming a layer if there is none,
+# e.g., layer0_reg/data_out_reg[0]/C is (0, None).
+def layer_and_neuron(name: str):
+    matches = list(_LAYER_RE.finditer(name or ""))
+    if not matches:
+        return None, None
+    neurons = [m for m in matches if m.group(2) is not None]
+    if neurons:
+        return int(neurons[-1].group(1)), int(neurons[-1].group(2))
+    return int(matches[0].group(1)), None
+
+
+class UtilizationRecord:
+    def __init__(self, instance: str, module: str, depth: int, counts: dict) -> None:
+        self.instance = instance
+        self.module = module
+        self.depth = depth
+        self.counts = counts
+        self.layer, self.neuron = layer_and_neuron(instance)
+
+    @property
+    def luts(self) -> int:
+        return self.counts.get("Total LUTs", self.counts.get("LUTs", 0))
+
+    @property
+    def ffs(self) -> int:
+        return self.counts.get("FFs", 0)
+
+    def to_dict(self) -> dict:
+        return {
+            "instance": self.instance,
+            "module": self.module,
+            "depth": self.depth,
+            "layer": self.layer,
+            "neuron": self.neuron,
+            "counts": self.counts,
+        }
+
+
+class TimingPath:
+    def __init__(
+        self,
+        slack_ns: float,
+        met: bool,
+        source: str,
+        destination: str,
+        path_group: str = None,
+        requirement_ns: float = None,
+        data_path_delay_ns: float = None,
+        logic_levels: int = None,
+    ) -> None:
+        self.slack_ns = slack_ns
+        self.met = met
+        self.source = source
+        self.destination = destination
+        self.path_group = path_group
+        self.requirement_ns = requirement_ns
+        self.data_path_delay_ns = data_path_delay_ns
+        self.logic_levels = logic_levels
+        self.start_layer = layer_and_neuron(source)[0]
+        self.end_layer = layer_and_neuron(destination)[0]
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+# The "key=value" lines of res.txt, values must be numbers
+def parse_res_txt(path: str) -> dict:
+    ret = {}
+    with open(path) as f:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            key, sep, value = line.partition("=")
+            if not sep:
+                raise Exception(f"{path}:{i+1}: expected key=value, got '{line}'")
+            try:
+                ret[key.strip()] = float(value)
+            except ValueError:
+                raise Exception(f"{path}:{i+1}: the value of {key.strip()} is not a number: '{value.strip()}'")
+    return ret
+
+
+def _parse_count(cell: str):
+    try:
+        return int(cell)
+    except ValueError:
+        try:
+            return float(cell)
+        except ValueError:
+            return None
+
+
+# The rows of the table of a hierarchical utilization report, or [] if the file
+# does not contain one
+def parse_hierarchical_utilization(path: str) -> list:
+    records = []
+    columns = None
+    with open(path) as f:
+        for line in f:
+            if not line.startswith("|"):
+                continue
+            cells = line.rstrip().rstrip("|").split("|")[1:]
+            if columns is None:
+                if cells and cells[0].strip() == "Instance":
+                    columns = [c.strip() for c in cells]
+                continue
+            if len(cells) != len(columns):
+                continue
+            instance = cells[0].rstrip()
+            # Instances are indented by two spaces per level below the top
+            depth = max(len(instance) - len(instance.lstrip()) - 1, 0) // 2
+            counts = {}
+            for name, cell in zip(columns[2:], cells[2:]):
+                value = _parse_count(cell.strip())
+                if value is not None:
+                    counts[name] = value
+            records.append(
+                UtilizationRecord(instance.strip(), cells[1].strip().strip("()"), depth, counts)
+            )
+    return records
+
+
+def _field(block: str, name: str):
+    m = re.search(rf"^\s*{name}:\s*(\S.*)$", block, re.MULTILINE)
+    return m.group(1).strip() if m is not None else None
+
+
+def _field_float(block: str, name: str):
+    value = _field(block, name)
+    m = _FLOAT_RE.search(value) if value is not None else None
+    return float(m.group(0)) if m is not None else None
+
+
+# The paths of a timing report, in the order of the report (worst first)
+def parse_timing_paths(path: str) -> list:
+    with open(path) as f:
+        text = f.read()
+    matches = list(_SLACK_RE.finditer(text))
+    paths = []
+    for i, m in enumerate(matches):
+        block = text[m.end():matches[i + 1].start() if i + 1 < len(matches) else len(text)]
+        source = _field(block, "Source")
+        destination = _field(block, "Destination")
+        if source is None or destination is None:
+            continue
+        logic_levels = _field(block, "Logic Levels")
+        paths.append(
+            TimingPath(
+                slack_ns=float(m.group(2)),
+                met=m.group(1) != "VIOLATED",
+                source=source,
+                destination=destination,
+                path_group=_field(block, "Path Group"),
+                requirement_ns=_field_float(block, "Requirement"),
+                data_path_delay_ns=_field_float(block, "Data Path Delay"),
+                logic_levels=int(logic_levels.split()[0]) if logic_levels else None,
+            )
+        )
+    return paths
+
+
+class SynthesisReport:
+    def __init__(self, results_dir: str, top_name: str, clk_period_ns: float) -> None:
+        self.results_dir = results_dir
+        self.top_name = top_name
+        self.clk_period_ns = float(clk_period_ns)
+        self.resources = {}
+        self.utilization = []
+        self.paths = []
+        self.errors = []
+
+    @property
+    def failed(self) -> bool:
+        return len(self.errors) > 0
+
+    @property
+    def wns(self):
+        return self.resources.get("WNS")
+
+    @property
+    def fmax_mhz(self):
+        if self.wns is None:
+            return None
+        return 1000.0 / (self.clk_period_ns - self.wns)
+
+    # The LUT / FF counts of each layer instance (or of each neuron of a layer
+    # if neurons=True), keyed by layer index (or (layer, neuron))
+    def hierarchy_counts(self, neurons: bool = False) -> dict:
+        counts = {}
+        for r in self.utilization:
+            if r.layer is None or (r.neuron is not None) != neurons:
+                continue
+            counts[(r.layer, r.neuron) if neurons else r.layer] = {"LUT": r.luts, "FF": r.ffs}
+        return counts
+
+    # The flat dictionary returned by synthesize_and_get_resource_counts()
+    def resource_counts(self) -> dict:
+        ret = dict(self.resources)
+        ret["fmax_mhz"] = self.fmax_mhz
+        return ret
+
+    def to_dict(self) -> dict:
+        return {
+            "results_dir": self.results_dir,
+            "top_name": self.top_name,
+            "clk_period_ns": self.clk_period_ns,
+            "failed": self.failed,
+            "errors": self.errors,
+            "resources": self.resources,
+            "fmax_mhz": self.fmax_mhz,
+            "layers": {str(k): v for k, v in sorted(self.hierarchy_counts().items())},
+            "utilization": [r.to_dict() for r in self.utilization],
+            "worst_paths": [p.to_dict() for p in self.paths],
+        }
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+# Read all reports in the results folder of a synthesis run
+def read_synthesis_report(results_dir: str, top_name: str, clk_period_ns: float) -> SynthesisReport:
+    report = SynthesisReport(results_dir, top_name, clk_period_ns)
+    if not os.path.isdir(results_dir):
+        report.errors.append(f"{results_dir} does not exist, synthesis did not run")
+        return report
+    res_path = os.path.join(results_dir, "res.txt")
+    if not os.path.exists(res_path):
+        report.errors.append(f"{res_path} does not exist, synthesis did not complete")
+    else:
+        try:
+            report.resources = parse_res_txt(res_path)
+        except Exception as e:
+            report.errors.append(str(e))
+        if "WNS" not in report.resources:
+            report.errors.append(f"{res_path} does not contain the WNS, timing was not reported")
+    files = sorted(
+        glob.glob(os.path.join(results_dir, "*.rpt"))
+        + glob.glob(os.path.join(results_dir, "*.txt"))
+        + glob.glob(os.path.join(results_dir, "*.log"))
+    )
+    for path in files:
+        if path == res_path:
+            continue
+        if path.endswith(".log"):
+            with open(path, errors="replace") as f:
+                report.errors += [
+                    f"{os.path.basename(path)}: {line.strip()}" for line in f if line.startswith("ERROR:")
+                ]
+            continue
+        with open(path, errors="replace") as f:
+            text = f.read()
+        if re.search(r"^\|\s*Instance\s*\|", text, re.MULTILINE):
+            report.utilization += parse_hierarchical_utilization(path)
+        elif _SLACK_RE.search(text):
+            report.paths += parse_timing_paths(path)
+    report.paths.sort(key=lambda p: p.slack_ns)
+    return report
+
+
+# The measured cost of each layer next to its analytic cost (truth table sizes
+# and input bits per neuron), e.g., to find the layers where reducing the fan-in
+# saves the most LUTs. Layers without a hierarchical utilization record have
+# None LUT / FF counts.
+def layer_costs(report: SynthesisReport, module_list) -> list:
+    measured = report.hierarchy_counts()
+    costs = []
+    for i, layer in enumerate(module_list):
+        sizes = layer.get_truth_table_sizes()
+        entries = sum(sizes)
+        counts = measured.get(i, {})
+        luts = counts.get("LUT")
+        costs.append(
+            {
+                "layer": i,
+                "neurons": layer.out_features,
+                "truth_table_entries": entries,
+                "max_input_bits": max(sizes).bit_length() - 1 if sizes else 0,
+                "LUT": luts,
+                "FF": counts.get("FF"),
+                "luts_per_neuron": luts / layer.out_features if luts is not None and layer.out_features else None,
+                "luts_per_1k_entries": 1000 * luts / entries if luts is not None and entries else None,
+            }
+        )
+    return costs
+
+
+def format_layer_costs(costs: list) -> str:
+    header = f"{'layer':>6}{'neurons':>9}{'TT entries':>12}{'LUT':>10}{'FF':>10}{'LUT/neuron':>12}"
+    lines = [header]
+    for c in costs:
+        luts = f"{c['LUT']:>10}" if c["LUT"] is not None else f"{'-':>10}"
+        ffs = f"{c['FF']:>10}" if c["FF"] is not None else f"{'-':>10}"
+        per_neuron = f"{c['luts_per_neuron']:>12.1f}" if c["luts_per_neuron"] is not None else f"{'-':>12}"
+        lines.append(f"{c['layer']:>6}{c['neurons']:>9}{c['truth_table_entries']:>12}{luts}{ffs}{per_neuron}")
+    return "\n".join(lines)
@@ -0,0 +1,215 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import math
+
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+from .nn import SparseLinearNeq
+
+
+# Learn the connectivity of the NEQs during training, with a fixed fan-in
+# (in the style of RigL). Every input of a layer is scored as a candidate input
+# of every neuron by the gradient the loss would have w.r.t. the weights
+# connecting them, accumulated over update_interval steps. Every update, the
+# weakest connection (smallest fc1 / res0 weights) of the neurons with the best
+# candidates is replaced by that candidate. The new connections start with zero
+# weights (and optimizer state), so only the dropped weak connections change the
+# function computed by the model at the time of the swap.
+# The fanout bound (max_fanout) and input coverage (cover_inputs) of the
+# FeatureMasks are kept: swaps which would break them are skipped.
+# The fraction of neurons rewired per update decays to 0 at end_step (cosine).
+# Call step() after every optimizer.step().
+class ConnectivitySearch:
+    def __init__(
+        self,
+        model: nn.Module,
+        optimizer=None,
+        update_interval: int = 100,
+        swap_fraction: float = 0.1,
+        end_step: int = None,
+    ) -> None:
+        self.layers = [m for m in model.modules() if type(m) == SparseLinearNeq]
+        self.optimizer = optimizer
+        self.update_interval = update_interval
+        self.swap_fraction = swap_fraction
+        self.end_step = end_step
+        self.num_steps = 0
+        self.inputs = {}  # The quantized input of each layer, in the last forward pass
+        self.grads = {}  # The accumulated dense gradients of fc1 / res0 of each layer
+        self.handles = []
+        for layer in self.layers:
+            if layer.apply_input_quant:
+                hook = layer.input_quant.register_forward_hook(
+                    lambda module, args, output, layer=layer: self._save_input(
+                        layer, output
+                    )
+                )
+            else:
+                hook = layer.register_forward_pre_hook(
+                    lambda module, args, layer=layer: self._save_input(layer, args[0])
+                )
+            self.handles.append(hook)
+            for fc in [layer.fc1, layer.res0]:
+                self.handles.append(
+                    fc.register_forward_hook(
+                        lambda module, args, output, layer=layer, fc=fc: self._watch(
+                            layer, fc, output
+                        )
+                    )
+                )
+
+    def _save_input(self, layer, x):
+        if (
+            layer.training
+            and torch.is_grad_enabled()
+            and not layer.is_lut_inference
+            and self.current_fraction() > 0
+        ):
+            self.inputs[layer] = x.detach()
+        else:
+            self.inputs.pop(layer, None)
+
+    def _watch(self, layer, fc, output):
+        if layer in self.inputs and output.requires_grad:
+            x = self.inputs[layer]
+            output.register_hook(
+                lambda grad: self._accumulate(layer, fc, grad, x)
+            )
+
+    # The gradient w.r.t. a dense weight matrix connecting all inputs: grad^T @ x
+    def _accumulate(self, layer, fc, grad, x):
+        dense_grad = grad.float().t() @ x.float()  # [out_features*width_n, in_features]
+        key = (layer, fc)
+        if key in self.grads:
+            self.grads[key] += dense_grad
+        else:
+            self.grads[key] = dense_grad
+
+    def current_fraction(self) -> float:
+        if self.end_step is None:
+            return self.swap_fraction
+        if self.num_steps >= self.end_step:
+            return 0.0
+        return self.swap_fraction * 0.5 * (1 + math.cos(math.pi * self.num_steps / self.end_step))
+
+    def step(self) -> None:
+        self.num_steps += 1
+        if self.num_steps % self.update_interval == 0:
+            fraction = self.current_fraction()
+            if fraction > 0:
+                self.update(fraction)
+            self.grads = {}
+
+    # Rewire round(fraction * out_features) neurons of every layer, returns the
+    # number of swapped connections per layer
+    def update(self, fraction: float) -> list:
+        num_swaps = []
+        with torch.no_grad():
+            for layer in self.layers:
+                if (layer, layer.fc1) not in self.grads:
+                    num_swaps.append(0)
+                    continue
+                num_swaps.append(self._rewire(layer, fraction))
+        return num_swaps
+
+    def _rewire(self, layer, fraction) -> int:
+        out_features, width_n, fan_in = layer.out_features, layer.width_n, layer.fan_in
+        num_neurons = min(int(round(fraction * out_features)), out_features)
+        if num_neurons == 0 or fan_in == layer.in_features:
+            return 0
+        imask = layer.imask.imask
+        # Padding slots of neurons with a reduced fan-in are not connections
+        slot_mask = layer.imask.slot_mask()
+        # Score the candidate inputs of each neuron, excluding the connected ones
+        score = sum(
+            self.grads[(layer, fc)].reshape(out_features, width_n, -1).pow(2).sum(1)
+            for fc in [layer.fc1, layer.res0]
+            if (layer, fc) in self.grads
+        )
+        rows = torch.arange(out_features, device=imask.device).unsqueeze(1).expand_as(imask)
+        score[rows[slot_mask], imask[slot_mask]] = -math.inf
+        fanout = layer.imask.fanout().to(imask.device)
+        if layer.imask.max_fanout is not None:
+            score[:, fanout >= layer.imask.max_fanout] = -math.inf
+        best_score, best_input = score.max(dim=1)
+        # The magnitude of the weights of each connection
+        magnitude = sum(
+            fc.weight.detach().reshape(out_features, width_n, fan_in).pow(2).sum(1)
+            for fc in [layer.fc1, layer.res0]
+        )
+        magnitude = magnitude.masked_fill(~slot_mask, math.inf)
+        if layer.imask.cover_inputs:
+            # The only connection of an input can not be dropped
+            magnitude = magnitude.masked_fill(fanout[imask] <= 1, math.inf)
+        weakest_slot = magnitude.argmin(dim=1)
+        neurons = best_score.topk(num_neurons).indices
+        neurons = neurons[best_score[neurons] > 0]  # Only candidates which received a gradient
+        if layer.imask.max_fanout is not None or layer.imask.cover_inputs:
+            weakest_input = imask.gather(1, weakest_slot.unsqueeze(1)).squeeze(1)
+            neurons = self._keep_fanout(layer.imask, neurons, best_input, weakest_input, fanout)
+        # Swap the connections, and keep the connected inputs of each neuron
+        # sorted, in its first fan_ins slots (followed by the padding ones)
+        swapped = torch.zeros_like(imask, dtype=torch.bool)
+        swapped[neurons, weakest_slot[neurons]] = True
+        new_imask = imask.clone()
+        new_imask[neurons, weakest_slot[neurons]] = best_input[neurons]
+        _, order = new_imask.masked_fill(~slot_mask, layer.in_features).sort(dim=1, stable=True)
+        new_imask = new_imask.gather(1, order)
+        swapped = swapped.gather(1, order)
+        rows_order = order.repeat_interleave(width_n, dim=0)
+        rows_swapped = swapped.repeat_interleave(width_n, dim=0)
+        for fc in [layer.fc1, layer.res0]:
+            fc.weight.copy_(self._rewire_columns(fc.weight, rows_order, rows_swapped))
+            # Reset the optimizer state of the new connections as well
+            if self.optimizer is not None:
+                for state in self.optimizer.state.get(fc.weight, {}).values():
+                    if isinstance(state, Tensor) and state.shape == fc.weight.shape:
+                        state.copy_(self._rewire_columns(state, rows_order, rows_swapped))
+        layer.imask.imask.copy_(new_imask)
+        return len(neurons)
+
+    # Walk the neurons in order of their score and keep those whose swap still
+    # respects the fanout bound and input coverage after the previous swaps
+    @staticmethod
+    def _keep_fanout(feature_mask, neurons, best_input, weakest_input, fanout) -> Tensor:
+        fanout, best_input, weakest_input = fanout.tolist(), best_input.tolist(), weakest_input.tolist()
+        kept = []
+        for n in neurons.tolist():
+            new, old = best_input[n], weakest_input[n]
+            if feature_mask.max_fanout is not None and fanout[new] >= feature_mask.max_fanout:
+                continue
+            if feature_mask.cover_inputs and fanout[old] <= 1:
+                continue
+            fanout[new] += 1
+            fanout[old] -= 1
+            kept.append(n)
+        return torch.tensor(kept, dtype=torch.int64, device=neurons.device)
+
+    @staticmethod
+    def _rewire_columns(weight, order, swapped) -> Tensor:
+        weight = weight.gather(1, order.to(weight.device))
+        return weight.masked_fill(swapped.to(weight.device), 0.0)
+
+    def remove(self) -> None:
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
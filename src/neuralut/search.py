@@ -0,0 +1,349 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Hardware-cost-aware architecture search. The candidates are the combinations
+# of hidden layer sizes, fan-ins, bitwidths and sub-network widths of a search
+# space, those over the LUT / latency budget of the analytic cost model below
+# are pruned before training, and the survivors are trained with a short budget
+# in parallel worker processes. The Pareto front of validation accuracy (on a
+# part of the training set held out by the dataset specific training function,
+# never the test set) vs. estimated LUTs and latency is kept in
+# <work_dir>/search.json, which is updated as each candidate completes, so that
+# an interrupted search resumes with the candidates which were not trained yet.
+# The dataset specific part is a function training a candidate, see
+# search.py in datasets/jet_substructure and datasets/mnist.
+
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .pipeline import object_digest
+
+# The options of the search space and the model config keys they set
+SPACE_KEYS = {
+    "hidden_layers": "hidden_layers",
+    "input_fanins": "input_fanin",
+    "hidden_fanins": "hidden_fanin",
+    "output_fanins": "output_fanin",
+    "input_bitwidths": "input_bitwidth",
+    "hidden_bitwidths": "hidden_bitwidth",
+    "output_bitwidths": "output_bitwidth",
+    "width_ns": "width_n",
+}
+
+
+# The number of 6-input LUTs implementing an X-input, Y-output truth table: one
+# LUT per output bit up to 6 inputs, as estimated in the LogicNets paper beyond
+# (the estimate is 0 at 4 inputs and negative below, so it is not used there)
+def lut_cost(x: int, y: int) -> float:
+    if x <= 6:
+        return y
+    return y / 3 * (2 ** (x - 4) - (-1) ** x)
+
+
+# The LUT levels of an X-input function, a LUT6 followed by a tree of 4:1
+# multiplexers (one LUT6 each) for the remaining inputs
+def lut_depth(x: int) -> int:
+    return 1 + max(math.ceil((x - 6) / 2), 0)
+
+
+# (neurons, input bits, output bits) of each layer of a NeqModel config
+def layer_shapes(model_cfg: dict) -> list:
+    sizes = list(model_cfg["hidden_layers"]) + [model_cfg["output_length"]]
+    shapes = []
+    for i, neurons in enumerate(sizes):
+        if i == 0:
+            in_bits = model_cfg["input_fanin"] * model_cfg["input_bitwidth"]
+        elif i == len(sizes) - 1:
+            in_bits = model_cfg["output_fanin"] * model_cfg["hidden_bitwidth"]
+        else:
+            in_bits = model_cfg["hidden_fanin"] * model_cfg["hidden_bitwidth"]
+        out_bits = model_cfg["output_bitwidth"] if i == len(sizes) - 1 else model_cfg["hidden_bitwidth"]
+        shapes.append((neurons, in_bits, out_bits))
+    return shapes
+
+
+# The analytic hardware cost of a NeqModel config: LUTs, truth table entries,
+# the latency in clock cycles (one per layer, with registers between layers)
+# and the LUT levels of the longest path
+def estimate_cost(model_cfg: dict) -> dict:
+    shapes = layer_shapes(model_cfg)
+    return {
+        "luts": sum(n * lut_cost(x, y) for n, x, y in shapes),
+        "truth_table_entries": sum(n * 2**x for n, x, _ in shapes),
+        "max_input_bits": max(x for _, x, _ in shapes),
+        "latency_cycles": len(shapes),
+        "lut_depth": sum(lut_depth(x) for _, x, _ in shapes),
+    }
+
+
+# One model config per combination of the values of the search space, on top of
+# the base config
+def enumerate_architectures(space: dict, base_cfg: dict) -> list:
+    keys = [k for k in SPACE_KEYS if space.get(k)]
+    candidates = []
+    for values in itertools.product(*[space[k] for k in keys]):
+        cfg = dict(base_cfg)
+        for k, v in zip(keys, values):
+            cfg[SPACE_KEYS[k]] = list(v) if k == "hidden_layers" else v
+        candidates.append(cfg)
+    return candidates
+
+
+# Whether point a is at least as good as b in all objectives and better in one.
+# objectives maps keys to "max" or "min".
+def dominates(a: dict, b: dict, objectives: dict) -> bool:
+    better = False
+    for k, direction in objectives.items():
+        x, y = (a[k], b[k]) if direction == "max" else (b[k], a[k])
+        if x < y:
+            return False
+        if x > y:
+            better = True
+    return better
+
+
+def pareto_front(points: list, objectives: dict) -> list:
+    return [
+        p for p in points if not any(dominates(q, p, objectives) for q in points if q is not p)
+    ]
+
+
+PARETO_OBJECTIVES = {"val_accuracy": "max", "luts": "min", "latency_cycles": "min"}
+
+
+def _format_architecture(cfg: dict) -> str:
+    return (
+        f"{'-'.join(str(n) for n in cfg['hidden_layers'])}"
+        f" fanin {cfg['input_fanin']}/{cfg['hidden_fanin']}/{cfg['output_fanin']}"
+        f" bits {cfg['input_bitwidth']}/{cfg['hidden_bitwidth']}/{cfg['output_bitwidth']}"
+        f" N {cfg['width_n']}"
+    )
+
+
+def format_candidates(candidates: list) -> str:
+    header = f"{'architecture':<56}{'LUTs':>12}{'latency':>9}{'depth':>7}{'val acc':>9}"
+    lines = [header]
+    for c in candidates:
+        acc = f"{c['val_accuracy']:>9.2f}" if c.get("val_accuracy") is not None else f"{'-':>9}"
+        lines.append(
+            f"{_format_architecture(c['config']):<56}{c['luts']:>12.0f}"
+            f"{c['latency_cycles']:>9}{c['lut_depth']:>7}{acc}"
+        )
+    return "\n".join(lines)
+
+
+# Train each candidate with train_fn(candidate) -> {"val_accuracy": ..., ...}
+# in up to 'workers' processes. train_fn must be importable by the workers,
+# i.e., defined at the top level of a module.
+class ArchitectureSearch:
+    def __init__(self, work_dir: str, train_fn, workers: int = 1, devices=None) -> None:
+        self.work_dir = work_dir
+        self.train_fn = train_fn
+        self.workers = workers
+        self.devices = devices or [0]
+        self.path = os.path.join(work_dir, "search.json")
+        self.results = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.results = json.load(f)["candidates"]
+
+    def save(self) -> None:
+        os.makedirs(self.work_dir, exist_ok=True)
+        trained = [c for c in self.results.values() if c.get("status") == "done"]
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "candidates": self.results,
+                    "pareto_front": [c["name"] for c in pareto_front(trained, PARETO_OBJECTIVES)],
+                },
+                f,
+                indent=2,
+            )
+        os.replace(tmp_path, self.path)
+
+    # Train the candidates which were not trained by a previous run, returns the
+    # Pareto front of all trained candidates
+    def run(self, candidates: list) -> list:
+        pending = []
+        for c in candidates:
+            previous = self.results.get(c["name"])
+            if previous is not None and previous.get("status") == "done":
+                print(f"Skipping {c['name']}, trained previously")
+                continue
+            pending.append(c)
+        # CUDA can't be used in forked processes
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as executor:
+            futures = {}
+            for i, c in enumerate(pending):
+                c = dict(c, device=self.devices[i % len(self.devices)])
+                c["log_dir"] = os.path.join(self.work_dir, c["name"])
+                futures[executor.submit(self.train_fn, c)] = c
+            for future in as_completed(futures):
+                c = futures[future]
+                try:
+                    c.update(future.result())
+                    c["status"] = "done"
+                    print(f"{c['name']}: validation accuracy {c['val_accuracy']:.2f}%, {c['luts']:.0f} LUTs")
+                except Exception as e:
+                    c["status"] = "failed"
+                    c["error"] = f"{type(e).__name__}: {e}"
+                    print(f"{c['name']}: failed, {c['error']}")
+                self.results[c["name"]] = c
+                self.save()
+        self.save()
+        trained = [c for c in self.results.values() if c.get("status") == "done"]
+        return sorted(pareto_front(trained, PARETO_OBJECTIVES), key=lambda c: c["luts"])
+
+
+def _layers(value: str) -> list:
+    return [int(n) for n in value.split(",")]
+
+
+def add_arguments(parser: ArgumentParser, configs: dict, default_arch: str) -> None:
+    parser.add_argument(
+        "--arch",
+        type=str,
+        choices=configs.keys(),
+        default=default_arch,
+        help="The architecture providing the options which are not searched (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--hidden-layers",
+        nargs="+",
+        type=_layers,
+        default=None,
+        help="Comma separated hidden layer sizes, e.g., 64,32 128,64 (default: those of --arch)",
+    )
+    for name in ["fanins", "bitwidths"]:
+        for layer in ["input", "hidden", "output"]:
+            parser.add_argument(f"--{layer}-{name}", nargs="+", type=int, default=None)
+    parser.add_argument("--width-ns", nargs="+", type=int, default=None)
+    parser.add_argument(
+        "--max-luts",
+        type=float,
+        default=None,
+        help="Prune the candidates estimated to need more LUTs (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-latency",
+        type=int,
+        default=None,
+        help="Prune the candidates with more layers, i.e., clock cycles (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-input-bits",
+        type=int,
+        default=16,
+        help="Prune the candidates with neurons of more input bits, whose truth tables are too large to generate (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-candidates",
+        type=int,
+        default=None,
+        help="Train a random sample of this many of the remaining candidates (default: all)",
+    )
+    parser.add_argument(
+        "--epochs",
+        type=int,
+        default=10,
+        help="Training budget of each candidate (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of candidates trained concurrently (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--devices",
+        nargs="+",
+        type=int,
+        default=[0],
+        help="GPUs assigned to the candidates in turn, with --cuda (default: %(default)s)",
+    )
+    parser.add_argument("--cuda", action="store_true", default=False)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--work-dir",
+        type=str,
+        default="search",
+        help="Where the results (search.json) are stored (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        default=False,
+        help="Only list the candidates which would be trained (default: %(default)s)",
+    )
+
+
+# Parse the command line, prune the search space and train the survivors with
+# train_fn. output_length is the number of outputs of the models.
+def main(train_fn, configs: dict, default_arch: str, output_length: int, argv=None) -> list:
+    parser = ArgumentParser(description="Search for architectures trading off accuracy and LUTs")
+    add_arguments(parser, configs, default_arch)
+    args = parser.parse_args(argv)
+
+    base_cfg = dict(configs[args.arch])
+    base_cfg["output_length"] = output_length
+    base_cfg["epochs"] = args.epochs
+    if args.seed is not None:
+        base_cfg["seed"] = args.seed
+    space = {k: getattr(args, k) for k in SPACE_KEYS}
+    candidates = []
+    names = set()
+    for cfg in enumerate_architectures(space, base_cfg):
+        cost = estimate_cost(cfg)
+        if args.max_luts is not None and cost["luts"] > args.max_luts:
+            continue
+        if args.max_latency is not None and cost["latency_cycles"] > args.max_latency:
+            continue
+        if cost["max_input_bits"] > args.max_input_bits:
+            continue
+        searched = {k: cfg[k] for k in SPACE_KEYS.values()}
+        if len(cfg["hidden_layers"]) < 2:
+            del searched["hidden_fanin"]  # Only used between hidden layers
+        # The candidates of another base architecture or budget are distinct
+        name = object_digest([args.arch, cfg["epochs"], cfg["seed"], searched])[:12]
+        if name in names:
+            continue
+        names.add(name)
+        candidates.append({"name": name, "config": cfg, "cuda": args.cuda, **cost})
+    print(f"{len(candidates)} candidates within the budget")
+    if args.max_candidates is not None and len(candidates) > args.max_candidates:
+        candidates = random.Random(base_cfg["seed"]).sample(candidates, args.max_candidates)
+        print(f"Training a sample of {len(candidates)} candidates")
+    if args.dry_run:
+        print(format_candidates(sorted(candidates, key=lambda c: c["luts"])))
+        return candidates
+
+    search = ArchitectureSearch(args.work_dir, train_fn, workers=args.workers, devices=args.devices)
+    front = search.run(candidates)
+    print("Pareto front of validation accuracy vs. estimated LUTs and latency:")
+    print(format_candidates(front))
+    print(f"Results stored at: {search.path}")
+    return front
@@ -0,0 +1,326 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Run many out-of-context synthesis jobs concurrently, e.g., to sweep clock
+# periods, FPGA parts and model variants (one generated Verilog directory per
+# variant):
+#   python -m neuralut.sweep --verilog-dirs jsc-2l/verilog jsc-5l/verilog \
+#       --clock-periods 1.0 1.1 1.2 --slots 4 --work-dir sweep
+# Each job synthesizes a copy of its Verilog directory in its own working
+# directory, <work-dir>/<job name>, and the results are collected into a table
+# (<work-dir>/results.csv / results.json).
+# tools/fake_omx provides a stand-in for vivadocompile.sh (and vivado), to try
+# the sweep on machines without Vivado:
+#   OHMYXILINX=$PWD/tools/fake_omx PATH=$PWD/tools/fake_omx:$PATH python -m neuralut.sweep ...
+
+import csv
+import glob
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+from .synthesis import synthesize_and_get_resource_counts
+from .synthesis_cache import SynthesisCache
+
+RESULT_COLUMNS = ["name", "status", "attempts", "LUT", "FF", "WNS", "fmax_mhz", "wall_time_s"]
+
+
+class SynthesisJob:
+    def __init__(
+        self,
+        name: str,
+        verilog_dir: str,
+        top_name: str = "neuralut",
+        fpga_part: str = "xcvu9p-flgb2104-2-i",
+        clk_period_ns: float = 1.1,
+        clk_name: str = "clk",
+        post_synthesis: int = 1,
+    ) -> None:
+        self.name = name
+        self.verilog_dir = verilog_dir
+        self.top_name = top_name
+        self.fpga_part = fpga_part
+        self.clk_period_ns = clk_period_ns
+        self.clk_name = clk_name
+        self.post_synthesis = post_synthesis
+
+    def params(self) -> dict:
+        return {
+            "verilog_dir": self.verilog_dir,
+            "top_name": self.top_name,
+            "fpga_part": self.fpga_part,
+            "clk_period_ns": self.clk_period_ns,
+            "clk_name": self.clk_name,
+            "post_synthesis": self.post_synthesis,
+        }
+
+
+# One job per combination of Verilog directory, FPGA part and clock period
+def grid_jobs(verilog_dirs, fpga_parts, clk_periods_ns, top_name="neuralut", post_synthesis=1) -> list:
+    jobs = []
+    for verilog_dir, fpga_part, clk_period_ns in itertools.product(
+        verilog_dirs, fpga_parts, clk_periods_ns
+    ):
+        variant = os.path.basename(os.path.normpath(os.path.abspath(verilog_dir)))
+        if len(verilog_dirs) > 1 and variant == "verilog":
+            # e.g., jsc-2l/verilog, use the name of the model's directory instead
+            variant = os.path.basename(os.path.dirname(os.path.abspath(verilog_dir)))
+        name = f"{variant}-{fpga_part}-{clk_period_ns}ns"
+        jobs.append(
+            SynthesisJob(
+                name,
+                verilog_dir,
+                top_name=top_name,
+                fpga_part=fpga_part,
+                clk_period_ns=clk_period_ns,
+                post_synthesis=post_synthesis,
+            )
+        )
+    if len(set(job.name for job in jobs)) != len(jobs):
+        raise Exception("The jobs of the sweep must have distinct names")
+    return jobs
+
+
+# Runs up to 'slots' synthesis jobs at a time. A job which fails (or exceeds
+# 'timeout' seconds) is retried up to 'retries' times, from a clean copy of its
+# Verilog directory. If a SynthesisCache is given, jobs whose design and
+# arguments were synthesized before complete immediately.
+class SynthesisSweep:
+    def __init__(
+        self,
+        work_dir: str,
+        slots: int = 1,
+        timeout: float = None,
+        retries: int = 0,
+        omx_path: str = None,
+        shell: str = "zsh",
+        cache: SynthesisCache = None,
+    ) -> None:
+        self.work_dir = work_dir
+        self.slots = slots
+        self.timeout = timeout
+        self.retries = retries
+        self.omx_path = omx_path
+        self.shell = shell
+        self.cache = cache
+        self._print_lock = threading.Lock()
+
+    def _log(self, message: str) -> None:
+        with self._print_lock:
+            print(message, flush=True)
+
+    # Copy the HDL of a job into its working directory, so that concurrent jobs
+    # on the same design don't share their Vivado project folders
+    def _prepare(self, job, job_dir) -> None:
+        if os.path.exists(job_dir):
+            shutil.rmtree(job_dir)
+        os.makedirs(job_dir)
+        files = glob.glob(os.path.join(job.verilog_dir, "*.v"))
+        if not files:
+            raise Exception(f"No Verilog files found in {job.verilog_dir}")
+        for f in files:
+            shutil.copy(f, job_dir)
+
+    def run_job(self, job: SynthesisJob) -> dict:
+        job_dir = os.path.join(self.work_dir, job.name)
+        result = {"name": job.name, **job.params(), "work_dir": job_dir}
+        start = time.perf_counter()
+        for attempt in range(1, self.retries + 2):
+            result["attempts"] = attempt
+            self._log(f"[{job.name}] starting attempt {attempt}")
+            try:
+                self._prepare(job, job_dir)
+                synthesize = (
+                    self.cache.synthesize
+                    if self.cache is not None
+                    else synthesize_and_get_resource_counts
+                )
+                counts = synthesize(
+                    job_dir,
+                    job.top_name,
+                    fpga_part=job.fpga_part,
+                    clk_name=job.clk_name,
+                    clk_period_ns=job.clk_period_ns,
+                    post_synthesis=job.post_synthesis,
+                    omx_path=self.omx_path,
+                    shell=self.shell,
+                    timeout=self.timeout,
+                    log_file=os.path.join(self.work_dir, f"{job.name}.log"),
+                    verbose=False,
+                )
+                result.update(counts)
+                result["status"] = "done"
+                result.pop("error", None)
+                break
+            except subprocess.TimeoutExpired:
+                result["status"] = "timeout"
+                result["error"] = f"Timed out after {self.timeout} s"
+            except Exception as e:
+                result["status"] = "failed"
+                result["error"] = f"{type(e).__name__}: {e}"
+            self._log(f"[{job.name}] attempt {attempt}: {result['error']}")
+        result["wall_time_s"] = time.perf_counter() - start
+        self._log(f"[{job.name}] {result['status']} in {result['wall_time_s']:.1f} s")
+        return result
+
+    # Run all jobs, returns their results in the order of 'jobs'
+    def run(self, jobs) -> list:
+        os.makedirs(self.work_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.slots) as executor:
+            results = list(executor.map(self.run_job, jobs))
+        self.save(results)
+        return results
+
+    def save(self, results) -> None:
+        with open(os.path.join(self.work_dir, "results.json"), "w") as f:
+            json.dump(results, f, indent=2)
+        with open(os.path.join(self.work_dir, "results.csv"), "w", newline="") as f:
+            columns = RESULT_COLUMNS + ["fpga_part", "clk_period_ns", "verilog_dir", "error"]
+            writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(results)
+
+
+def format_results(results) -> str:
+    header = f"{'job':<48}{'status':<10}{'LUT':>10}{'FF':>10}{'WNS (ns)':>10}{'fmax (MHz)':>12}{'time (s)':>10}"
+    lines = [header, "-" * len(header)]
+    for r in results:
+        if r["status"] == "done":
+            lines.append(
+                f"{r['name']:<48}{r['status']:<10}{r.get('LUT', 0):>10.0f}{r.get('FF', 0):>10.0f}"
+                f"{r.get('WNS', 0):>10.3f}{r.get('fmax_mhz', 0):>12.1f}{r['wall_time_s']:>10.1f}"
+            )
+        else:
+            lines.append(
+                f"{r['name']:<48}{r['status']:<10}{'-':>10}{'-':>10}{'-':>10}{'-':>12}{r['wall_time_s']:>10.1f}"
+            )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Run a sweep of out-of-context synthesis jobs")
+    parser.add_argument(
+        "--verilog-dirs",
+        nargs="+",
+        type=str,
+        required=True,
+        help="The directories with the generated Verilog of each model variant",
+    )
+    parser.add_argument("--top-name", type=str, default="neuralut")
+    parser.add_argument(
+        "--fpga-parts",
+        nargs="+",
+        type=str,
+        default=["xcvu9p-flgb2104-2-i"],
+        help="(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--clock-periods",
+        nargs="+",
+        type=float,
+        default=[1.1],
+        help="Target clock periods in ns (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--post-synthesis",
+        type=int,
+        default=1,
+        help="Passed on to vivadocompile.sh (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=str,
+        default="sweep",
+        help="Where the working directory of each job and the results are stored (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--slots",
+        type=int,
+        default=1,
+        help="Number of jobs run concurrently (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="Kill a job after this many seconds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=0,
+        help="Number of times a failed or timed out job is retried (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--omx-path",
+        type=str,
+        default=None,
+        help="The oh-my-xilinx directory, defaults to $OHMYXILINX",
+    )
+    parser.add_argument(
+        "--shell",
+        type=str,
+        default="zsh",
+        help="The shell used to run vivadocompile.sh (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=None,
+        help="A directory to cache synthesis results in (default: $NEURALUT_SYNTHESIS_CACHE or ~/.cache/neuralut/synthesis)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=10.0,
+        help="Size of the synthesis cache in GiB (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="Synthesize every job, without looking up or storing results in the cache (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    jobs = grid_jobs(
+        args.verilog_dirs,
+        args.fpga_parts,
+        args.clock_periods,
+        top_name=args.top_name,
+        post_synthesis=args.post_synthesis,
+    )
+    sweep = SynthesisSweep(
+        args.work_dir,
+        slots=args.slots,
+        timeout=args.timeout,
+        retries=args.retries,
+        omx_path=args.omx_path,
+        shell=args.shell,
+        cache=None if args.no_cache else SynthesisCache(args.cache, max_size_gb=args.cache_size),
+    )
+    results = sweep.run(jobs)
+    print(format_results(results))
+    print(f"Results stored at: {args.work_dir}/results.csv")
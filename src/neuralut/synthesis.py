@@ -12,47 +12,144 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import glob
 import os
+import shutil
+import signal
 import subprocess
+import time
 from shutil import which
 
-#xcvu9p-flgb2104-2-i
-# TODO: Add option to perform synthesis on a remote server
-def synthesize_and_get_resource_counts(verilog_dir, top_name, fpga_part = "xcku3p-ffva676-1-e", clk_name="clk", clk_period_ns=5.0, post_synthesis = 0):
-    # old part : "xczu3eg-sbva484-1-i"
-    # ensure that the OH_MY_XILINX envvar is set
-    if "OHMYXILINX" not in os.environ:
-        raise Exception("The environment variable OHMYXILINX is not defined.")
+from .instrument import span
+from .reports import read_synthesis_report
+
+# The oh-my-xilinx command which synthesizes the design in verilog_dir, omx_path
+# defaults to $OHMYXILINX
+def synthesis_command(verilog_dir, top_name, fpga_part, clk_name, clk_period_ns, post_synthesis, omx_path=None, shell="zsh"):
+    if omx_path is None:
+        # ensure that the OH_MY_XILINX envvar is set
+        if "OHMYXILINX" not in os.environ:
+            raise Exception("The environment variable OHMYXILINX is not defined.")
+        omx_path = os.environ["OHMYXILINX"]
     # ensure that vivado is in PATH: source $VIVADO_PATH/settings64.sh
     if which("vivado") is None:
         raise Exception("vivado is not in PATH, ensure settings64.sh is sourced.")
     abs_verilog_dir = os.path.abspath(verilog_dir)
-    omx_path = os.environ["OHMYXILINX"]
     script = "vivadocompile.sh"
     # vivadocompile.sh <top-level-entity> <clock-name (optional)> <fpga-part (optional)>
-    call_omx = "zsh %s/%s %s %s %s %f %s %s" % (omx_path, script, top_name, clk_name, fpga_part, float(clk_period_ns), post_synthesis, abs_verilog_dir)
-    call_omx = call_omx.split()
-    proc = subprocess.Popen(call_omx, cwd=verilog_dir, stdout=subprocess.PIPE, env=os.environ)
-    proc.communicate()
+    call_omx = "%s %s/%s %s %s %s %f %s %s" % (shell, omx_path, script, top_name, clk_name, fpga_part, float(clk_period_ns), post_synthesis, abs_verilog_dir)
+    return call_omx.split()
+
+
+# vivadocompile.sh only writes res.txt, the per-layer reports parsed by
+# neuralut.reports (report_utilization -hierarchical, report_timing) are written
+# by a second Vivado batch run of this script. It opens the newest design
+# checkpoint of the synthesis run or, if there is none, synthesizes the design
+# out-of-context again, the counts are then post-synthesis rather than post-route.
+#   vivado -mode batch -source layer_reports.tcl -tclargs <results dir> <max paths>
+#       <checkpoint or -> <verilog dir> <top> <fpga part> <clock name> <clock period>
+LAYER_REPORTS_TCL = """\
+lassign $argv results_dir max_paths checkpoint verilog_dir top fpga_part clk_name clk_period
+if {$checkpoint ne "-"} {
+    open_checkpoint $checkpoint
+} else {
+    read_verilog [glob -directory $verilog_dir *.v]
+    synth_design -top $top -part $fpga_part -mode out_of_context
+    create_clock -name $clk_name -period $clk_period [get_ports $clk_name]
+}
+report_utilization -hierarchical -hierarchical_depth 3 -file [file join $results_dir utilization_hierarchical.rpt]
+report_timing -max_paths $max_paths -nworst 1 -sort_by slack -file [file join $results_dir timing_paths.rpt]
+"""
+
+
+# Run a command in a new session, so that the whole process group (vivado
+# included) can be killed on a timeout, returns its exit code
+def _run_in_session(cmd, cwd, timeout=None, log=None):
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=log if log is not None else subprocess.PIPE, stderr=subprocess.STDOUT if log is not None else None, env=os.environ, start_new_session=True)
+    try:
+        proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.communicate()
+        raise
+    return proc.returncode
+
+
+# The newest design checkpoint written below verilog_dir since start_time, e.g.,
+# by vivadocompile.sh, or None
+def find_checkpoint(verilog_dir, start_time):
+    checkpoints = [
+        p for p in glob.glob(os.path.join(verilog_dir, "**", "*.dcp"), recursive=True)
+        if os.path.getmtime(p) >= start_time
+    ]
+    return max(checkpoints, key=os.path.getmtime) if checkpoints else None
 
+
+# Write the per-layer utilization and timing reports of a synthesized design to
+# results_dir with LAYER_REPORTS_TCL, returns whether Vivado succeeded. Its log
+# is written to verilog_dir/layer_reports.log.
+def write_layer_reports(verilog_dir, top_name, fpga_part, clk_name, clk_period_ns, results_dir, checkpoint=None, max_paths=10, timeout=None, log_file=None):
+    verilog_dir = os.path.abspath(verilog_dir)
+    results_dir = os.path.abspath(results_dir)
+    tcl_path = os.path.join(results_dir, "layer_reports.tcl")
+    with open(tcl_path, "w") as f:
+        f.write(LAYER_REPORTS_TCL)
+    cmd = [
+        "vivado", "-mode", "batch", "-nojournal", "-log", "layer_reports.log",
+        "-source", tcl_path, "-tclargs", results_dir, str(max_paths),
+        os.path.abspath(checkpoint) if checkpoint is not None else "-",
+        verilog_dir, top_name, fpga_part, clk_name, "%f" % float(clk_period_ns),
+    ]
+    log = open(log_file, "a") if log_file is not None else None
+    try:
+        return _run_in_session(cmd, verilog_dir, timeout=timeout, log=log) == 0
+    finally:
+        if log is not None:
+            log.close()
+
+
+#xcvu9p-flgb2104-2-i
+# TODO: Add option to perform synthesis on a remote server
+# If the synthesis does not complete within timeout seconds, it is killed and
+# a subprocess.TimeoutExpired is raised. If it fails (no res.txt, no WNS, or
+# errors in the Vivado logs), an Exception listing the errors is raised.
+# The output of the tools is written to log_file, if specified. The parsed
+# reports are stored in <results folder>/synthesis_report.json.
+# If layer_reports is set and vivadocompile.sh did not write a hierarchical
+# utilization or timing report, they are written by write_layer_reports().
+def synthesize_and_get_resource_counts(verilog_dir, top_name, fpga_part = "xcku3p-ffva676-1-e", clk_name="clk", clk_period_ns=5.0, post_synthesis = 0, omx_path=None, shell="zsh", timeout=None, log_file=None, verbose=True, layer_reports=True):
+    # old part : "xczu3eg-sbva484-1-i"
+    call_omx = synthesis_command(verilog_dir, top_name, fpga_part, clk_name, clk_period_ns, post_synthesis, omx_path=omx_path, shell=shell)
     vivado_proj_folder = "%s/results_%s" % (verilog_dir, top_name)
-    res_counts_path = vivado_proj_folder + "/res.txt"
+    # Remove the reports of a previous run, which would hide a failure of this one
+    if os.path.exists(vivado_proj_folder):
+        shutil.rmtree(vivado_proj_folder)
+    start_time = time.time()
+    with span("synthesis", top_name=top_name, fpga_part=fpga_part, clk_period_ns=float(clk_period_ns)):
+        log = open(log_file, "w") if log_file is not None else None
+        try:
+            _run_in_session(call_omx, verilog_dir, timeout=timeout, log=log)
+        finally:
+            if log is not None:
+                log.close()
+
+    report = read_synthesis_report(vivado_proj_folder, top_name, clk_period_ns)
+    if layer_reports and not report.failed and not (report.utilization and report.paths):
+        checkpoint = find_checkpoint(verilog_dir, start_time)
+        with span("layer_reports", top_name=top_name, checkpoint=checkpoint):
+            ok = write_layer_reports(verilog_dir, top_name, fpga_part, clk_name, clk_period_ns, vivado_proj_folder, checkpoint=checkpoint, timeout=timeout, log_file=log_file)
+        if not ok:
+            print("Warning: writing the per-layer reports of %s failed, see %s/layer_reports.log" % (top_name, verilog_dir))
+        report = read_synthesis_report(vivado_proj_folder, top_name, clk_period_ns)
+    if os.path.isdir(vivado_proj_folder):
+        report.save(vivado_proj_folder + "/synthesis_report.json")
+    if report.failed:
+        raise Exception("Synthesis of %s failed:\n  %s" % (top_name, "\n  ".join(report.errors)))
+    if verbose:
+        for k, v in report.resources.items():
+            print("%s: %s" % (k, v))
 
-    with open(res_counts_path, 'r') as myfile:
-        res_data = myfile.read().split("\n")
     ret = {}
     ret["vivado_proj_folder"] = vivado_proj_folder
-    for res_line in res_data:
-        res_fields = res_line.split("=")
-        print(res_fields)
-        try:
-            ret[res_fields[0]] = float(res_fields[1])
-        except ValueError:
-            ret[res_fields[0]] = 0
-        except IndexError:
-            ret[res_fields[0]] = 0
-    if ret["WNS"] == 0:
-        ret["fmax_mhz"] = 0
-    else:
-        ret["fmax_mhz"] = 1000.0 / (float(clk_period_ns) - ret["WNS"])
-    return ret
\ No newline at end of file
+    ret.update(report.resource_counts())
+    return ret
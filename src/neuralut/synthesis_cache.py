@@ -0,0 +1,187 @@
+#  This file is part of NeuraLUT.
+#
+#  NeuraLUT is a derivative work based on LogicNets,
+#  which is licensed under the Apache License 2.0.
+
+#  Copyright (C) 2021 Xilinx, Inc
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# A cache of synthesis results, so that synthesizing an unchanged design again
+# (e.g., rerunning neq2lut.py in a new log directory, or a sweep) returns
+# immediately:
+#   cache = SynthesisCache("~/.cache/neuralut/synthesis", max_size_gb=10)
+#   ret = cache.synthesize(verilog_dir, "neuralut", fpga_part=..., clk_period_ns=...)
+# Entries are keyed by the digest of the Verilog files in verilog_dir, the
+# arguments of the synthesis and the synthesis script. Each entry stores the
+# parsed resource counts and a copy of the results_<top> folder written by
+# vivadocompile.sh (res.txt and the reports), which is restored into
+# verilog_dir on a hit. The least recently used entries are evicted once the
+# cache grows beyond max_size_gb.
+
+import glob
+import json
+import os
+import shutil
+import threading
+import time
+from shutil import which
+
+from .instrument import span
+from .pipeline import file_digest, object_digest
+from .synthesis import LAYER_REPORTS_TCL, synthesize_and_get_resource_counts
+
+DEFAULT_CACHE_DIR = os.path.join("~", ".cache", "neuralut", "synthesis")
+
+
+def _dir_size(path) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return size
+
+
+class SynthesisCache:
+    def __init__(self, cache_dir: str = None, max_size_gb: float = 10.0) -> None:
+        if cache_dir is None:
+            cache_dir = os.environ.get("NEURALUT_SYNTHESIS_CACHE", DEFAULT_CACHE_DIR)
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = int(max_size_gb * 2**30)
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    # The key of a synthesis run: the digests of the Verilog files (by name) and
+    # of vivadocompile.sh, and the synthesis arguments. The location of vivado
+    # is included, so that switching to another installation is a miss, and so
+    # is the script writing the per-layer reports, if they are requested.
+    def key(self, verilog_dir, top_name, fpga_part, clk_name, clk_period_ns, post_synthesis, omx_path=None, layer_reports=True) -> str:
+        files = sorted(glob.glob(os.path.join(verilog_dir, "*.v")))
+        if not files:
+            raise Exception(f"No Verilog files found in {verilog_dir}")
+        if omx_path is None:
+            omx_path = os.environ.get("OHMYXILINX", "")
+        script = os.path.join(omx_path, "vivadocompile.sh")
+        return object_digest(
+            {
+                "hdl": {os.path.basename(f): file_digest(f) for f in files},
+                "top_name": top_name,
+                "fpga_part": fpga_part,
+                "clk_name": clk_name,
+                "clk_period_ns": float(clk_period_ns),
+                "post_synthesis": int(post_synthesis),
+                "script": file_digest(script) if os.path.exists(script) else None,
+                "vivado": which("vivado"),
+                "layer_reports": object_digest(LAYER_REPORTS_TCL) if layer_reports else None,
+            }
+        )
+
+    def _entry_dir(self, key) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    # The cached resource counts of a key, with its reports restored into
+    # results_dir, or None on a miss
+    def get(self, key, results_dir=None):
+        entry_dir = self._entry_dir(key)
+        result_path = os.path.join(entry_dir, "result.json")
+        try:
+            with open(result_path) as f:
+                ret = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Mark the entry as recently used
+        now = time.time()
+        os.utime(result_path, (now, now))
+        reports_dir = os.path.join(entry_dir, "reports")
+        if results_dir is not None and os.path.isdir(reports_dir):
+            if os.path.exists(results_dir):
+                shutil.rmtree(results_dir)
+            shutil.copytree(reports_dir, results_dir)
+            ret["vivado_proj_folder"] = results_dir
+        return ret
+
+    # Store the resource counts of a key and a copy of the reports in results_dir.
+    # The entry is written to a temporary directory first, so that concurrent
+    # readers never see a partial entry.
+    def put(self, key, ret: dict, results_dir=None) -> None:
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f"{entry_dir}.tmp-{os.getpid()}-{threading.get_ident()}"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        if results_dir is not None and os.path.isdir(results_dir):
+            shutil.copytree(results_dir, os.path.join(tmp_dir, "reports"))
+        with open(os.path.join(tmp_dir, "result.json"), "w") as f:
+            json.dump(ret, f, indent=2)
+        with self._lock:
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.replace(tmp_dir, entry_dir)
+            self.evict()
+
+    # Remove the least recently used entries until the cache fits in max_size
+    def evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            result_path = os.path.join(path, "result.json")
+            if ".tmp-" in name or not os.path.exists(result_path):
+                continue
+            entries.append((os.path.getmtime(result_path), _dir_size(path), path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self) -> None:
+        with self._lock:
+            for name in os.listdir(self.cache_dir):
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+
+    # synthesize_and_get_resource_counts(), unless the same design was already
+    # synthesized with the same arguments. Failed runs are not cached.
+    def synthesize(self, verilog_dir, top_name, fpga_part="xcku3p-ffva676-1-e", clk_name="clk", clk_period_ns=5.0, post_synthesis=0, **kwargs) -> dict:
+        key = self.key(
+            verilog_dir,
+            top_name,
+            fpga_part,
+            clk_name,
+            clk_period_ns,
+            post_synthesis,
+            omx_path=kwargs.get("omx_path"),
+            layer_reports=kwargs.get("layer_reports", True),
+        )
+        results_dir = "%s/results_%s" % (verilog_dir, top_name)
+        with span("synthesis_cache", top_name=top_name, key=key) as s:
+            ret = self.get(key, results_dir)
+            s.set(hit=ret is not None)
+        if ret is not None:
+            if kwargs.get("verbose", True):
+                print(f"Synthesis results found in the cache ({self._entry_dir(key)})")
+            return ret
+        ret = synthesize_and_get_resource_counts(
+            verilog_dir,
+            top_name,
+            fpga_part=fpga_part,
+            clk_name=clk_name,
+            clk_period_ns=clk_period_ns,
+            post_synthesis=post_synthesis,
+            **kwargs,
+        )
+        self.put(key, ret, results_dir)
+        return ret
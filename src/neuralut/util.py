@@ -24,40 +24,26 @@ import subprocess
 
 import torch
 
-# Return the indices associated with a '1' value
-# TODO: vectorise this function
+# Return the indices associated with a '1' value, in ascending order
 def fetch_mask_indices(mask: torch.Tensor) -> torch.LongTensor:
-    local_mask = mask.detach().clone()
-    fan_in = torch.sum(local_mask, dtype=torch.int64)
-    indices = [0] * fan_in
-    for i in range(fan_in):
-        ind = torch.argmax(local_mask)
-        indices[i] = ind
-        local_mask[ind] = 0
-    return tuple(indices)
+    return tuple(torch.nonzero(mask.detach(), as_tuple=True)[0])
 
 
-# Return a matrix which contains all input permutations
-# TODO: implement this function
+# Return a matrix which contains all input permutations, the first input
+# varies fastest
 def generate_permutation_matrix(input_state_space, is_cuda) -> torch.Tensor:
     total_permutations = reduce(
         lambda a, b: a * b, map(lambda x: x.nelement(), input_state_space)
     )  # Calculate the total number of permutations
-    fan_in = len(input_state_space)
-    permutations_matrix = torch.zeros(
-        (total_permutations, fan_in), dtype=torch.float16
-    )
-    if is_cuda:
-        permutations_matrix.cuda()
-    # TODO: is there a way to do this that is vectorised?
-    for p in range(total_permutations):
-        next_perm = p
-        for f in range(fan_in):
-            div_factor = input_state_space[f].nelement()
-            index = next_perm % div_factor
-            permutations_matrix[p, f] = input_state_space[f][index]
-            next_perm = next_perm // div_factor
-    return permutations_matrix
+    permutations = torch.arange(total_permutations)
+    columns = []
+    stride = 1
+    for state_space in input_state_space:
+        state_space = state_space.detach().cpu().to(torch.float16)
+        index = torch.div(permutations, stride, rounding_mode="floor") % state_space.nelement()
+        columns.append(state_space[index])
+        stride *= state_space.nelement()
+    return torch.stack(columns, dim=1)
 
 
 # Prepare a directory for simulating post-synthesis verilog from Vivado.
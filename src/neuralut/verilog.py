@@ -12,6 +12,8 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+from itertools import accumulate
+
 def generate_register_verilog(module_name="myreg", param_name="DataWidth", input_name="data_in", output_name="data_out"):
     register_template = """\
 module {module_name} #(parameter {param_name}=16) (
@@ -80,12 +82,16 @@ endmodule\n"""
                                         output_bits_1=output_bits-1,
                                         lut_string=lut_string)
 
+# input_bitwidth is either the bitwidth of every input, or a list with the bitwidth of each input
 def generate_neuron_connection_verilog(input_indices, input_bitwidth):
+    if isinstance(input_bitwidth, int):
+        input_bitwidth = [input_bitwidth]*(max(int(i) for i in input_indices)+1)
+    offsets = [0] + list(accumulate(input_bitwidth))
     connection_string = ""
     for i in range(len(input_indices)):
-        index = input_indices[i]
-        offset = index*input_bitwidth
-        for b in reversed(range(input_bitwidth)):
+        index = int(input_indices[i])
+        offset = offsets[index]
+        for b in reversed(range(input_bitwidth[index])):
             connection_string += f"M0[{offset+b}]"
             if not (i == len(input_indices)-1 and b == 0):
                 connection_string += ", "
@@ -0,0 +1,81 @@
+#!/bin/sh
+#  This file is part of NeuraLUT.
+#
+#  A stand-in for oh-my-xilinx's vivadocompile.sh, to try neuralut.sweep (and
+#  synthesize_and_get_resource_counts) on machines without Vivado. It takes the
+#  same arguments:
+#    vivadocompile.sh <top> <clock name> <fpga part> <clock period> <post synthesis> <verilog dir>
+#  and writes results_<top>/res.txt with resource counts derived from the size
+#  of the Verilog files, a hierarchical utilization report and a timing report
+#  with one path per layer. The environment variables
+#    FAKE_VIVADO_DELAY: seconds to sleep before writing the results (default: 1)
+#    FAKE_VIVADO_FAIL:  if set to 1, exit with an error without writing results
+#  can be used to exercise timeouts and retries.
+
+TOP=$1
+CLK_PERIOD=$4
+VERILOG_DIR=$6
+
+sleep "${FAKE_VIVADO_DELAY:-1}"
+if [ "${FAKE_VIVADO_FAIL:-0}" = "1" ]; then
+    echo "Fake synthesis of $TOP failed" >&2
+    exit 1
+fi
+
+RESULTS="results_$TOP"
+mkdir -p "$RESULTS"
+LINES=$(cat "$VERILOG_DIR"/*.v | wc -l)
+LUT=$((LINES / 4))
+FF=$((LINES / 16))
+# WNS shrinks with the size of the design, relative to the clock period
+WNS=$(awk -v p="$CLK_PERIOD" -v n="$LINES" 'BEGIN { printf "%.3f", p - 0.5 - n / 100000 }')
+{
+    echo "LUT=$LUT"
+    echo "FF=$FF"
+    echo "DSP=0"
+    echo "BRAM=0"
+    echo "WNS=$WNS"
+} > "$RESULTS/res.txt"
+
+# report_utilization -hierarchical
+{
+    echo "+------------------------+-------------+------------+------------+---------+------+------+"
+    echo "|        Instance        |    Module   | Total LUTs | Logic LUTs | LUTRAMs | SRLs |  FFs |"
+    echo "+------------------------+-------------+------------+------------+---------+------+------+"
+    printf "| %-22s | %11s | %10d | %10d | %7d | %4d | %4d |\n" "$TOP" "(top)" "$LUT" "$LUT" 0 0 "$FF"
+    for LAYER in "$VERILOG_DIR"/layer*.v; do
+        case "$LAYER" in *_N*) continue ;; esac
+        [ -e "$LAYER" ] || continue
+        L=$(basename "$LAYER" .v)
+        L_LUT=$(($(cat "$VERILOG_DIR/${L}"_N*.v "$LAYER" 2>/dev/null | wc -l) / 4))
+        printf "| %-22s | %11s | %10d | %10d | %7d | %4d | %4d |\n" "  ${L}_inst" "$L" "$L_LUT" "$L_LUT" 0 0 0
+        for NEURON in "$VERILOG_DIR/${L}"_N*.v; do
+            [ -e "$NEURON" ] || continue
+            N=$(basename "$NEURON" .v)
+            N_LUT=$(($(wc -l < "$NEURON") / 4))
+            printf "| %-22s | %11s | %10d | %10d | %7d | %4d | %4d |\n" "    ${N}_inst" "$N" "$N_LUT" "$N_LUT" 0 0 0
+        done
+    done
+    echo "+------------------------+-------------+------------+------------+---------+------+------+"
+} > "$RESULTS/utilization_hierarchical.rpt"
+
+# report_timing, one path per layer, the one of the first layer is the worst
+{
+    I=0
+    for LAYER in "$VERILOG_DIR"/layer*.v; do
+        case "$LAYER" in *_N*) continue ;; esac
+        [ -e "$LAYER" ] || continue
+        L=$(basename "$LAYER" .v)
+        SLACK=$(awk -v w="$WNS" -v i="$I" 'BEGIN { printf "%.3f", w + 0.1 * i }')
+        echo "Slack (MET) :              ${SLACK}ns  (required time - arrival time)"
+        echo "  Source:                 ${L}_reg/data_out_reg[0]/C"
+        echo "  Destination:            ${L}_inst/${L}_N0_inst/M1_reg[0]/D"
+        echo "  Path Group:             clk"
+        echo "  Requirement:            ${CLK_PERIOD}ns  (clk rise@${CLK_PERIOD}ns - clk rise@0.000ns)"
+        echo "  Data Path Delay:        0.500ns  (logic 0.200ns (40.000%)  route 0.300ns (60.000%))"
+        echo "  Logic Levels:           2  (LUT6=2)"
+        echo
+        I=$((I + 1))
+    done
+} > "$RESULTS/timing_paths.rpt"
+echo "Fake synthesis of $TOP done: LUT=$LUT FF=$FF WNS=$WNS"